@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Booleans of the "python" and "numpy" engines on the same solids.
+#
+# - "box": a box of `12 * size ** 2` triangles minus a sphere of 1520
+#   triangles on one of its corners; size 65 is about 50k triangles.
+# - "spheres": the union of two overlapping spheres of `8 * size ** 2` quads.
+#
+# Every run starts from fresh solids, so both engines build their trees. The
+# time is the best of `repeat` runs.
+#
+#     python bench/bench_engines.py [-c box,spheres] [-s 20,65] [-r 1]
+#
+
+import argparse
+import os
+import sys
+import time
+sys.path.append(os.path.abspath(os.path.realpath(os.path.dirname(__file__)) + "/../src"))
+
+import bench_suite
+import csg_builder
+
+ENGINES = ("python", "numpy")
+
+
+# (operation, a, b) of the case `name` at `size`, as solids.
+def _case(name, size):
+    if name == "box":
+        return ("subtract", bench_suite.box(size, (0.0, 0.0, 0.0), 2.0),
+                bench_suite.sphere(10, (1.0, 0.7, 0.4), 0.8))
+    if name == "spheres":
+        return ("union", bench_suite.sphere(size),
+                bench_suite.sphere(size, (0.5, 0.3, 0.2)))
+    assert False, "unknown case=%s" % name
+
+
+def run(name, size, engine, repeat):
+    op, a, b = _case(name, size)
+    as_tri = name == "box"
+    best = None
+    for i in xrange(repeat):
+        csg_a = csg_builder.csg_from_solid(a, as_tri=as_tri)
+        csg_b = csg_builder.csg_from_solid(b, as_tri=as_tri)
+        t = time.time()
+        result = getattr(csg_a, op)(csg_b, engine=engine)
+        elapsed = time.time() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return len(csg_a.polygons) + len(csg_b.polygons), len(result.polygons), best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="compare the boolean engines")
+    parser.add_argument("-c", "--cases", default="box,spheres", help="cases to run, comma separated")
+    parser.add_argument("-s", "--sizes", default="20,65", help="tessellation levels, comma separated")
+    parser.add_argument("-r", "--repeat", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    print "%-8s %5s %8s %10s %10s %10s %10s %8s" % (
+        "case", "size", "items", "py out", "np out", "py[s]", "np[s]", "speedup")
+    for name in args.cases.split(","):
+        for size in [int(s) for s in args.sizes.split(",")]:
+            items, python_out, python_time = run(name, size, "python", args.repeat)
+            items, numpy_out, numpy_time = run(name, size, "numpy", args.repeat)
+            print "%-8s %5d %8d %10d %10d %10.2f %10.2f %7.1fx" % (
+                name, size, items, python_out, numpy_out, python_time, numpy_time,
+                python_time / numpy_time)
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
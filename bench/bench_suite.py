@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Benchmarks of booleans, PLY I/O and conversion on generated solids.
+#
+# Every case works on parametric solids (a UV sphere, a cylinder with n-gon
+# caps and a subdivided box) tessellated at each `size`, and runs in a fresh
+# worker process so that its peak memory (`peak_mb`, setup included) is its
+# own. The time of a case is the best of `repeat` runs; `rate` is items
+# (faces or polygons) per second.
+#
+# Results are compared against a stored baseline (bench/baseline.json by
+# default): a case slower or bigger than the baseline by more than
+# `tolerance` is reported as a regression and makes the exit status 1. A
+# baseline records the git revision it was captured at; save a new one with
+# every change meant to move the timings.
+#
+#     python bench/bench_suite.py [-s 4,8,12] [-r 3] [-o results.json]
+#     python bench/bench_suite.py --save      # store the run as the baseline
+#
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+sys.path.append(os.path.abspath(os.path.realpath(os.path.dirname(__file__)) + "/../src"))
+
+from csg import CSG
+from solid import Solid
+import csg_builder
+import ply_reader
+import ply_writer
+
+# Time changes of cases faster than this (seconds) are noise.
+MIN_TIME = 0.01
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+CASES = ("csg_from_solid", "union", "subtract", "intersect", "csg_to_solid",
+         "write_ascii", "write_binary", "read_ascii", "read_binary")
+
+
+# Faces point outwards (counterclockwise seen from outside).
+def sphere(n, center=(0.0, 0.0, 0.0), radius=1.0):
+    slices = 4 * n
+    stacks = 2 * n
+    solid = Solid()
+    cx, cy, cz = center
+    top = solid.append_vertex([cx, cy, cz + radius])
+    rings = []
+    for j in xrange(1, stacks):
+        phi = math.pi * j / stacks
+        ring = []
+        for i in xrange(slices):
+            theta = 2 * math.pi * i / slices
+            ring.append(solid.append_vertex([cx + radius * math.sin(phi) * math.cos(theta),
+                                             cy + radius * math.sin(phi) * math.sin(theta),
+                                             cz + radius * math.cos(phi)]))
+        rings.append(ring)
+    bottom = solid.append_vertex([cx, cy, cz - radius])
+
+    for i in xrange(slices):
+        k = (i + 1) % slices
+        solid.append_polygon([top, rings[0][i], rings[0][k]], as_tri=False)
+        for j in xrange(len(rings) - 1):
+            solid.append_polygon([rings[j][i], rings[j + 1][i], rings[j + 1][k], rings[j][k]],
+                                 as_tri=False)
+        solid.append_polygon([bottom, rings[-1][k], rings[-1][i]], as_tri=False)
+    return solid
+
+
+def cylinder(n, center=(0.0, 0.0, 0.0), radius=1.0, height=2.0):
+    segments = 4 * n
+    solid = Solid()
+    cx, cy, cz = center
+    lower = []
+    upper = []
+    for i in xrange(segments):
+        theta = 2 * math.pi * i / segments
+        x = cx + radius * math.cos(theta)
+        y = cy + radius * math.sin(theta)
+        lower.append(solid.append_vertex([x, y, cz - height / 2]))
+        upper.append(solid.append_vertex([x, y, cz + height / 2]))
+    for i in xrange(segments):
+        k = (i + 1) % segments
+        solid.append_polygon([lower[i], lower[k], upper[k], upper[i]], as_tri=False)
+    solid.append_polygon(upper[:], as_tri=False)
+    solid.append_polygon(lower[::-1], as_tri=False)
+    return solid
+
+
+def box(n, center=(0.0, 0.0, 0.0), size=1.0):
+    solid = Solid()
+    indices = {}
+    for axis in xrange(3):
+        u = (axis + 1) % 3
+        v = (axis + 2) % 3
+        for sign in (-1, 1):
+            for i in xrange(n):
+                for j in xrange(n):
+                    face = []
+                    for a, b in ((i, j), (i + 1, j), (i + 1, j + 1), (i, j + 1)):
+                        key = [0, 0, 0]
+                        key[axis] = sign * n
+                        key[u] = 2 * a - n
+                        key[v] = 2 * b - n
+                        key = tuple(key)
+                        if key not in indices:
+                            indices[key] = solid.append_vertex(
+                                [center[k] + size * key[k] / (2.0 * n) for k in xrange(3)])
+                        face.append(indices[key])
+                    if sign < 0:
+                        face.reverse()
+                    solid.append_polygon(face, as_tri=False)
+    return solid
+
+
+# The operands of the booleans at `size`: a sphere and an off-centre cylinder
+# crossing it, so that the cut is not aligned with either tessellation.
+def _operands(size):
+    a = csg_builder.csg_from_solid(sphere(size))
+    b = csg_builder.csg_from_solid(cylinder(size, (0.31, 0.17, 0.05), 0.55, 3.0))
+    return a, b
+
+
+def _result(size):
+    a, b = _operands(size)
+    return a.union(b)
+
+
+def _solid(size):
+    return csg_builder.csg_to_solid(_result(size))
+
+
+# (setup, run, items) of the case `name` at `size`. `setup()` makes the input
+# of one run (not timed) and `run(input)` is timed.
+def _case(name, size, directory):
+    if name == "csg_from_solid":
+        solid = box(size)
+        solid.append_solid(sphere(size))
+        return (lambda: solid), csg_builder.csg_from_solid, len(solid.faces)
+    if name in ("union", "subtract", "intersect"):
+        a, b = _operands(size)
+        # Fresh solids every run, so the BSP trees are built in every run.
+        setup = lambda: (CSG(a.polygons), CSG(b.polygons))
+        return setup, lambda (a, b): getattr(a, name)(b), len(a.polygons) + len(b.polygons)
+    if name == "csg_to_solid":
+        result = _result(size)
+        return (lambda: result), csg_builder.csg_to_solid, len(result.polygons)
+    if name.startswith("write_"):
+        solid = _solid(size)
+        path = os.path.join(directory, name + ".ply")
+        def write(solid):
+            writer = ply_writer.PLYWriter(path, "ascii" if name == "write_ascii" else "binary_little_endian")
+            writer.write_solid(solid)
+            writer.close()
+        return (lambda: solid), write, len(solid.faces)
+    if name.startswith("read_"):
+        solid = _solid(size)
+        path = os.path.join(directory, name + ".ply")
+        writer = ply_writer.PLYWriter(path, "ascii" if name == "read_ascii" else "binary_little_endian")
+        writer.write_solid(solid)
+        writer.close()
+        return (lambda: path), ply_reader.read, len(solid.faces)
+    assert False, "unknown case=%s" % name
+
+
+def _peak_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0)
+
+
+# Worker: run one case and return its record.
+def run_case(args):
+    name, size, repeat = args
+    directory = tempfile.mkdtemp(prefix="csg_bench_")
+    try:
+        setup, run, items = _case(name, size, directory)
+        best = None
+        for i in xrange(repeat):
+            data = setup()
+            t = time.time()
+            run(data)
+            elapsed = time.time() - t
+            best = elapsed if best is None else min(best, elapsed)
+        return {"case": name, "size": size, "items": items, "time": best,
+                "rate": items / best if best > 0 else None, "peak_mb": _peak_mb()}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run(cases, sizes, repeat):
+    # One process per case: the peak memory of a process never goes down.
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        for name in cases:
+            for size in sizes:
+                yield pool.apply(run_case, ((name, size, repeat),))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+# Relative change of the time and the peak memory of `record` against the
+# baseline `base`, and whether either grew by more than `tolerance`.
+def compare(record, base, tolerance):
+    time_change = record["time"] / base["time"] - 1.0 if base["time"] > 0 else 0.0
+    peak_change = record["peak_mb"] / base["peak_mb"] - 1.0 if base["peak_mb"] > 0 else 0.0
+    slower = time_change > tolerance and record["time"] > MIN_TIME
+    return time_change, peak_change, slower or peak_change > tolerance
+
+
+# The git revision of the tree, or None outside a git checkout.
+def _revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark booleans, PLY I/O and conversion")
+    parser.add_argument("-s", "--sizes", default="4,8,12", help="tessellation levels, comma separated")
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument("-c", "--cases", default=",".join(CASES), help="cases to run, comma separated")
+    parser.add_argument("-o", "--output", default=None, help="write the results as JSON")
+    parser.add_argument("-b", "--baseline", default=BASELINE)
+    parser.add_argument("-t", "--tolerance", type=float, default=0.25,
+                        help="allowed relative growth of time and memory")
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    cases = args.cases.split(",")
+    for name in cases:
+        if name not in CASES:
+            assert False, "unknown case=%s" % name
+
+    baseline = {}
+    revision = None
+    if not args.save and os.path.exists(args.baseline):
+        with open(args.baseline) as io:
+            report = json.load(io)
+        revision = report.get("revision")
+        for r in report["results"]:
+            baseline[(r["case"], r["size"])] = r
+
+    print "%-16s %5s %8s %10s %12s %9s %9s %9s" % (
+        "case", "size", "items", "time[ms]", "rate[/s]", "peak[MB]", "time", "peak")
+    results = []
+    regressions = 0
+    for record in run(cases, sizes, args.repeat):
+        results.append(record)
+        line = "%-16s %5d %8d %10.1f %12.0f %9.1f" % (
+            record["case"], record["size"], record["items"], record["time"] * 1000,
+            record["rate"] or 0, record["peak_mb"])
+        base = baseline.get((record["case"], record["size"]))
+        if base:
+            time_change, peak_change, regressed = compare(record, base, args.tolerance)
+            line += " %+8.0f%% %+8.0f%%" % (time_change * 100, peak_change * 100)
+            if regressed:
+                regressions += 1
+                line += "  REGRESSION"
+        print line
+        sys.stdout.flush()
+
+    report = {"python": sys.version.split()[0], "platform": sys.platform,
+              "repeat": args.repeat, "revision": _revision(), "results": results}
+    if args.output:
+        with open(args.output, "w") as io:
+            json.dump(report, io, indent=1, sort_keys=True, separators=(",", ": "))
+    if args.save:
+        with open(args.baseline, "w") as io:
+            json.dump(report, io, indent=1, sort_keys=True, separators=(",", ": "))
+        print "saved %s" % args.baseline
+    elif baseline:
+        print "%d regressions against %s at %s (tolerance %.0f%%)" % (
+            regressions, args.baseline, revision or "unknown revision", args.tolerance * 100)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
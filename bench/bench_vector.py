@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Microbenchmark of CSG.Vector / CSG.Plane / CSG.Polygon.
+#
+# "before" is a copy of the original classes (old-style classes with a
+# __dict__, an isinstance check in Vector.__init__ and a temporary vector per
+# arithmetic step); "after" is the current src/csg.py.
+#
+#     python bench/bench_vector.py [repeat]
+#
+
+import math
+import os
+import random
+import sys
+import timeit
+sys.path.append(os.path.abspath(os.path.realpath(os.path.dirname(__file__)) + "/../src"))
+
+from csg import CSG
+
+EPSILON = 1e-3
+
+
+class Vector:
+
+    def __init__(self, x, y=None, z=None):
+        if isinstance(x, list):
+            self.x = x[0]
+            self.y = x[1]
+            self.z = x[2]
+        else:
+            self.x = x
+            self.y = y
+            self.z = z
+
+    def clone(self):
+        return Vector(self.x, self.y, self.z)
+
+    def plus(self, a):
+        return Vector(self.x + a.x, self.y + a.y, self.z + a.z)
+
+    def minus(self, a):
+        return Vector(self.x - a.x, self.y - a.y, self.z - a.z)
+
+    def times(self, a):
+        return Vector(self.x * a, self.y * a, self.z * a)
+
+    def dividedBy(self, a):
+        if a == 0.0:
+            return self.clone()
+        return Vector(self.x / a, self.y / a, self.z / a)
+
+    def dot(self, a):
+        return self.x * a.x + self.y * a.y + self.z * a.z
+
+    def lerp(self, a, t):
+        return self.plus(a.minus(self).times(t))
+
+    def length(self):
+        return math.sqrt(self.dot(self))
+
+    def unit(self):
+        return self.dividedBy(self.length())
+
+    def cross(self, a):
+        return Vector(
+            self.y * a.z - self.z * a.y,
+            self.z * a.x - self.x * a.z,
+            self.x * a.y - self.y * a.x
+        )
+
+    def interpolate(self, other, t):
+        return self.lerp(other, t)
+
+
+class Plane:
+
+    def __init__(self, normal, w):
+        self.normal = normal
+        self.w = w
+
+    @classmethod
+    def fromPoints(cls, a, b, c):
+        n = b.minus(a).cross(c.minus(a)).unit()
+        return Plane(n, n.dot(a))
+
+    def splitPolygon(self, polygon, coplanarFront, coplanarBack, front, back):
+        COPLANAR = 0
+        FRONT = 1
+        BACK = 2
+        SPANNING = 3
+
+        polygonType = 0
+        types = []
+        for vertex in polygon.vertices:
+            t = self.normal.dot(vertex) - self.w
+            if t < -EPSILON:
+                typ = BACK
+            elif t > EPSILON:
+                typ = FRONT
+            else:
+                typ = COPLANAR
+            polygonType |= typ
+            types.append(typ)
+
+        if polygonType == COPLANAR:
+            if self.normal.dot(polygon.plane.normal) > 0:
+                coplanarFront.append(polygon)
+            else:
+                coplanarBack.append(polygon)
+        elif polygonType == FRONT:
+            front.append(polygon)
+        elif polygonType == BACK:
+            back.append(polygon)
+        elif polygonType == SPANNING:
+            f = []
+            b = []
+            for i in xrange(len(polygon.vertices)):
+                j = (i + 1) % len(polygon.vertices)
+                ti = types[i]
+                tj = types[j]
+                vi = polygon.vertices[i]
+                vj = polygon.vertices[j]
+                if ti != BACK:
+                    f.append(vi)
+                if ti != FRONT:
+                    b.append(vi.clone() if not ti == BACK else vi)
+                if (ti | tj) == SPANNING:
+                    t = (self.w - self.normal.dot(vi)) / self.normal.dot(vj.minus(vi))
+                    v = vi.interpolate(vj, t)
+                    f.append(v)
+                    b.append(v.clone())
+            if len(f) >= 3:
+                front.append(Polygon(f, polygon.shared))
+            if len(b) >= 3:
+                back.append(Polygon(b, polygon.shared))
+
+
+class Polygon:
+
+    def __init__(self, vertices, shared):
+        self.vertices = vertices
+        self.shared = shared
+        self.plane = Plane.fromPoints(vertices[0], vertices[1], vertices[2])
+
+
+def _points(count, seed=1):
+    rnd = random.Random(seed)
+    return [[rnd.uniform(-1, 1), rnd.uniform(-1, 1), rnd.uniform(-1, 1)] for i in xrange(count)]
+
+
+def _cases(vector, plane, polygon, points):
+    vectors = [vector(p) for p in points]
+    triangles = [polygon(vectors[i:i + 3], None) for i in xrange(0, len(vectors) - 2, 3)]
+    splitter = plane.fromPoints(vector(0.0, 0.0, 0.0), vector(1.0, 0.0, 0.0), vector(0.0, 1.0, 0.0))
+
+    def construct():
+        for p in points:
+            vector(p[0], p[1], p[2])
+
+    def lerp():
+        for i in xrange(len(vectors) - 1):
+            vectors[i].lerp(vectors[i + 1], 0.5)
+
+    def from_points():
+        for i in xrange(0, len(vectors) - 2, 3):
+            plane.fromPoints(vectors[i], vectors[i + 1], vectors[i + 2])
+
+    def split():
+        out = []
+        for t in triangles:
+            splitter.splitPolygon(t, out, out, out, out)
+
+    return [("Vector()", construct), ("Vector.lerp", lerp),
+            ("Plane.fromPoints", from_points), ("Plane.splitPolygon", split)]
+
+
+def _size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__"):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    points = _points(30000)
+    before = _cases(Vector, Plane, Polygon, points)
+    after = _cases(CSG.Vector, CSG.Plane, CSG.Polygon, points)
+
+    print "%-20s %10s %10s %8s" % ("", "before[ms]", "after[ms]", "speedup")
+    for (name, old), (_, new) in zip(before, after):
+        t_old = min(timeit.repeat(old, number=1, repeat=repeat)) * 1000
+        t_new = min(timeit.repeat(new, number=1, repeat=repeat)) * 1000
+        print "%-20s %10.1f %10.1f %7.2fx" % (name, t_old, t_new, t_old / t_new)
+
+    print "%-20s %10d %10d" % ("Vector size[bytes]", _size(Vector(1.0, 2.0, 3.0)),
+                               _size(CSG.Vector(1.0, 2.0, 3.0)))
+
+
+if __name__ == "__main__":
+    main()
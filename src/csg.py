@@ -1,6 +1,11 @@
 # coding:utf-8
+import json
 import math
+import random
 import sys
+import time
+from array import array
+from fractions import Fraction
 
 
 def fp3(value):
@@ -12,13 +17,42 @@ def fp3(value):
 
 class CSG:
 
+    # Engine used by `union`, `subtract` and `intersect` when none is given.
+    # "python" runs the `CSG.Node` trees below, "numpy" runs the vectorized
+    # engine in csg_numpy.py (requires NumPy).
+    DEFAULT_ENGINE = "python"
+
+    # Run booleans in robust mode when no `robust` is given (see `_operate`).
+    ROBUST = False
+
+    # `CSG.Profile` recording every boolean run without a `profile`, or None.
+    PROFILE = None
+
+    # `csg_cache.Cache` used by booleans run without a `cache`, or None.
+    CACHE = None
+
     def __init__(self, polygons=[]):
         self.polygons = polygons
+        self._bounds = None
+        self._tree = None
+        self._flat = None
+        self._treeKey = None
+        self._digest = None
 
     @classmethod
     def fromPolygons(cls, polygons):
         return CSG(polygons)
 
+    # Return a new CSG solid holding the polygons of the BSP tree `node`, which
+    # it keeps as its cached tree. `node` must have been built from those
+    # polygons alone.
+    @classmethod
+    def fromTree(cls, node):
+        csg = CSG(node.allPolygons())
+        csg._tree = node
+        csg._treeKey = CSG._treeKeyFor(node.splitter)
+        return csg
+
     def clone(self):
         polygons = [p.clone() for p in self.polygons]
         return CSG(polygons)
@@ -26,6 +60,52 @@ class CSG:
     def toPolygons(self):
         return self.polygons
 
+    # Return the BSP tree of self solid. It is built once (split by `splitter`)
+    # and reused by every later boolean, which works on a clone of it.
+    #
+    # Results of booleans have no tree. The tree a boolean ends with holds the
+    # right polygons, but the polygons of the second solid are only filtered
+    # into the cells of the first one, and cells covered by the second solid
+    # without any of its faces stay empty. Classifying other polygons with it
+    # leaves holes in the next result.
+    #
+    # Booleans keep the tree as a `CSG.FlatTree` (`_flat`) and let the nodes
+    # go; they are made again from it when asked for.
+    #
+    # The cached tree is only used with the splitter and under the tolerance
+    # it was built with (`_treeKey`): which side of a plane a polygon is on
+    # depends on the tolerance. Booleans with another splitter, or in robust
+    # mode and in plain mode on the same solid, build it again.
+    def tree(self, splitter=None):
+        self._checkTree(splitter)
+        if self._tree is None:
+            if self._flat is not None:
+                self._tree = self._flat.toNode()
+            else:
+                self._tree = CSG.Node(self.polygons, splitter=splitter)
+                self._treeKey = CSG._treeKeyFor(splitter)
+        return self._tree
+
+    # What a tree built now with `splitter` depends on besides the polygons.
+    @staticmethod
+    def _treeKeyFor(splitter=None):
+        return (splitter.key() if splitter else None, CSG.Plane_EPSILON, CSG.Plane_ROBUST)
+
+    # Forget the cached tree of self solid when it was built for another
+    # `_treeKeyFor`.
+    def _checkTree(self, splitter):
+        if not self._treeKey == CSG._treeKeyFor(splitter):
+            self._tree = None
+            self._flat = None
+            self._treeKey = None
+
+    # Return the `CSG.Bounds` of self solid, or None when it has no polygons.
+    # The box is computed once and cached.
+    def bounds(self):
+        if self._bounds is None and self.polygons:
+            self._bounds = CSG.Bounds.fromPolygons(self.polygons)
+        return self._bounds
+
     def __str__(self):
         text = ""
         for p in self.polygons:
@@ -46,15 +126,29 @@ class CSG:
     #          |       |            |       |
     #          +-------+            +-------+
     #
-    def union(self, csg):
-        a = CSG.Node(self.clone().polygons)
-        b = CSG.Node(csg.clone().polygons)
-        a.clipTo(b)
-        b.clipTo(a)
-        b.invert()
-        b.clipTo(a)
-        b.invert()
-        a.build(b.allPolygons())
+    def union(self, csg, engine=None, splitter=None, parallel=None, robust=None, profile=None,
+              cache=None):
+        return self._operate("union", csg, engine, splitter, parallel, robust, profile, cache)
+
+    def _union(self, csg, splitter=None, bounds=None, parallel=None, profile=None):
+        a = self._clonedTree(splitter, profile, "a")
+        b = csg._clonedTree(splitter, profile, "b")
+        a_bvh = self._bvh(bounds, profile, "a")
+        b_bvh = csg._bvh(bounds, profile, "b")
+        with profile.phase("clipTo", "a", a):
+            a.clipTo(b, bounds, parallel=parallel, bvh=b_bvh)
+        with profile.phase("clipTo", "b", b):
+            b.clipTo(a, bounds, parallel=parallel, bvh=a_bvh)
+        with profile.phase("invert", "b", b):
+            b.invert()
+        with profile.phase("clipTo", "b", b):
+            b.clipTo(a, bounds, parallel=parallel, bvh=a_bvh)
+        with profile.phase("invert", "b", b):
+            b.invert()
+        with profile.phase("allPolygons", "b", b) as phase:
+            polygons = b.allPolygons()
+            phase.polygons_out = len(polygons)
+        a = CSG._built(a, polygons, profile)
         return CSG(a.allPolygons())
 
     # Return a new CSG solid representing space in self solid but not in the
@@ -71,19 +165,171 @@ class CSG:
     #          |       |
     #          +-------+
     #
-    def subtract(self, csg):
-        a = CSG.Node(self.clone().polygons)
-        b = CSG.Node(csg.clone().polygons)
-        a.invert()
-        a.clipTo(b)
-        b.clipTo(a)
-        b.invert()
-        b.clipTo(a)
-        b.invert()
-        a.build(b.allPolygons())
-        a.invert()
+    def subtract(self, csg, engine=None, splitter=None, parallel=None, robust=None, profile=None,
+              cache=None):
+        return self._operate("subtract", csg, engine, splitter, parallel, robust, profile, cache)
+
+    def _subtract(self, csg, splitter=None, bounds=None, parallel=None, profile=None):
+        a = self._clonedTree(splitter, profile, "a")
+        b = csg._clonedTree(splitter, profile, "b")
+        a_bvh = self._bvh(bounds, profile, "a")
+        b_bvh = csg._bvh(bounds, profile, "b")
+        with profile.phase("invert", "a", a):
+            a.invert()
+        with profile.phase("clipTo", "a", a):
+            a.clipTo(b, bounds, parallel=parallel, bvh=b_bvh)
+        with profile.phase("clipTo", "b", b):
+            b.clipTo(a, bounds, keepOutside=False, parallel=parallel, bvh=a_bvh)
+        with profile.phase("invert", "b", b):
+            b.invert()
+        with profile.phase("clipTo", "b", b):
+            b.clipTo(a, bounds, keepOutside=False, parallel=parallel, bvh=a_bvh)
+        # csg.js inverts b back, builds its polygons into a and inverts the
+        # result. Building the flipped polygons of b into a turned back
+        # gives the same solid, and only the polygons of b are ever flipped.
+        with profile.phase("invert", "a", a):
+            a.invert()
+        with profile.phase("allPolygons", "b", b) as phase:
+            polygons = b.allPolygons()
+            phase.polygons_out = len(polygons)
+        a = CSG._built(a, polygons, profile)
         return CSG(a.allPolygons())
 
+    # Subtract every solid in `csgs` from self solid, like a chain of
+    # `subtract` calls. Self solid and every tool are built into a tree once,
+    # and every tree only ever classifies polygons against its own solid: self
+    # solid is clipped by each tool, the tools by each other (`_clipEachOther`)
+    # and by self solid. Tools that miss self solid are skipped.
+    #
+    #     stock.subtract_many([tool1, tool2, tool3])
+    #
+    def subtract_many(self, csgs, splitter=None, parallel=None, robust=None, profile=None):
+        if CSG.ROBUST if robust is None else robust:
+            return CSG._robustly([self] + list(csgs), self.subtract_many, csgs, splitter, parallel, False, profile)
+        if parallel is True or isinstance(parallel, int):
+            import csg_parallel
+            pool = csg_parallel.Pool(None if parallel is True else parallel)
+            try:
+                return self.subtract_many(csgs, splitter, pool, False, profile)
+            finally:
+                pool.close()
+
+        profile = profile or CSG.PROFILE or CSG.Profile(enabled=False)
+        profile.begin("subtract_many", "python")
+        count = len(self.polygons) + sum(len(csg.polygons) for csg in csgs)
+        with profile.phase("operate", None, polygons=count) as operation:
+            box = self.bounds()
+            tools = [csg for csg in csgs if box is not None and csg.bounds() is not None and
+                     box.overlaps(csg.bounds(), CSG.Plane_EPSILON)]
+            if not tools:
+                result = CSG(self.polygons[:])
+            else:
+                a = self._clonedTree(splitter, profile, "a")
+                with profile.phase("invert", "a", a):
+                    a.invert()
+                a_bvh = self._bvh(None, profile, "a")
+                labels = ["b%d" % i for i in xrange(len(tools))]
+                trees = [csg._clonedTree(splitter, profile, label)
+                         for csg, label in zip(tools, labels)]
+                bvhs = [csg._bvh(None, profile, label) for csg, label in zip(tools, labels)]
+                for csg, b, b_bvh in zip(tools, trees, bvhs):
+                    bounds = box.intersection(csg.bounds()).expanded(CSG.Plane_EPSILON)
+                    with profile.phase("clipTo", "a", a):
+                        a.clipTo(b, bounds, parallel=parallel, bvh=b_bvh)
+                CSG._clipEachOther(tools, trees, bvhs, labels, parallel, profile)
+
+                polygons = []
+                for csg, b, label in zip(tools, trees, labels):
+                    bounds = box.intersection(csg.bounds()).expanded(CSG.Plane_EPSILON)
+                    with profile.phase("clipTo", label, b):
+                        b.clipTo(a, bounds, keepOutside=False, parallel=parallel, bvh=a_bvh)
+                    with profile.phase("invert", label, b):
+                        b.invert()
+                    with profile.phase("clipTo", label, b):
+                        b.clipTo(a, bounds, keepOutside=False, parallel=parallel, bvh=a_bvh)
+                    with profile.phase("allPolygons", label, b) as phase:
+                        # Left inverted: the tool's surface faces into the result.
+                        tool = b.allPolygons()
+                        phase.polygons_out = len(tool)
+                    polygons.extend(tool)
+                with profile.phase("invert", "a", a):
+                    a.invert()
+                with profile.phase("allPolygons", "a", a) as phase:
+                    stock = a.allPolygons()
+                    phase.polygons_out = len(stock)
+                result = CSG(stock + polygons)
+            operation.polygons_out = len(result.polygons)
+        return result
+
+    # Union of self solid and every solid in `csgs`, like a chain of `union`
+    # calls. The tree of every solid is built once, and only solids whose
+    # bounds overlap are clipped against each other (`_clipEachOther`); the
+    # others go straight to the result.
+    #
+    #     part.union_many([boss1, boss2, rib])
+    #
+    def union_many(self, csgs, splitter=None, parallel=None, robust=None, profile=None):
+        if CSG.ROBUST if robust is None else robust:
+            return CSG._robustly([self] + list(csgs), self.union_many, csgs, splitter, parallel, False, profile)
+        if parallel is True or isinstance(parallel, int):
+            import csg_parallel
+            pool = csg_parallel.Pool(None if parallel is True else parallel)
+            try:
+                return self.union_many(csgs, splitter, pool, False, profile)
+            finally:
+                pool.close()
+
+        profile = profile or CSG.PROFILE or CSG.Profile(enabled=False)
+        profile.begin("union_many", "python")
+        solids = [csg for csg in [self] + list(csgs) if csg.polygons]
+        count = sum(len(csg.polygons) for csg in solids)
+        with profile.phase("operate", None, polygons=count) as operation:
+            boxes = [csg.bounds() for csg in solids]
+            clipped = [i for i in xrange(len(solids))
+                       if any(not i == j and boxes[i].overlaps(boxes[j], CSG.Plane_EPSILON)
+                              for j in xrange(len(solids)))]
+            labels = ["b%d" % i for i in clipped]
+            trees = [solids[i]._clonedTree(splitter, profile, label)
+                     for i, label in zip(clipped, labels)]
+            bvhs = [solids[i]._bvh(None, profile, label) for i, label in zip(clipped, labels)]
+            CSG._clipEachOther([solids[i] for i in clipped], trees, bvhs, labels, parallel, profile)
+
+            trees = dict(zip(clipped, trees))
+            polygons = []
+            for i, csg in enumerate(solids):
+                if i in trees:
+                    with profile.phase("allPolygons", "b%d" % i, trees[i]) as phase:
+                        tree = trees[i].allPolygons()
+                        phase.polygons_out = len(tree)
+                    polygons.extend(tree)
+                else:
+                    polygons.extend(csg.polygons)
+            result = CSG(polygons)
+            operation.polygons_out = len(result.polygons)
+        return result
+
+    # Clip the trees of overlapping `csgs` against each other, leaving in
+    # `trees` only the surface of their union. Like in `union`, of two
+    # coincident faces only the one of the earlier solid is kept. `bvhs` are
+    # the `CSG.BVH` of `csgs`.
+    @staticmethod
+    def _clipEachOther(csgs, trees, bvhs, labels, parallel, profile):
+        boxes = [csg.bounds() for csg in csgs]
+        for i, b in enumerate(trees):
+            for j, other in enumerate(trees):
+                if i == j or not boxes[i].overlaps(boxes[j], CSG.Plane_EPSILON):
+                    continue
+                bounds = boxes[i].intersection(boxes[j]).expanded(CSG.Plane_EPSILON)
+                with profile.phase("clipTo", labels[i], b):
+                    b.clipTo(other, bounds, parallel=parallel, bvh=bvhs[j])
+                if j < i:
+                    with profile.phase("invert", labels[i], b):
+                        b.invert()
+                    with profile.phase("clipTo", labels[i], b):
+                        b.clipTo(other, bounds, parallel=parallel, bvh=bvhs[j])
+                    with profile.phase("invert", labels[i], b):
+                        b.invert()
+
     # Return a new CSG solid representing space both self solid and in the
     # solid `csg`. Neither self solid nor the solid `csg` are modified.
     #
@@ -98,34 +344,196 @@ class CSG:
     #          |       |
     #          +-------+
     #
-    def intersect(self, csg):
-        #print "a-----------"
-        a = CSG.Node(self.clone().polygons, name="a")
-        #print "b-----------"
-        b = CSG.Node(csg.clone().polygons, name="b")
-        #print "0: a(%s), b(%s)" % (a.p(), b.p())
-        a.invert()
-        #print "1: a(%s), b(%s)" % (a.p(), b.p())
-        b.clipTo(a)
-        #print "2: a(%s), b(%s)" % (a.p(), b.p())
-        b.invert()
-        #print "3: a(%s), b(%s)" % (a.p(), b.p())
-        a.clipTo(b)
-        #print "4: a(%s), b(%s)" % (a.p(), b.p())
-        b.clipTo(a)
-        #print "5: a(%s), b(%s)" % (a.p(), b.p())
-        a.build(b.allPolygons())
-        #print "6: a(%s), b(%s)" % (a.p(), b.p())
-        a.invert()
-        #print "7: a(%s), b(%s)" % (a.p(), b.p())
+    def intersect(self, csg, engine=None, splitter=None, parallel=None, robust=None, profile=None,
+              cache=None):
+        return self._operate("intersect", csg, engine, splitter, parallel, robust, profile, cache)
+
+    def _intersect(self, csg, splitter=None, bounds=None, parallel=None, profile=None):
+        a = self._clonedTree(splitter, profile, "a")
+        b = csg._clonedTree(splitter, profile, "b")
+        a_bvh = self._bvh(bounds, profile, "a")
+        b_bvh = csg._bvh(bounds, profile, "b")
+        with profile.phase("invert", "a", a):
+            a.invert()
+        with profile.phase("clipTo", "b", b):
+            b.clipTo(a, bounds, keepOutside=False, parallel=parallel, bvh=a_bvh)
+        with profile.phase("invert", "b", b):
+            b.invert()
+        with profile.phase("clipTo", "a", a):
+            a.clipTo(b, bounds, keepOutside=False, parallel=parallel, bvh=b_bvh)
+        with profile.phase("clipTo", "b", b):
+            b.clipTo(a, bounds, keepOutside=False, parallel=parallel, bvh=a_bvh)
+        # Like in `subtract`, the flipped polygons of b are built into a
+        # turned back instead of inverting the result. Both trees are turned
+        # back by their flag, so nothing is flipped at all.
+        with profile.phase("invert", "b", b):
+            b.invert()
+        with profile.phase("invert", "a", a):
+            a.invert()
+        with profile.phase("allPolygons", "b", b) as phase:
+            polygons = b.allPolygons()
+            phase.polygons_out = len(polygons)
+        a = CSG._built(a, polygons, profile)
         return CSG(a.allPolygons())
 
+    # The flat tree `a` as `CSG.Node`s, with `polygons` built into it.
+    @staticmethod
+    def _built(a, polygons, profile):
+        with profile.phase("build", "a", a) as phase:
+            phase.node = a.toNode()
+            phase.node.build(polygons)
+        return phase.node
+
+    # `CSG.BVH` over the polygons of self solid touching `bounds`, or all of
+    # them when it is None.
+    def _bvh(self, bounds, profile, label):
+        with profile.phase("bvh", label, polygons=len(self.polygons)):
+            if bounds is None:
+                return CSG.BVH(self.polygons)
+            return CSG.BVH([p for p in self.polygons if bounds.overlaps(p.bounds())])
+
+    # `CSG.FlatTree` copy of the BSP tree of self solid, built first when it is
+    # not cached.
+    def _clonedTree(self, splitter, profile, label):
+        self._checkTree(splitter)
+        if self._flat is None:
+            if self._tree is None:
+                with profile.phase("build", label, polygons=len(self.polygons)) as phase:
+                    phase.node = self.tree(splitter)
+            with profile.phase("flatten", label, self._tree) as phase:
+                phase.node = self._flat = CSG.FlatTree.fromNode(self._tree)
+            self._tree = None
+        with profile.phase("clone", label, self._flat) as phase:
+            phase.node = self._flat.clone()
+        return phase.node
+
+    # Run the boolean `op` on self solid and `csg` with the given engine. The
+    # BSP trees of the "python" engine pick their splitting planes with
+    # `splitter` (a `CSG.Splitter`).
+    #
+    # Solids whose bounds do not overlap take a fast path without any BSP tree.
+    # Otherwise only polygons touching the overlap of both bounds are clipped;
+    # every other polygon is known to be outside the other solid and goes
+    # straight to the output (or is dropped when it is clipped against an
+    # inverted tree).
+    #
+    # `parallel` clips large trees in a process pool (csg_parallel.py): either
+    # a `csg_parallel.Pool` to reuse, a number of processes, or True for one
+    # process per CPU.
+    #
+    # `robust` (default `CSG.ROBUST`) replaces the fixed `CSG.Plane_EPSILON`
+    # with one relative to the size of both solids (`robustEpsilon`) and
+    # classifies the points whose float distance is too close to call
+    # exactly (`CSG.Plane.classifyRobust`). The numpy engine only takes the
+    # relative tolerance.
+    #
+    # `profile` (default `CSG.PROFILE`) is a `CSG.Profile` recording the
+    # phases of the boolean.
+    #
+    # `cache` (default `CSG.CACHE`) is a `csg_cache.Cache` the result is
+    # looked up in first and stored in after.
+    def _operate(self, op, csg, engine, splitter=None, parallel=None, robust=None, profile=None,
+                 cache=None):
+        if CSG.ROBUST if robust is None else robust:
+            return CSG._robustly([self, csg], self._operate, op, csg, engine, splitter, parallel,
+                                 False, profile, cache)
+        engine = engine or CSG.DEFAULT_ENGINE
+        cache = cache or CSG.CACHE
+        key = cache.key(op, self, csg, engine, splitter) if cache else None
+        if key:
+            result = cache.get(key)
+            if result is not None:
+                return result
+
+        profile = profile or CSG.PROFILE or CSG.Profile(enabled=False)
+        profile.begin(op, engine)
+        with profile.phase("operate", None, polygons=len(self.polygons) + len(csg.polygons)) as phase:
+            result = self._operateWith(op, csg, engine, splitter, parallel, profile)
+            phase.polygons_out = len(result.polygons)
+        if key:
+            cache.put(key, result)
+        return result
+
+    def _operateWith(self, op, csg, engine, splitter, parallel, profile):
+        a = self.bounds()
+        b = csg.bounds()
+        if a is None or b is None or not a.overlaps(b, CSG.Plane_EPSILON):
+            return self._disjoint(op, csg)
+        bounds = a.intersection(b).expanded(CSG.Plane_EPSILON)
+
+        if engine == "python":
+            if parallel is True or isinstance(parallel, int):
+                import csg_parallel
+                pool = csg_parallel.Pool(None if parallel is True else parallel)
+                try:
+                    return getattr(self, "_" + op)(csg, splitter, bounds, pool, profile)
+                finally:
+                    pool.close()
+            return getattr(self, "_" + op)(csg, splitter, bounds, parallel, profile)
+        if engine == "numpy":
+            assert splitter is None, "splitter is not supported by the numpy engine"
+            assert not parallel, "parallel is not supported by the numpy engine"
+            import csg_numpy
+            return csg_numpy.operate(op, self, csg, bounds)
+        assert False, "unknown engine=%s" % engine
+
+    # Call `function(*args)` in robust mode with the tolerance for `solids`.
+    @staticmethod
+    def _robustly(solids, function, *args):
+        saved = CSG.Plane_EPSILON, CSG.Plane_ROBUST
+        CSG.Plane_EPSILON = CSG.robustEpsilon(solids)
+        CSG.Plane_ROBUST = True
+        try:
+            return function(*args)
+        finally:
+            CSG.Plane_EPSILON, CSG.Plane_ROBUST = saved
+
+    # Tolerance of robust mode for booleans on `solids`: `Plane_RELATIVE_EPSILON`
+    # times the largest coordinate of their bounds, which is what the rounding
+    # error of a plane distance grows with.
+    @staticmethod
+    def robustEpsilon(solids):
+        scale = 0.0
+        for csg in solids:
+            b = csg.bounds()
+            if b is not None:
+                scale = max(scale, abs(b.min.x), abs(b.min.y), abs(b.min.z),
+                            abs(b.max.x), abs(b.max.y), abs(b.max.z))
+        return CSG.Plane_RELATIVE_EPSILON * scale
+
+    # `op` on two solids with disjoint bounds.
+    def _disjoint(self, op, csg):
+        if op == "union":
+            return CSG(self.polygons + csg.polygons)
+        if op == "subtract":
+            return self
+        if op == "intersect":
+            return CSG([])
+        assert False, "unknown op=%s" % op
+
+    # Return a new CSG solid with the coplanar fragments left by booleans merged
+    # back into larger convex polygons (see csg_merge.py). Chained booleans on
+    # merged results work on far fewer polygons.
+    #
+    #     a.union(b).mergeCoplanar().subtract(c)
+    #
+    def mergeCoplanar(self):
+        import csg_merge
+        return CSG(csg_merge.merge_coplanar(self.polygons))
+
+    # Return a lazy expression over self solid (see csg_expr.py). Booleans on
+    # it are only recorded, then planned and run together by `evaluate()`.
+    #
+    #     a.lazy().union(b).union(c).subtract(d).evaluate()
+    #
+    def lazy(self):
+        import csg_expr
+        return csg_expr.Expr("leaf", csg=self)
+
     # Return a new CSG solid with solid and empty space switched. This solid is
     # not modified.
     def inverse(self):
-        csg = self.clone()
-        [p.flip() for p in csg.polygons]
-        return csg
+        return CSG([p.flipped() for p in self.polygons])
 
     # # class Vector
     #
@@ -135,17 +543,20 @@ class CSG:
     #
     #     new CSG.Vector(1, 2, 3)
     #     new CSG.Vector([1, 2, 3])
-    class Vector:
+    #
+    # Vectors are never modified once created, so they can be shared freely.
+    # `__slots__` keeps every instance small and the hot operations build
+    # their result directly without temporary vectors.
+    class Vector(object):
+
+        __slots__ = ("x", "y", "z")
 
         def __init__(self, x, y=None, z=None):
-            if isinstance(x, list):
-                self.x = x[0]
-                self.y = x[1]
-                self.z = x[2]
-            else:
-                self.x = x
-                self.y = y
-                self.z = z
+            if y is None:
+                x, y, z = x[0], x[1], x[2]
+            self.x = x
+            self.y = y
+            self.z = z
 
         def __str__(self):
             return "[%s, %s, %s]" % (fp3(self.x), fp3(self.y), fp3(self.z))
@@ -187,7 +598,10 @@ class CSG:
             return self.x * a.x + self.y * a.y + self.z * a.z
 
         def lerp(self, a, t):
-            return self.plus(a.minus(self).times(t))
+            x = self.x
+            y = self.y
+            z = self.z
+            return CSG.Vector(x + (a.x - x) * t, y + (a.y - y) * t, z + (a.z - z) * t)
 
         def length(self):
             return math.sqrt(self.dot(self))
@@ -217,7 +631,27 @@ class CSG:
     #Plane_EPSILON = 1e-5
     Plane_EPSILON = 1e-3
 
-    class Plane:
+    # Set while a boolean runs in robust mode: `splitPolygon()` then decides the
+    # points near +-`Plane_EPSILON` exactly, and `Plane_EPSILON` is
+    # `Plane_RELATIVE_EPSILON` times the size of the operands.
+    Plane_ROBUST = False
+    Plane_RELATIVE_EPSILON = 1e-9
+
+    # Bound of the relative rounding error of a float plane distance.
+    Plane_ROUNDING = 8 * sys.float_info.epsilon
+
+    # Number of polygons `splitPolygon()` has cut in two, in this process.
+    Plane_SPLITS = 0
+
+    class Plane(object):
+
+        __slots__ = ("normal", "w")
+
+        # Classes of a point or polygon relative to a plane.
+        COPLANAR = 0
+        FRONT = 1
+        BACK = 2
+        SPANNING = 3
 
         def __init__(self, normal, w):
             self.normal = normal
@@ -226,10 +660,25 @@ class CSG:
         def __str__(self):
             return str(self.normal) + ", w=" + fp3(self.w)
 
+        # Same as `b.minus(a).cross(c.minus(a)).unit()` and its dot with `a`,
+        # without the four temporary vectors.
         @classmethod
         def fromPoints(cls, a, b, c):
-            n = b.minus(a).cross(c.minus(a)).unit()
-            return CSG.Plane(n, n.dot(a))
+            ux = b.x - a.x
+            uy = b.y - a.y
+            uz = b.z - a.z
+            vx = c.x - a.x
+            vy = c.y - a.y
+            vz = c.z - a.z
+            nx = uy * vz - uz * vy
+            ny = uz * vx - ux * vz
+            nz = ux * vy - uy * vx
+            length = math.sqrt(nx * nx + ny * ny + nz * nz)
+            if length != 0.0:
+                nx /= length
+                ny /= length
+                nz /= length
+            return CSG.Plane(CSG.Vector(nx, ny, nz), nx * a.x + ny * a.y + nz * a.z)
 
         def clone(self):
             return CSG.Plane(self.normal.clone(), self.w)
@@ -238,37 +687,104 @@ class CSG:
             self.normal = self.normal.negated()
             self.w = -self.w
 
+        # Return a new plane facing the other way.
+        def flipped(self):
+            return CSG.Plane(self.normal.negated(), -self.w)
+
+        # Signed distance from self plane to `vertex`.
+        def distance(self, vertex):
+            n = self.normal
+            return n.x * vertex.x + n.y * vertex.y + n.z * vertex.z - self.w
+
+        # Classify a single point against self plane.
+        def classifyPoint(self, vertex):
+            t = self.distance(vertex)
+            if t < -CSG.Plane_EPSILON:
+                return CSG.Plane.BACK
+            if t > CSG.Plane_EPSILON:
+                return CSG.Plane.FRONT
+            return CSG.Plane.COPLANAR
+
+        # Classify `vertices` against self plane like `splitPolygon()`, appending
+        # their float distances to `dists`. A point is only classified with exact
+        # rationals when its float distance is within its rounding error of
+        # +-`Plane_EPSILON`. Returns the classes of the points and of the whole
+        # polygon.
+        def classifyRobust(self, vertices, dists):
+            nx = self.normal.x
+            ny = self.normal.y
+            nz = self.normal.z
+            w = self.w
+            eps = CSG.Plane_EPSILON
+            rounding = CSG.Plane_ROUNDING
+            polygonType = 0
+            types = []
+            for vertex in vertices:
+                x = nx * vertex.x
+                y = ny * vertex.y
+                z = nz * vertex.z
+                t = x + y + z - w
+                dists.append(t)
+                error = rounding * (abs(x) + abs(y) + abs(z) + abs(w))
+                if abs(t) - eps > error:
+                    typ = CSG.Plane.FRONT if t > 0.0 else CSG.Plane.BACK
+                elif eps - abs(t) > error:
+                    typ = CSG.Plane.COPLANAR
+                else:
+                    # 曖昧なときだけ有理数で厳密に判定する
+                    exact = (Fraction(nx) * Fraction(vertex.x) + Fraction(ny) * Fraction(vertex.y) +
+                             Fraction(nz) * Fraction(vertex.z) - Fraction(w))
+                    if exact > eps:
+                        typ = CSG.Plane.FRONT
+                    elif exact < -eps:
+                        typ = CSG.Plane.BACK
+                    else:
+                        typ = CSG.Plane.COPLANAR
+                polygonType |= typ
+                types.append(typ)
+            return types, polygonType
+
         # Split `polygon` by self plane if needed, then put the polygon or polygon
         # fragments in the appropriate lists. Coplanar polygons go into either
         # `coplanarFront` or `coplanarBack` depending on their orientation with
         # respect to self plane. Polygons in front or in back of self plane go into
-        # either `front` or `back`.
+        # either `front` or `back`. Returns the class of the whole polygon.
         def splitPolygon(self, polygon, coplanarFront, coplanarBack, front, back):
-            COPLANAR = 0
-            FRONT = 1
-            BACK = 2
-            SPANNING = 3
+            COPLANAR = CSG.Plane.COPLANAR
+            FRONT = CSG.Plane.FRONT
+            BACK = CSG.Plane.BACK
+            SPANNING = CSG.Plane.SPANNING
 
             # Classify each point as well as the entire polygon into one of the above
-            # four classes.
+            # four classes. The signed distances are kept to place the split points.
+            nx = self.normal.x
+            ny = self.normal.y
+            nz = self.normal.z
+            w = self.w
+            eps = CSG.Plane_EPSILON
             polygonType = 0
             types = []
-            for vertex in polygon.vertices:
-                t = self.normal.dot(vertex) - self.w
-                if t < -CSG.Plane_EPSILON:
-                    #print "BACK: t=%.3f" % t
-                    typ = BACK
-                #else:
-                    #typ = FRONT if t > CSG.Plane_EPSILON else COPLANAR
-                elif t > CSG.Plane_EPSILON:
-                    #print "FRONT: t=%.3f" % t
-                    typ = FRONT
-                else:
-                    #print "COP: t=%.3f" % t
-                    typ = COPLANAR
-
-                polygonType |= typ
-                types.append(typ)
+            dists = []
+            if CSG.Plane_ROBUST:
+                types, polygonType = self.classifyRobust(polygon.vertices, dists)
+            else:
+                for vertex in polygon.vertices:
+                    t = nx * vertex.x + ny * vertex.y + nz * vertex.z - w
+                    dists.append(t)
+                    if t < -eps:
+                        #print "BACK: t=%.3f" % t
+                        typ = BACK
+                    #else:
+                        #typ = FRONT if t > CSG.Plane_EPSILON else COPLANAR
+                    elif t > eps:
+                        #print "FRONT: t=%.3f" % t
+                        typ = FRONT
+                    else:
+                        #print "COP: t=%.3f" % t
+                        typ = COPLANAR
+
+                    polygonType |= typ
+                    types.append(typ)
 
             # Put the polygon in the correct list, splitting it when necessary.
             if polygonType == COPLANAR:
@@ -288,6 +804,7 @@ class CSG:
                 back.append(polygon)
 
             elif polygonType == SPANNING:
+                CSG.Plane_SPLITS += 1
                 f = []
                 b = []
                 for i in xrange(len(polygon.vertices)):
@@ -299,19 +816,127 @@ class CSG:
                     if ti != BACK:
                         f.append(vi)
                     if ti != FRONT:
-                        b.append(vi.clone() if not ti == BACK else vi)
+                        b.append(vi)
                     if (ti | tj) == SPANNING:
-                            t = (self.w - self.normal.dot(vi)) / self.normal.dot(vj.minus(vi))
-                            v = vi.interpolate(vj, t)
+                            di = dists[i]
+                            v = vi.interpolate(vj, di / (di - dists[j]))
                             f.append(v)
-                            b.append(v.clone())
+                            b.append(v)
 
                 if len(f) >= 3:
                     #print "  SPANNING: front"
-                    front.append(CSG.Polygon(f, polygon.shared))
+                    front.append(CSG.Polygon(f, polygon.shared, polygon.plane))
                 if len(b) >= 3:
                     #print "  SPANNING: back"
-                    back.append(CSG.Polygon(b, polygon.shared))
+                    back.append(CSG.Polygon(b, polygon.shared, polygon.plane))
+
+            return polygonType
+
+    # # class Bounds
+    #
+    # Axis-aligned bounding box between the corners `min` and `max`.
+    class Bounds(object):
+
+        __slots__ = ("min", "max")
+
+        def __init__(self, min, max):
+            self.min = min
+            self.max = max
+
+        def __str__(self):
+            return "%s - %s" % (self.min, self.max)
+
+        @classmethod
+        def fromVertices(cls, vertices):
+            xs = [v.x for v in vertices]
+            ys = [v.y for v in vertices]
+            zs = [v.z for v in vertices]
+            return CSG.Bounds(CSG.Vector(min(xs), min(ys), min(zs)),
+                              CSG.Vector(max(xs), max(ys), max(zs)))
+
+        @classmethod
+        def fromPolygons(cls, polygons):
+            return CSG.Bounds.fromBounds([p.bounds() for p in polygons])
+
+        # Box around all `boxes`.
+        @classmethod
+        def fromBounds(cls, boxes):
+            return CSG.Bounds(
+                CSG.Vector(min(b.min.x for b in boxes), min(b.min.y for b in boxes),
+                           min(b.min.z for b in boxes)),
+                CSG.Vector(max(b.max.x for b in boxes), max(b.max.y for b in boxes),
+                           max(b.max.z for b in boxes)))
+
+        # True when self box and `bounds` share any point, allowing a gap of
+        # `eps`.
+        def overlaps(self, bounds, eps=0.0):
+            return (self.min.x <= bounds.max.x + eps and bounds.min.x <= self.max.x + eps and
+                    self.min.y <= bounds.max.y + eps and bounds.min.y <= self.max.y + eps and
+                    self.min.z <= bounds.max.z + eps and bounds.min.z <= self.max.z + eps)
+
+        def intersection(self, bounds):
+            return CSG.Bounds(
+                CSG.Vector(max(self.min.x, bounds.min.x), max(self.min.y, bounds.min.y),
+                           max(self.min.z, bounds.min.z)),
+                CSG.Vector(min(self.max.x, bounds.max.x), min(self.max.y, bounds.max.y),
+                           min(self.max.z, bounds.max.z)))
+
+        def expanded(self, eps):
+            return CSG.Bounds(
+                CSG.Vector(self.min.x - eps, self.min.y - eps, self.min.z - eps),
+                CSG.Vector(self.max.x + eps, self.max.y + eps, self.max.z + eps))
+
+    # # class BVH
+    #
+    # Bounding volume hierarchy over the boxes of `polygons`: a binary tree split
+    # at the median of the longest axis, with at most `LEAF_SIZE` boxes per
+    # leaf. `touches` finds out whether a box comes near any of the polygons
+    # while visiting only a few of them.
+    class BVH(object):
+
+        LEAF_SIZE = 8
+
+        def __init__(self, polygons):
+            # [box, front, back, boxes of a leaf or None] per node, root first
+            self.nodes = []
+            if polygons:
+                self._build([p.bounds() for p in polygons])
+
+        def _build(self, boxes):
+            pending = [[boxes, None, 0]]
+            while pending:
+                boxes, parent, slot = pending.pop()
+                box = CSG.Bounds.fromBounds(boxes)
+                if parent is not None:
+                    self.nodes[parent][slot] = len(self.nodes)
+                node = [box, None, None, None]
+                self.nodes.append(node)
+                if len(boxes) <= CSG.BVH.LEAF_SIZE:
+                    node[3] = boxes
+                    continue
+
+                size = box.max.minus(box.min)
+                axis = [size.x, size.y, size.z].index(max(size.x, size.y, size.z))
+                boxes = sorted(boxes, key=lambda b: b.min[axis] + b.max[axis])
+                half = len(boxes) // 2
+                pending.append([boxes[:half], len(self.nodes) - 1, 1])
+                pending.append([boxes[half:], len(self.nodes) - 1, 2])
+
+        # True when a polygon box overlaps `box` with a gap of `eps`.
+        def touches(self, box, eps=0.0):
+            pending = [0] if self.nodes else []
+            while pending:
+                node = self.nodes[pending.pop()]
+                if not node[0].overlaps(box, eps):
+                    continue
+                if node[3] is None:
+                    pending.append(node[1])
+                    pending.append(node[2])
+                    continue
+                for b in node[3]:
+                    if b.overlaps(box, eps):
+                        return True
+            return False
 
     # # class Polygon
 
@@ -324,12 +949,23 @@ class CSG:
     # polygons that are clones of each other or were split from the same polygon.
     # This can be used to define per-polygon properties (such as surface color).
     #
-    class Polygon:
+    # Booleans never modify polygons, vertices or planes: they share them between
+    # solids, trees and fragments, and `flipped()` returns a new polygon over the
+    # same vertices. Only fragments cut by `splitPolygon` allocate new polygons,
+    # and they reuse the plane of the polygon they were cut from. Use `clone()`
+    # before modifying a polygon in place.
+    #
+    class Polygon(object):
 
-        def __init__(self, vertices, shared):
+        __slots__ = ("vertices", "shared", "plane", "_bounds")
+
+        def __init__(self, vertices, shared, plane=None):
             self.vertices = vertices
             self.shared = shared
-            self.plane = CSG.Plane.fromPoints(vertices[0], vertices[1], vertices[2])
+            if plane is None:
+                plane = CSG.Plane.fromPoints(vertices[0], vertices[1], vertices[2])
+            self.plane = plane
+            self._bounds = None
 
         def __str__(self):
             return CSG.Polygon.vertices_to_string(self.vertices)
@@ -347,10 +983,115 @@ class CSG:
             vertices = [v.clone() for v in self.vertices]
             return CSG.Polygon(vertices, self.shared)
 
+        # The `CSG.Bounds` of self polygon, computed once.
+        def bounds(self):
+            if self._bounds is None:
+                self._bounds = CSG.Bounds.fromVertices(self.vertices)
+            return self._bounds
+
+        # Average of the vertices, a point inside the (convex) polygon.
+        def center(self):
+            vertices = self.vertices
+            return CSG.Vector(sum(v.x for v in vertices) / len(vertices),
+                              sum(v.y for v in vertices) / len(vertices),
+                              sum(v.z for v in vertices) / len(vertices))
+
         def flip(self):
             self.vertices.reverse()
             #[v.flip() for v in self.vertices]
-            self.plane.flip()
+            self.plane = self.plane.flipped()
+
+        # Return a new polygon facing the other way. It shares the vertices and
+        # bounds of self polygon.
+        def flipped(self):
+            polygon = CSG.Polygon(self.vertices[::-1], self.shared, self.plane.flipped())
+            polygon._bounds = self._bounds
+            return polygon
+
+    # # class Splitter
+    #
+    # Chooses the polygon whose plane a `CSG.Node` splits its polygons with.
+    # csg.js always takes the first polygon, which is `strategy="first"` here.
+    # The other strategies help on inputs where that gives deep, skewed trees:
+    #
+    # - "cost": try `samples` candidate polygons and keep the one with the
+    #   lowest `split_weight * splits + |front - back|`, counted over up to
+    #   `probes` polygons.
+    # - "axis": like "cost", but planes whose normal is far from the x, y and z
+    #   axes are penalized by `axis_weight` per probed polygon.
+    # - "random": any polygon, drawn from a generator seeded with `seed`.
+    #
+    # Example usage:
+    #
+    #     splitter = CSG.Splitter("cost", samples=8, seed=1)
+    #     print CSG.Node(csg.polygons, splitter=splitter).stats()
+    #     csg.union(other, splitter=splitter)
+    class Splitter:
+
+        STRATEGIES = ("first", "cost", "axis", "random")
+
+        def __init__(self, strategy="first", samples=16, probes=64, split_weight=8.0,
+                     axis_weight=0.5, seed=None):
+            assert strategy in CSG.Splitter.STRATEGIES, "unknown strategy=%s" % strategy
+            self.strategy = strategy
+            self.samples = samples
+            self.probes = probes
+            self.split_weight = split_weight
+            self.axis_weight = axis_weight
+            self.random = random.Random(seed)
+
+        # What the trees built with self splitter depend on. The "first"
+        # strategy builds the same trees as no splitter at all.
+        def key(self):
+            if self.strategy == "first":
+                return None
+            return (self.strategy, self.samples, self.probes, self.split_weight, self.axis_weight)
+
+        def choose(self, polygons):
+            count = len(polygons)
+            if self.strategy == "first" or count < 3:
+                return polygons[0]
+            if self.strategy == "random":
+                return polygons[self.random.randrange(count)]
+
+            candidates = self._sample(polygons, self.samples)
+            probes = self._sample(polygons, self.probes)
+            best = None
+            best_cost = None
+            for candidate in candidates:
+                cost = self.cost(candidate.plane, probes)
+                if best_cost is None or cost < best_cost:
+                    best = candidate
+                    best_cost = cost
+            return best
+
+        def _sample(self, polygons, count):
+            if len(polygons) <= count:
+                return polygons
+            return self.random.sample(polygons, count)
+
+        # Estimated cost of splitting `polygons` by `plane`.
+        def cost(self, plane, polygons):
+            splits = 0
+            front = 0
+            back = 0
+            for p in polygons:
+                polygonType = 0
+                for v in p.vertices:
+                    polygonType |= plane.classifyPoint(v)
+                if polygonType == CSG.Plane.SPANNING:
+                    splits += 1
+                elif polygonType == CSG.Plane.FRONT:
+                    front += 1
+                elif polygonType == CSG.Plane.BACK:
+                    back += 1
+
+            cost = self.split_weight * splits + abs(front - back)
+            if self.strategy == "axis":
+                n = plane.normal
+                alignment = max(abs(n.x), abs(n.y), abs(n.z))
+                cost += self.axis_weight * (1.0 - alignment) * len(polygons)
+            return cost
 
     # # class Node
 
@@ -361,117 +1102,264 @@ class CSG:
     # no distinction between internal and leaf nodes.
     class Node:
 
-        def __init__(self, polygons=None, name="Node", level=0):
+        def __init__(self, polygons=None, name="Node", level=0, splitter=None):
             self.plane = None
             self.front = None
             self.back = None
             self.name = name
             self.level = level
+            self.splitter = splitter
+            self.splits = 0
             self.polygons = []
             if polygons:
                 self.build(polygons)
 
+        # Copy of the structure of self BSP tree. Planes and polygons are never
+        # modified in place, so the copy shares them. Like `build`, it walks the
+        # tree with a list instead of recursing so deep trees can be copied.
         def clone(self):
-            node = CSG.Node()
-            if self.plane:
-                node.plane = self.plane.clone()
-            if self.front:
-                node.front = self.front.clone()
-            if self.back:
-                node.back = self.back.clone()
-
-            node.polygons = [p.clone() for p in self.polygons]
-            node.name = self.name
-            node.level = self.level
-            return node
+            root = CSG.Node()
+            pairs = [[self, root]]
+            while pairs:
+                src, node = pairs.pop()
+                node.plane = src.plane
+                if src.front:
+                    node.front = CSG.Node()
+                    pairs.append([src.front, node.front])
+                if src.back:
+                    node.back = CSG.Node()
+                    pairs.append([src.back, node.back])
+
+                node.polygons = src.polygons[:]
+                node.name = src.name
+                node.level = src.level
+                node.splitter = src.splitter
+                node.splits = src.splits
+            return root
 
         # Convert solid space to empty space and empty space to solid space.
+        #
+        # Like `build`, every traversal of a tree below walks it with a list
+        # instead of recursing, so trees of any depth work without raising the
+        # recursion limit.
         def invert(self):
-            for p in self.polygons:
-                p.flip()
-
-            if self.plane:
-                self.plane.flip()
-            if self.front:
-                self.front.invert()
-            if self.back:
-                self.back.invert()
-
-            temp = self.front
-            self.front = self.back
-            self.back = temp
-
-        # Recursively remove all polygons in `polygons` that are inside self BSP
-        # tree.
-        def clipPolygons(self, polygons):
-            if not self.plane:
-                return polygons[:]
-
-            front = []
-            back = []
-
-            i = 0
-            for p in polygons:
-                self.plane.splitPolygon(p, front, back, front, back)
-                i += 1
-
-            if self.front:
-                front = self.front.clipPolygons(front)
-            if self.back:
-                back = self.back.clipPolygons(back)
-            else:
+            nodes = [self]
+            while nodes:
+                node = nodes.pop()
+                node.polygons = [p.flipped() for p in node.polygons]
+                if node.plane:
+                    node.plane = node.plane.flipped()
+                node.front, node.back = node.back, node.front
+                if node.front:
+                    nodes.append(node.front)
+                if node.back:
+                    nodes.append(node.back)
+
+        # Remove all polygons in `polygons` that are inside self BSP tree. The
+        # fragments reaching an empty front are collected in one list, in the
+        # order of the recursive version (front subtrees first). With
+        # `flipped`, the polygons are clipped as if they were flipped (they
+        # come back as they are).
+        def clipPolygons(self, polygons, flipped=False):
+            result = []
+            pending = [[self, polygons]]
+            while pending:
+                node, polygons = pending.pop()
+                if not node.plane:
+                    result.extend(polygons)
+                    continue
+
+                front = []
                 back = []
-
-            front.extend(back)
-            return front
+                for p in polygons:
+                    if flipped:
+                        node.plane.splitPolygon(p, back, front, front, back)
+                    else:
+                        node.plane.splitPolygon(p, front, back, front, back)
+
+                if back and node.back:
+                    pending.append([node.back, back])
+                if front:
+                    if node.front:
+                        pending.append([node.front, front])
+                    else:
+                        result.extend(front)
+            return result
+
+        # Side of `point` in self BSP tree: `CSG.Plane.BACK` inside the solid,
+        # `FRONT` outside, or `COPLANAR` when it is within `Plane_EPSILON` of a
+        # plane on the way down and cannot be told.
+        def classifyPoint(self, point):
+            eps = CSG.Plane_EPSILON
+            node = self
+            while node.plane:
+                t = node.plane.normal.dot(point) - node.plane.w
+                if t > eps:
+                    if not node.front:
+                        return CSG.Plane.FRONT
+                    node = node.front
+                elif t < -eps:
+                    if not node.back:
+                        return CSG.Plane.BACK
+                    node = node.back
+                else:
+                    return CSG.Plane.COPLANAR
+            return CSG.Plane.FRONT
 
         # Remove all polygons in self BSP tree that are inside the other BSP tree
-        # `bsp`.
-        def clipTo(self, bsp):
-            self.polygons = bsp.clipPolygons(self.polygons)
-            if self.front:
-                self.front.clipTo(bsp)
-            if self.back:
-                self.back.clipTo(bsp)
-
-        # Return a list of all polygons in self BSP tree.
+        # `bsp`. With `bounds`, only the polygons touching that box are clipped;
+        # the others are kept as they are, or dropped if `keepOutside` is False.
+        # With a `csg_parallel.Pool` as `parallel`, a large tree is clipped in
+        # the pool's worker processes instead.
+        #
+        # `bvh` is a `CSG.BVH` over the polygons `bsp` was built from (those
+        # touching `bounds` are enough). A polygon touching none of them cannot
+        # cross the surface of that solid, so it is inside or outside as a
+        # whole. Such polygons are grouped by shared vertices, every group is
+        # classified by one point (`classifyPoint`), and only the others go
+        # through `clipPolygons`.
+        def clipTo(self, bsp, bounds=None, keepOutside=True, parallel=None, bvh=None):
+            nodes = self._nodes()
+            lists = [node.polygons for node in nodes]
+            CSG.Node._clipLists(lists, bsp, bounds, keepOutside, parallel, bvh)
+            for node, polygons in zip(nodes, lists):
+                node.polygons = polygons
+
+        # The nodes of self tree, breadth first.
+        def _nodes(self):
+            nodes = [self]
+            i = 0
+            while i < len(nodes):
+                if nodes[i].front:
+                    nodes.append(nodes[i].front)
+                if nodes[i].back:
+                    nodes.append(nodes[i].back)
+                i += 1
+            return nodes
+
+        # `clipTo` on the polygon lists of the nodes of a tree, replaced in
+        # `lists`. Shared by `CSG.Node` and `CSG.FlatTree`; `flipped` is passed
+        # on to `clipPolygons`.
+        @staticmethod
+        def _clipLists(lists, bsp, bounds, keepOutside, parallel, bvh, flipped=False):
+            if parallel:
+                import csg_parallel
+                if csg_parallel.clip_lists(lists, bsp, parallel, bounds, keepOutside, bvh, flipped):
+                    return
+            eps = CSG.Plane_EPSILON
+            far = []
+            for k, polygons in enumerate(lists):
+                near = []
+                outside = []
+                for p in polygons:
+                    if bounds and not bounds.overlaps(p.bounds()):
+                        if keepOutside:
+                            outside.append(p)
+                    elif bvh is not None and not bvh.touches(p.bounds(), eps):
+                        far.append([k, p])
+                    else:
+                        near.append(p)
+                lists[k] = bsp.clipPolygons(near, flipped) + outside
+            CSG.Node._keepFar(bsp, far, lists, flipped)
+
+        # Hand the [k, polygon] pairs in `far`, whose polygons touch nothing of
+        # the surface of `bsp`, back to `lists[k]` unless they are inside.
+        @staticmethod
+        def _keepFar(bsp, far, lists, flipped=False):
+            for group in CSG.Node._connected(far):
+                side = CSG.Plane.COPLANAR
+                for k, p in group[:4]:
+                    side = bsp.classifyPoint(p.center())
+                    if not side == CSG.Plane.COPLANAR:
+                        break
+                for k, p in group:
+                    if side == CSG.Plane.FRONT:
+                        lists[k].append(p)
+                    elif side == CSG.Plane.COPLANAR:
+                        lists[k].extend(bsp.clipPolygons([p], flipped))
+
+        # Groups of the [k, polygon] pairs in `pairs` whose polygons are
+        # connected through shared vertex positions.
+        @staticmethod
+        def _connected(pairs):
+            parents = range(len(pairs))
+
+            def find(i):
+                while not parents[i] == i:
+                    parents[i] = parents[parents[i]]
+                    i = parents[i]
+                return i
+
+            first = {}
+            for i, pair in enumerate(pairs):
+                for v in pair[1].vertices:
+                    j = first.setdefault((v.x, v.y, v.z), i)
+                    if not j == i:
+                        parents[find(i)] = find(j)
+
+            groups = {}
+            for i, pair in enumerate(pairs):
+                groups.setdefault(find(i), []).append(pair)
+            return groups.values()
+
+        # Return a list of all polygons in self BSP tree, node by node from the
+        # root, front subtrees first.
         def allPolygons(self):
-            polygons = self.polygons[:]
-            if self.front:
-                polygons.extend(self.front.allPolygons())
-            if self.back:
-                polygons.extend(self.back.allPolygons())
+            polygons = []
+            nodes = [self]
+            while nodes:
+                node = nodes.pop()
+                polygons.extend(node.polygons)
+                if node.back:
+                    nodes.append(node.back)
+                if node.front:
+                    nodes.append(node.front)
             return polygons
 
         # Build a BSP tree out of `polygons`. When called on an existing tree, the
         # new polygons are filtered down to the bottom of the tree and become new
-        # nodes there. Each set of polygons is partitioned using the first polygon
-        # (no heuristic is used to pick a good split).
+        # nodes there. Each set of polygons is partitioned using the polygon
+        # picked by `self.splitter` (the first one when no splitter is set).
+        #
+        # Polygons lying on the plane of a node by construction (the one it was
+        # picked from and its fragments) stay in that node without being
+        # classified. A vertex of a slightly non-planar polygon can be off its
+        # own plane, and the polygon would otherwise go to the same side, pick
+        # the same plane and never end.
         def _build(self, polygons):
             if len(polygons) < 1:
                 return
 
             if not self.plane:
-                self.plane = polygons[0].plane.clone()
+                self.plane = self.choosePlane(polygons)
 
             front = []
             back = []
 
             for p in polygons:
-                self.plane.splitPolygon(p, self.polygons, self.polygons, front, back)
+                if p.plane is self.plane:
+                    self.polygons.append(p)
+                elif self.plane.splitPolygon(p, self.polygons, self.polygons, front, back) == CSG.Plane.SPANNING:
+                    self.splits += 1
 
             if len(front) > 0:
                 if not self.front:
-                    self.front = CSG.Node()
-                    self.front.level = self.level + 1
+                    self.front = self.createChild()
                 self.front.build(front)
 
             if len(back) > 0:
                 if not self.back:
-                    self.back = CSG.Node()
-                    self.back.level = self.level + 1
+                    self.back = self.createChild()
                 self.back.build(back)
 
+        def choosePlane(self, polygons):
+            if self.splitter:
+                return self.splitter.choose(polygons).plane
+            return polygons[0].plane
+
+        def createChild(self):
+            return CSG.Node(level=self.level + 1, splitter=self.splitter)
+
         # 上の build だと `RuntimeError: maximum recursion depth exceeded` が起こる
         #
         def build(self, polygons):
@@ -500,44 +1388,63 @@ class CSG:
                 return None
 
             if not self.plane:
-                self.plane = polygons[0].plane.clone()
+                self.plane = self.choosePlane(polygons)
 
             front = []
             back = []
 
             for p in polygons:
-                self.plane.splitPolygon(p, self.polygons, self.polygons, front, back)
+                if p.plane is self.plane:
+                    self.polygons.append(p)
+                elif self.plane.splitPolygon(p, self.polygons, self.polygons, front, back) == CSG.Plane.SPANNING:
+                    self.splits += 1
                 #print "split: f=%d, b=%d" % (len(front), len(back))
 
             next_csgs = []
             if len(front) > 0:
                 if not self.front:
-                    self.front = CSG.Node()
-                    self.front.level = self.level + 1
+                    self.front = self.createChild()
                 #print "buid: front: %d" % len(front)
                 next_csgs.append([self.front, front])
 
             if len(back) > 0:
                 if not self.back:
-                    self.back = CSG.Node()
-                    self.back.level = self.level + 1
+                    self.back = self.createChild()
                 #print "buid: back : %d" % len(back)
                 next_csgs.append([self.back, back])
 
             return next_csgs if len(next_csgs) > 0 else None
 
+        # Shape of self BSP tree: `depth` (levels), `nodes`, `polygons` held by the
+        # nodes (fragments included) and `splits`, the number of polygons that
+        # were cut in two while building it.
+        def stats(self):
+            stats = {"depth": 0, "nodes": 0, "polygons": 0, "splits": 0}
+            nodes = [self]
+            while nodes:
+                node = nodes.pop()
+                stats["depth"] = max(stats["depth"], node.level - self.level + 1)
+                stats["nodes"] += 1
+                stats["polygons"] += len(node.polygons)
+                stats["splits"] += node.splits
+                if node.front:
+                    nodes.append(node.front)
+                if node.back:
+                    nodes.append(node.back)
+            return stats
+
         def p(self, label=""):
             text = ""
-            for i in xrange(self.level):
-                text += "  "
-            text += "%s: %d" % (label, len(self.polygons))
-
-            if self.front:
-                text += self.front.p(label + "f")
-
-            if self.back:
-                text += self.back.p(label + "b")
-
+            nodes = [[self, label]]
+            while nodes:
+                node, label = nodes.pop()
+                for i in xrange(node.level):
+                    text += "  "
+                text += "%s: %d" % (label, len(node.polygons))
+                if node.back:
+                    nodes.append([node.back, label + "b"])
+                if node.front:
+                    nodes.append([node.front, label + "f"])
             return text
 
         def __str__(self):
@@ -545,3 +1452,319 @@ class CSG:
             text += "\n  %s" % (self.front)
             text += "\n  %s" % (self.back)
             return text
+
+    # # class FlatTree
+    #
+    # A BSP tree kept in flat arrays instead of linked `CSG.Node` objects, the
+    # form booleans clone and clip. Node `k` has the plane `planes[k]` (a
+    # shared `CSG.Plane`, None only for the root of an empty tree), the
+    # children `fronts[k]` and `backs[k]` (-1 when missing), `splits[k]`, and
+    # the polygons `polygons[offsets[k]:offsets[k + 1]]`, all nodes' polygons
+    # in one list. The root is node 0 and every child comes after its parent.
+    #
+    # A clone copies five arrays and two lists instead of allocating an object,
+    # its `__dict__` and a polygon list per node: about 40 bytes per node
+    # instead of more than a kilobyte. `toNode` gives back the `CSG.Node` form,
+    # which is still the one polygons are built into.
+    #
+    # `invert` only flips the `inverted` flag: the arrays always hold the tree
+    # as it was built, and clipping reads every plane and polygon of an
+    # inverted tree as flipped. Negating a plane negates every distance to it
+    # exactly, so this classifies and splits like flipping the tree does.
+    # Polygons are flipped once, when they leave the tree (`allPolygons`,
+    # `toNode`).
+    class FlatTree(object):
+
+        __slots__ = ("planes", "fronts", "backs", "splits", "offsets", "polygons", "splitter",
+                     "inverted")
+
+        def __init__(self):
+            self.planes = []
+            self.fronts = array("i")
+            self.backs = array("i")
+            self.splits = array("i")
+            self.offsets = array("i", [0])
+            self.polygons = []
+            self.splitter = None
+            self.inverted = False
+
+        # Flat copy of the tree `node`, numbered from the root, front subtrees
+        # first.
+        @classmethod
+        def fromNode(cls, node):
+            tree = cls()
+            tree.splitter = node.splitter
+            nodes = []
+            pending = [node]
+            while pending:
+                n = pending.pop()
+                nodes.append(n)
+                if n.back:
+                    pending.append(n.back)
+                if n.front:
+                    pending.append(n.front)
+            numbers = dict((id(n), k) for k, n in enumerate(nodes))
+            for n in nodes:
+                tree.planes.append(n.plane)
+                tree.fronts.append(numbers[id(n.front)] if n.front else -1)
+                tree.backs.append(numbers[id(n.back)] if n.back else -1)
+                tree.splits.append(n.splits)
+                tree.polygons.extend(n.polygons)
+                tree.offsets.append(len(tree.polygons))
+            return tree
+
+        # Self tree as linked `CSG.Node`s, sharing planes and polygons unless
+        # they have to be flipped.
+        def toNode(self):
+            nodes = [CSG.Node(splitter=self.splitter) for k in xrange(len(self.planes))]
+            planes = self.planes
+            polygons = self.polygons
+            fronts = self.fronts
+            backs = self.backs
+            if self.inverted:
+                planes = [plane.flipped() if plane else None for plane in planes]
+                polygons = [p.flipped() for p in polygons]
+                fronts, backs = backs, fronts
+            offsets = self.offsets
+            for k, node in enumerate(nodes):
+                node.plane = planes[k]
+                node.splits = self.splits[k]
+                node.polygons = polygons[offsets[k]:offsets[k + 1]]
+                if fronts[k] >= 0:
+                    node.front = nodes[fronts[k]]
+                    node.front.level = node.level + 1
+                if backs[k] >= 0:
+                    node.back = nodes[backs[k]]
+                    node.back.level = node.level + 1
+            return nodes[0]
+
+        def clone(self):
+            tree = CSG.FlatTree()
+            tree.planes = self.planes[:]
+            tree.fronts = array("i", self.fronts)
+            tree.backs = array("i", self.backs)
+            tree.splits = array("i", self.splits)
+            tree.offsets = array("i", self.offsets)
+            tree.polygons = self.polygons[:]
+            tree.splitter = self.splitter
+            tree.inverted = self.inverted
+            return tree
+
+        def invert(self):
+            self.inverted = not self.inverted
+
+        # Same as `CSG.Node.clipPolygons`. With `inverted` set, a plane's
+        # front side is the back side of its stored form, so the lists that
+        # `splitPolygon` fills and the children they go down are swapped.
+        # Coplanar polygons are swapped once more when they are `flipped`.
+        def clipPolygons(self, polygons, flipped=False):
+            planes = self.planes
+            fronts = self.fronts
+            backs = self.backs
+            inverted = self.inverted
+            if inverted:
+                fronts, backs = backs, fronts
+            result = []
+            pending = [[0, polygons]]
+            while pending:
+                k, polygons = pending.pop()
+                plane = planes[k]
+                if not plane:
+                    result.extend(polygons)
+                    continue
+
+                front = []
+                back = []
+                sides = [back, front] if inverted else [front, back]
+                coplanar = sides[::-1] if flipped else sides
+                for p in polygons:
+                    plane.splitPolygon(p, coplanar[0], coplanar[1], sides[0], sides[1])
+
+                if back and backs[k] >= 0:
+                    pending.append([backs[k], back])
+                if front:
+                    if fronts[k] >= 0:
+                        pending.append([fronts[k], front])
+                    else:
+                        result.extend(front)
+            return result
+
+        # Same as `CSG.Node.classifyPoint`.
+        def classifyPoint(self, point):
+            eps = CSG.Plane_EPSILON
+            fronts = self.fronts
+            backs = self.backs
+            sign = 1.0
+            if self.inverted:
+                fronts, backs = backs, fronts
+                sign = -1.0
+            k = 0
+            while self.planes[k]:
+                plane = self.planes[k]
+                t = sign * (plane.normal.dot(point) - plane.w)
+                if t > eps:
+                    if fronts[k] < 0:
+                        return CSG.Plane.FRONT
+                    k = fronts[k]
+                elif t < -eps:
+                    if backs[k] < 0:
+                        return CSG.Plane.BACK
+                    k = backs[k]
+                else:
+                    return CSG.Plane.COPLANAR
+            return CSG.Plane.FRONT
+
+        # Same as `CSG.Node.clipTo`. The polygons stay as stored and are
+        # clipped as flipped when self tree is inverted.
+        def clipTo(self, bsp, bounds=None, keepOutside=True, parallel=None, bvh=None):
+            offsets = self.offsets
+            lists = [self.polygons[offsets[k]:offsets[k + 1]] for k in xrange(len(self.planes))]
+            CSG.Node._clipLists(lists, bsp, bounds, keepOutside, parallel, bvh, self.inverted)
+            polygons = []
+            offsets = array("i", [0])
+            for l in lists:
+                polygons.extend(l)
+                offsets.append(len(polygons))
+            self.polygons = polygons
+            self.offsets = offsets
+
+        # Same as `CSG.Node.allPolygons`.
+        def allPolygons(self):
+            polygons = []
+            offsets = self.offsets
+            fronts = self.fronts
+            backs = self.backs
+            if self.inverted:
+                fronts, backs = backs, fronts
+            pending = [0]
+            while pending:
+                k = pending.pop()
+                polygons.extend(self.polygons[offsets[k]:offsets[k + 1]])
+                if backs[k] >= 0:
+                    pending.append(backs[k])
+                if fronts[k] >= 0:
+                    pending.append(fronts[k])
+            if self.inverted:
+                return [p.flipped() for p in polygons]
+            return polygons
+
+        # Same as `CSG.Node.stats`.
+        def stats(self):
+            levels = array("i", [1]) * len(self.planes)
+            for k in xrange(len(self.planes)):
+                for child in (self.fronts[k], self.backs[k]):
+                    if child >= 0:
+                        levels[child] = levels[k] + 1
+            return {"depth": max(levels), "nodes": len(self.planes),
+                    "polygons": len(self.polygons), "splits": sum(self.splits)}
+
+    # # class Profile
+    #
+    # Records the phases of booleans: building, flattening and cloning the BSP
+    # trees, `clipTo`, `invert`, `allPolygons` and the final `build`, plus one
+    # "operate" record for the whole boolean. Every record holds:
+    #
+    # - `id`, `op`, `engine`: the boolean it belongs to, numbered from 1
+    # - `phase`, `tree`: what ran, and on which tree ("a", "b", ...)
+    # - `time`: wall time in seconds
+    # - `polygons_in`, `polygons_out`: polygons held by the tree before and
+    #   after the phase (or taken and returned by it)
+    # - `splits`: polygons cut in two during the phase
+    # - `depth`, `nodes`: shape of the tree after the phase
+    #
+    # Pass one as `profile` to `union`, `subtract`, `intersect` or
+    # `subtract_many`, or set `CSG.PROFILE` to record every boolean. Without
+    # either, a disabled profile stands in and a phase only costs a small
+    # object. Splits made in the worker processes of `parallel` are not
+    # counted.
+    #
+    # Example usage:
+    #
+    #     profile = CSG.Profile()
+    #     a.union(b, profile=profile).subtract(c, profile=profile)
+    #     print profile.summary()
+    #     profile.write("profile.jsonl")
+    class Profile(object):
+
+        def __init__(self, enabled=True):
+            self.enabled = enabled
+            self.records = []
+            self.count = 0
+            self.op = None
+            self.engine = None
+
+        # Start recording the boolean `op` run by `engine`.
+        def begin(self, op, engine):
+            self.count += 1
+            self.op = op
+            self.engine = engine
+
+        # Context of one phase on the tree `node`. When the phase does not
+        # work on a tree, `polygons` is the number of polygons it takes; either
+        # can also be set on the returned object inside the block, as can
+        # `polygons_out`. Only counts are passed in, so that a disabled profile
+        # never builds a list.
+        def phase(self, name, tree, node=None, polygons=None):
+            return CSG.Profile.Phase(self, name, tree, node, polygons)
+
+        def record(self, phase, elapsed):
+            record = {"id": self.count, "op": self.op, "engine": self.engine,
+                      "phase": phase.name, "tree": phase.tree, "time": elapsed,
+                      "polygons_in": phase.polygons_in, "polygons_out": phase.polygons_out,
+                      "splits": CSG.Plane_SPLITS - phase.splits}
+            if phase.node is not None:
+                stats = phase.node.stats()
+                record["depth"] = stats["depth"]
+                record["nodes"] = stats["nodes"]
+                if phase.polygons_out is None:
+                    record["polygons_out"] = stats["polygons"]
+            self.records.append(record)
+
+        # Time, splits and number of records per phase, as text.
+        def summary(self):
+            phases = {}
+            for r in self.records:
+                total = phases.setdefault(r["phase"], [0, 0.0, 0])
+                total[0] += 1
+                total[1] += r["time"]
+                total[2] += r["splits"]
+            text = "%-12s %6s %10s %8s\n" % ("phase", "count", "time", "splits")
+            for name in sorted(phases, key=lambda name: -phases[name][1]):
+                count, elapsed, splits = phases[name]
+                text += "%-12s %6d %10.4f %8d\n" % (name, count, elapsed, splits)
+            return text
+
+        def toJSON(self):
+            return json.dumps(self.records, sort_keys=True)
+
+        # Write the records to `filename`, one JSON object per line.
+        def write(self, filename):
+            with open(filename, "w") as io:
+                for r in self.records:
+                    io.write(json.dumps(r, sort_keys=True) + "\n")
+
+        class Phase(object):
+
+            def __init__(self, profile, name, tree, node, polygons):
+                self.profile = profile
+                self.name = name
+                self.tree = tree
+                self.node = node
+                self.polygons = polygons
+                self.polygons_out = None
+
+            def __enter__(self):
+                if self.profile.enabled:
+                    if self.polygons is not None:
+                        self.polygons_in = self.polygons
+                    elif self.node is not None:
+                        self.polygons_in = self.node.stats()["polygons"]
+                    else:
+                        self.polygons_in = None
+                    self.splits = CSG.Plane_SPLITS
+                    self.start = time.time()
+                return self
+
+            def __exit__(self, type, value, traceback):
+                if self.profile.enabled and type is None:
+                    self.profile.record(self, time.time() - self.start)
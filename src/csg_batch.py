@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# 多数の (A, op, B) ジョブをまとめて実行する
+#
+# A manifest lists one job per line:
+#
+#     # a        op        b        output
+#     a.ply      union     b.ply    out/union.ply
+#     a.ply      subtract  b.ply    out/subtract.ply
+#
+# Relative paths are relative to the manifest. Blank lines and lines starting
+# with "#" are skipped.
+#
+# Jobs run in a process pool. Every worker keeps the last `CACHE_SIZE` operand
+# meshes it has read, along with their BSP trees, and the jobs are sorted by
+# operand so that jobs sharing meshes tend to land in the same worker. Workers
+# are replaced after `MAX_TASKS` jobs so a long batch does not grow without
+# bound. One JSON line of statistics is written per job.
+#
+# With `-c directory`, results are cached there (csg_cache.py) and jobs on
+# the same operands in later batches are not computed again.
+#
+#     python src/csg_batch.py jobs.txt [-p processes] [-s stats.jsonl] [-c cache]
+#
+
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+import ply_reader
+import ply_writer
+import csg_builder
+import csg_cache
+from csg import CSG
+
+OPERATIONS = ("union", "subtract", "intersect")
+
+# Operand meshes kept per worker process.
+CACHE_SIZE = 8
+
+# Jobs run by a worker process before it is replaced.
+MAX_TASKS = 200
+
+Job = collections.namedtuple("Job", ["index", "a", "op", "b", "output"])
+
+
+def read_manifest(path):
+    base = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    with open(path) as io:
+        for number, line in enumerate(io, 1):
+            items = line.split()
+            if not items or items[0].startswith("#"):
+                continue
+            if not len(items) == 4:
+                assert False, "expected 'a op b output': %s:%d" % (path, number)
+            a, op, b, output = items
+            if op not in OPERATIONS:
+                assert False, "unknown op=%s: %s:%d" % (op, path, number)
+            jobs.append(Job(len(jobs), os.path.join(base, a), op,
+                            os.path.join(base, b), os.path.join(base, output)))
+    return jobs
+
+
+_meshes = collections.OrderedDict()
+
+
+# Read the PLY file `path` as a CSG solid, or take it from the cache of this
+# process. Returns the solid and whether it was cached.
+def _load(path):
+    csg = _meshes.pop(path, None)
+    cached = csg is not None
+    if not cached:
+        csg = csg_builder.csg_from_solid(ply_reader.read(path))
+    _meshes[path] = csg
+    while len(_meshes) > CACHE_SIZE:
+        _meshes.popitem(last=False)
+    return csg, cached
+
+
+def run_job(job, engine=None, face_color=None):
+    stats = {"index": job.index, "a": job.a, "op": job.op, "b": job.b,
+             "output": job.output, "pid": os.getpid()}
+    try:
+        t = time.time()
+        csg_a, stats["a_cached"] = _load(job.a)
+        csg_b, stats["b_cached"] = _load(job.b)
+        stats["read"] = time.time() - t
+        stats["a_polygons"] = len(csg_a.polygons)
+        stats["b_polygons"] = len(csg_b.polygons)
+
+        t = time.time()
+        csg = getattr(csg_a, job.op)(csg_b, engine=engine)
+        stats["operate"] = time.time() - t
+        stats["polygons"] = len(csg.polygons)
+
+        t = time.time()
+        solid = csg_builder.csg_to_solid(csg, as_tri=True)
+        directory = os.path.dirname(job.output)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        writer = ply_writer.PLYWriter(job.output)
+        writer.face_color = face_color
+        writer.write_solid(solid)
+        writer.close()
+        stats["write"] = time.time() - t
+        stats["faces"] = len(solid.faces)
+    except Exception:
+        stats["error"] = traceback.format_exc()
+    return stats
+
+
+def _run_job(args):
+    return run_job(*args)
+
+
+# Run `jobs` on `processes` worker processes (in this process when 1) and
+# yield the statistics of every job as it finishes.
+def run(jobs, processes=None, engine=None, face_color=None):
+    # Keep jobs sharing operands next to each other, so that a chunk of jobs
+    # handed to one worker reads every mesh once.
+    ordered = sorted(jobs, key=lambda job: (job.a, job.b, job.index))
+    tasks = [(job, engine, face_color) for job in ordered]
+
+    if processes == 1:
+        for task in tasks:
+            yield _run_job(task)
+        return
+
+    processes = processes or multiprocessing.cpu_count()
+    chunksize = max(1, min(16, len(tasks) // (processes * 4)))
+    pool = multiprocessing.Pool(processes, maxtasksperchild=MAX_TASKS)
+    try:
+        for stats in pool.imap_unordered(_run_job, tasks, chunksize):
+            yield stats
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="run CSG jobs listed in a manifest")
+    parser.add_argument("manifest")
+    parser.add_argument("-p", "--processes", type=int, default=None)
+    parser.add_argument("-s", "--stats", default=None, help="JSON lines of per-job statistics")
+    parser.add_argument("-e", "--engine", default=None, choices=("python", "numpy"))
+    parser.add_argument("-c", "--cache", default=None, help="directory of cached results")
+    args = parser.parse_args(argv)
+
+    if args.cache:
+        # Worker processes inherit it; they share the files, not the memory.
+        CSG.CACHE = csg_cache.Cache(args.cache)
+
+    jobs = read_manifest(args.manifest)
+    out = open(args.stats, "w") if args.stats else None
+    failed = 0
+    t = time.time()
+    for stats in run(jobs, args.processes, args.engine, [255, 255, 0]):
+        if "error" in stats:
+            failed += 1
+            print "job %d failed: %s" % (stats["index"], stats["error"].rstrip().split("\n")[-1])
+        else:
+            print "job %d: %s %s %s -> %d polygons (%.2fs)" % (
+                stats["index"], os.path.basename(stats["a"]), stats["op"],
+                os.path.basename(stats["b"]), stats["polygons"], stats["operate"])
+        if out:
+            out.write(json.dumps(stats, sort_keys=True) + "\n")
+            out.flush()
+    if out:
+        out.close()
+    print "%d jobs, %d failed, %.2fs" % (len(jobs), failed, time.time() - t)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
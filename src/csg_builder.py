@@ -1,52 +1,169 @@
 # coding: utf-8
 
 import math
+import ply_reader
 from solid import Solid
 from csg import CSG
 
-def _create_tri_polygon(solid, i0, i1, i2):
-    # CSG.js (WebGL) では時計回りが表
-    p0 = solid.vertices[i0]
-    p1 = solid.vertices[i1]
-    p2 = solid.vertices[i2]
-    vertices = []
-    vertices.append(CSG.Vector(p0))
-    vertices.append(CSG.Vector(p1))
-    vertices.append(CSG.Vector(p2))
-    return CSG.Polygon(vertices, False)
-
-def _create_tri_polygons(solid, face, color, polygons):
-    i0 = face.indices[0]
-    for i in xrange(2, len(face.indices) - 1):
-        polygon = _create_tri_polygon(solid, i0, face.indices[i - 1], face.indices[i])
-        polygon.shared = color
-        polygons.append(polygon)
-
-def _create_polygons(solid, face, color, polygons):
-    vertices = []
-    for i in face.indices[:-1]:
-        v = solid.vertices[i]
-        vertices.append(CSG.Vector(v))
-
-    polygon = CSG.Polygon(vertices, False)
-    polygon.shared = color
-    polygons.append(polygon)
-
-def csg_from_solid(solid, as_tri=True):
-    as_tri=True # 三角パッチじゃないと、CSG.Node.build で無限ループになってしまう。
-    polygons = []
-    for f in solid.faces:
-        indices = f.indices
-        # face は最後が閉じていることに注意
-        color = map(lambda c: c / 255.0, f.color) if f.color else None
-        if as_tri:
-            _create_tri_polygons(solid, f, color, polygons)
-        else:
-            _create_polygons(solid, f, color, polygons)
+# Faces whose vertices are farther than this from their plane, relative to
+# their longest edge, are not planar.
+PLANAR_TOLERANCE = 1e-6
+
+# Faces whose doubled area is below this, relative to their longest edge
+# squared, are degenerate.
+DEGENERATE_TOLERANCE = 1e-12
+
+# Plane of the loop `corners` (Newell's method, relative to the first corner),
+# the longest edge squared and the largest distance of a corner from the
+# plane. The plane is None when the loop has no area.
+def _plane(corners):
+    o = corners[0]
+    nx = ny = nz = 0.0
+    size2 = 0.0
+    n = len(corners)
+    for i in xrange(n):
+        a = corners[i - 1]
+        b = corners[i]
+        ax = a.x - o.x
+        ay = a.y - o.y
+        az = a.z - o.z
+        bx = b.x - o.x
+        by = b.y - o.y
+        bz = b.z - o.z
+        nx += (ay - by) * (az + bz)
+        ny += (az - bz) * (ax + bx)
+        nz += (ax - bx) * (ay + by)
+        size2 = max(size2, (ax - bx) ** 2 + (ay - by) ** 2 + (az - bz) ** 2)
+    length = math.sqrt(nx * nx + ny * ny + nz * nz)
+    if length <= DEGENERATE_TOLERANCE * size2 or length == 0.0:
+        return None, size2, 0.0
+    normal = CSG.Vector(nx / length, ny / length, nz / length)
+    plane = CSG.Plane(normal, normal.dot(o))
+    deviation = max(abs(plane.distance(v)) for v in corners)
+    return plane, size2, deviation
+
+def _same(a, b):
+    return a is b or (a.x == b.x and a.y == b.y and a.z == b.z)
+
+# Append the triangle a, b, c unless it is degenerate.
+def _append_triangle(a, b, c, color, polygons):
+    ux = b.x - a.x
+    uy = b.y - a.y
+    uz = b.z - a.z
+    vx = c.x - a.x
+    vy = c.y - a.y
+    vz = c.z - a.z
+    nx = uy * vz - uz * vy
+    ny = uz * vx - ux * vz
+    nz = ux * vy - uy * vx
+    length = math.sqrt(nx * nx + ny * ny + nz * nz)
+    size2 = max(ux * ux + uy * uy + uz * uz, vx * vx + vy * vy + vz * vz)
+    if length <= DEGENERATE_TOLERANCE * size2 or length == 0.0:
+        return
+    nx /= length
+    ny /= length
+    nz /= length
+    plane = CSG.Plane(CSG.Vector(nx, ny, nz), nx * a.x + ny * a.y + nz * a.z)
+    polygons.append(CSG.Polygon([a, b, c], color, plane))
+
+def _convex(corners, normal, size2):
+    n = len(corners)
+    for i in xrange(n):
+        a = corners[i - 2]
+        b = corners[i - 1]
+        c = corners[i]
+        turn = b.minus(a).cross(c.minus(b)).dot(normal)
+        if turn < -DEGENERATE_TOLERANCE * size2:
+            return False
+    return True
+
+# Append the polygons of the face with the corner vectors `corners` to
+# `polygons`. A planar convex face becomes one polygon, anything else a fan
+# of triangles (all of them with `as_tri`). Degenerate triangles are
+# dropped: their plane has no normal and would swallow every polygon of
+# the BSP node that picked it.
+def _append_face(corners, color, polygons, as_tri):
+    if len(corners) == 3:
+        _append_triangle(corners[0], corners[1], corners[2], color, polygons)
+        return
+
+    # 重複した頂点を除く
+    loop = []
+    for v in corners:
+        if not loop or not _same(v, loop[-1]):
+            loop.append(v)
+    while len(loop) > 1 and _same(loop[0], loop[-1]):
+        loop.pop()
+    if len(loop) < 3:
+        return
 
+    if len(loop) > 3 and not as_tri:
+        plane, size2, deviation = _plane(loop)
+        if plane is not None and deviation <= PLANAR_TOLERANCE * math.sqrt(size2) and _convex(loop, plane.normal, size2):
+            polygons.append(CSG.Polygon(loop, color, plane))
+            return
+
+    v0 = loop[0]
+    for i in xrange(2, len(loop)):
+        _append_triangle(v0, loop[i - 1], loop[i], color, polygons)
+
+# Solid.FaceArray / Solid.FaceView (ply_reader) から直接作る
+#
+# One CSG.Vector is made per vertex, when first used, and shared by every
+# polygon using it (polygons never change their vertices); `vectors` caches
+# them across calls. `loops` are (indices, color) pairs as given by
+# FaceArray.loops() or ply_reader.read_chunks, so no Solid.Face is built.
+def _create_polygons_from_loops(vertices, vectors, loops, polygons, as_tri=False):
+    for loop, color in loops:
+        color = map(lambda c: c / 255.0, color) if color else None
+        corners = []
+        for i in loop:
+            v = vectors[i]
+            if v is None:
+                v = vectors[i] = CSG.Vector(vertices[i])
+            corners.append(v)
+        _append_face(corners, color, polygons, as_tri)
+
+# Polygons of the faces in `chunks` (lists of (indices, color), see
+# ply_reader.read_chunks), one list per chunk.
+def iter_polygons(vertices, chunks, as_tri=False):
+    vectors = [None] * len(vertices)
+    for loops in chunks:
+        polygons = []
+        _create_polygons_from_loops(vertices, vectors, loops, polygons, as_tri)
+        yield polygons
+
+# PLY ファイルから少しずつ CSG を作る
+#
+# Faces stream out of the file a chunk at a time, become polygons and go
+# straight into the BSP tree of the new solid (split by `splitter`), so the
+# faces of the file and a second full list of polygons are never held at the
+# same time as the tree.
+def csg_from_ply(filename, splitter=None, chunk=ply_reader.CHUNK, as_tri=False):
+    vertices, chunks = ply_reader.read_chunks(filename, chunk)
+    node = CSG.Node(splitter=splitter)
+    for polygons in iter_polygons(vertices, chunks, as_tri):
+        node.build(polygons)
+    return CSG.fromTree(node)
+
+# Planar convex faces become one polygon each; the other faces, or all of
+# them with `as_tri`, are cut into triangles.
+def csg_from_solid(solid, as_tri=False):
+    faces = solid.faces
+    if isinstance(faces, (Solid.FaceArray, Solid.FaceView)):
+        loops = faces.loops()
+    else:
+        # face は最後が閉じていることに注意
+        loops = ((f.indices[:-1], f.color) for f in faces)
+    polygons = []
+    vectors = [None] * len(solid.vertices)
+    _create_polygons_from_loops(solid.vertices, vectors, loops, polygons, as_tri)
     return CSG(polygons)
 
-def csg_to_solid(csg, as_tri=False):
+# `weld` merges the duplicated vertices of neighbouring polygons (see
+# Solid.weld): True for Solid.WELD_TOLERANCE, a tolerance, or False to give
+# every polygon its own vertices.
+def csg_to_solid(csg, as_tri=False, weld=True):
     solid = Solid()
     for p in csg.polygons:
         indices = []
@@ -55,4 +172,7 @@ def csg_to_solid(csg, as_tri=False):
             indices.append(i)
 
         solid.append_polygon(indices, as_tri=as_tri)
+
+    if weld is not False:
+        solid.weld(None if weld is True else weld)
     return solid
@@ -0,0 +1,198 @@
+# coding: utf-8
+#
+# ブーリアン演算の結果をキャッシュする
+#
+# A result is keyed by a SHA-1 of the operation, the engine, the tolerance
+# (`CSG.Plane_EPSILON` and robust mode) and the digests of both operands. The
+# digest of a solid covers the coordinates, planes and `shared` values of its
+# polygons in order, so solids read again from the same files hit the cache
+# across runs.
+#
+# Results are kept in two tiers: the last `memory_size` results in memory,
+# and, when a `directory` is given, files there up to `disk_size` bytes in
+# total, dropping the least recently used ones first. Files are written by
+# csg_file.py, which reads them back without running code from them, so the
+# directory can be shared. Results whose `shared` values csg_file cannot
+# write are only kept in memory. Booleans with a splitter that draws random
+# samples are not cached.
+#
+#     CSG.CACHE = csg_cache.Cache("/var/cache/csg")
+#     a.union(b)       # computed
+#     a.union(b)       # from memory
+#
+
+import collections
+import hashlib
+import os
+import tempfile
+from array import array
+from csg import CSG
+import csg_file
+
+SUFFIX = ".csg"
+
+
+# Digest of the polygons of `csg`, computed once per solid.
+def digest(csg):
+    if csg._digest is None:
+        sha = hashlib.sha1()
+        coords = array("d")
+        counts = array("i")
+        planes = array("d")
+        shareds = []
+        for p in csg.polygons:
+            for v in p.vertices:
+                coords.extend((v.x, v.y, v.z))
+            counts.append(len(p.vertices))
+            normal = p.plane.normal
+            planes.extend((normal.x, normal.y, normal.z, p.plane.w))
+            shareds.append(p.shared)
+        sha.update(coords.tostring())
+        sha.update(counts.tostring())
+        sha.update(planes.tostring())
+        sha.update(repr(shareds))
+        csg._digest = sha.hexdigest()
+    return csg._digest
+
+
+# A new solid over the polygons (and tree) of `csg`, so that the cache and
+# its callers never share a polygon list.
+def _copy(csg):
+    result = CSG(csg.polygons[:])
+    result._tree = csg._tree
+    result._flat = csg._flat
+    result._treeKey = csg._treeKey
+    result._bounds = csg._bounds
+    return result
+
+
+# # class Cache
+#
+# Results of booleans by key. Set one as `CSG.CACHE`, or pass it to
+# `union`, `subtract` or `intersect` as `cache`.
+class Cache(object):
+
+    def __init__(self, directory=None, memory_size=32, disk_size=1 << 30):
+        self.directory = directory
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.memory = collections.OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+    # Key of `a.op(b)`, or None when the result cannot be cached.
+    def key(self, op, a, b, engine, splitter=None):
+        if splitter is not None and not splitter.strategy == "first":
+            return None
+        sha = hashlib.sha1()
+        sha.update(repr((op, engine, CSG.Plane_EPSILON, CSG.Plane_ROBUST)))
+        sha.update(digest(a))
+        sha.update(digest(b))
+        return sha.hexdigest()
+
+    # The cached result of `key`, or None.
+    def get(self, key):
+        csg = self.memory.pop(key, None)
+        if csg is None:
+            csg = self._read(key)
+            if csg is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        else:
+            self.hits += 1
+        self._remember(key, csg)
+        return _copy(csg)
+
+    def put(self, key, csg):
+        self._remember(key, _copy(csg))
+        if self.directory:
+            self._write(key, csg)
+
+    def clear(self):
+        self.memory.clear()
+        if self.directory:
+            for path, size, mtime in self._files():
+                self._remove(path)
+
+    def _remember(self, key, csg):
+        self.memory[key] = csg
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def _read(self, key):
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as io:
+                data = io.read()
+        except IOError:
+            return None
+        try:
+            csg = csg_file.loads(data)
+        except Exception:
+            self._remove(path)
+            return None
+        try:
+            # Last use, for eviction.
+            os.utime(path, None)
+        except OSError:
+            pass
+        return csg
+
+    def _write(self, key, csg):
+        try:
+            data = csg_file.dumps(csg)
+        except AssertionError:
+            return
+        if len(data) > self.disk_size:
+            return
+        # Write under a temporary name and rename, so that other processes
+        # never read a partial file.
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        with os.fdopen(fd, "wb") as io:
+            io.write(data)
+        os.rename(tmp, self._path(key))
+        self._evict()
+
+    def _files(self):
+        if not self.directory:
+            return []
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((path, stat.st_size, stat.st_mtime))
+        return files
+
+    # Remove the least recently used files until the rest fit in `disk_size`.
+    def _evict(self):
+        files = self._files()
+        total = sum(size for path, size, mtime in files)
+        for path, size, mtime in sorted(files, key=lambda f: f[2]):
+            if total <= self.disk_size:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
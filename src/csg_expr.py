@@ -0,0 +1,304 @@
+# coding: utf-8
+#
+# 遅延評価の CSG 式
+#
+# `csg.lazy()` starts an expression: `union`, `subtract` and `intersect` on it
+# only record the operation, and `evaluate()` plans and runs the whole tree.
+#
+#     expr = a.lazy().union(b).union(c).subtract(d).subtract(e)
+#     csg = expr.evaluate()
+#
+# The planner
+#
+# - flattens chains into n-way nodes: ((a | b) | c) is union(a, b, c), and
+#   ((a - d) - e) is subtract(a, d, e), which runs as `a.subtract_many`
+# - folds repeated subexpressions: the same solid, or the same operation on
+#   the same operands (in any order for union and intersect), is evaluated
+#   once, and repeated operands of a union or intersect are dropped
+# - prunes by bounds, before evaluating anything: an intersect of operands
+#   whose bounds do not all overlap is empty, and operands to subtract that
+#   miss the bounds of the solid are dropped
+#
+# An n-way union runs as `union_many`: the tree of every operand is built
+# once and only operands whose bounds overlap are clipped against each other,
+# where a left fold rebuilds the tree of the growing result at every step.
+# With the numpy engine or a cache, n-way nodes run as a chain of pairwise
+# booleans instead.
+#
+
+from csg import CSG
+
+
+def _expr(operand):
+    if isinstance(operand, Expr):
+        return operand
+    return Expr("leaf", csg=operand)
+
+
+# # class Expr
+#
+# A node of a CSG expression: "leaf" (a solid), "empty", or an operation on
+# `children`. A "subtract" node subtracts all of its children but the first
+# from the first.
+class Expr(object):
+
+    OPERATIONS = ("union", "subtract", "intersect")
+
+    def __init__(self, op, children=(), csg=None):
+        self.op = op
+        self.children = list(children)
+        self.csg = csg
+        self._key = None
+        self._bounds = False
+        self._result = None
+
+    def union(self, other):
+        return Expr("union", [self, _expr(other)])
+
+    def subtract(self, other):
+        return Expr("subtract", [self, _expr(other)])
+
+    def intersect(self, other):
+        return Expr("intersect", [self, _expr(other)])
+
+    # Key of a planned node, equal for nodes that evaluate to the same solid
+    # by construction. Planned nodes share equal subexpressions, so the key
+    # names the children by identity and stays flat however deep the
+    # expression is.
+    def key(self):
+        if self._key is None:
+            if self.op == "leaf":
+                self._key = ("leaf", id(self.csg))
+            elif self.op == "empty":
+                self._key = ("empty",)
+            elif self.op == "subtract":
+                self._key = ("subtract", id(self.children[0]),
+                             tuple(sorted(id(c) for c in self.children[1:])))
+            else:
+                self._key = (self.op, tuple(sorted(id(c) for c in self.children)))
+        return self._key
+
+    # `CSG.Bounds` containing the solid of self expression, or None when it is
+    # known to be empty. Computed without evaluating anything.
+    def bounds(self):
+        if self._bounds is False:
+            for node in _postorder(self, lambda n: n._bounds is not False):
+                node._bounds = node._computeBounds()
+        return self._bounds
+
+    def _computeBounds(self):
+        if self.op == "leaf":
+            return self.csg.bounds()
+        if self.op == "empty":
+            return None
+        boxes = [c.bounds() for c in self.children]
+        if self.op == "subtract":
+            return boxes[0]
+        if self.op == "union":
+            boxes = [b for b in boxes if b is not None]
+            if not boxes:
+                return None
+            return CSG.Bounds(
+                CSG.Vector(min(b.min.x for b in boxes), min(b.min.y for b in boxes),
+                           min(b.min.z for b in boxes)),
+                CSG.Vector(max(b.max.x for b in boxes), max(b.max.y for b in boxes),
+                           max(b.max.z for b in boxes)))
+        box = boxes[0]
+        for b in boxes[1:]:
+            if box is None or b is None or not box.overlaps(b, CSG.Plane_EPSILON):
+                return None
+            box = box.intersection(b)
+        return box
+
+    # The planned expression: flattened, folded and pruned.
+    def plan(self):
+        return _plan(self, {})
+
+    # Plan and evaluate self expression. The options are passed to every
+    # boolean (see `CSG.union`). The result is kept, so evaluating again
+    # costs nothing.
+    def evaluate(self, engine=None, splitter=None, parallel=None, robust=None, profile=None,
+                 cache=None):
+        if self._result is None:
+            options = {"engine": engine, "splitter": splitter, "parallel": parallel,
+                       "robust": robust, "profile": profile, "cache": cache}
+            self._result = _evaluate(self.plan(), {}, options)
+        return self._result
+
+    def __str__(self):
+        lines = []
+        pending = [[self, 0, ""]]
+        while pending:
+            node, level, suffix = pending.pop()
+            indent = "  " * level
+            if node.op == "leaf":
+                lines.append("%sleaf(%d polygons)%s" % (indent, len(node.csg.polygons), suffix))
+            elif node.op == "empty":
+                lines.append("%sempty%s" % (indent, suffix))
+            else:
+                lines.append("%s%s(" % (indent, node.op))
+                last = len(node.children) - 1
+                for i in xrange(last, -1, -1):
+                    pending.append([node.children[i], level + 1, ")" + suffix if i == last else ","])
+        return "\n".join(lines)
+
+
+# The nodes of `expr`, each once and after its children, leaving out the
+# subexpressions for which `skip` is true. Expressions built by chains are as
+# deep as they are long, so they are walked with a list instead of recursing.
+def _postorder(expr, skip=None):
+    order = []
+    seen = set()
+    pending = [[expr, False]]
+    while pending:
+        node, done = pending.pop()
+        if done:
+            order.append(node)
+            continue
+        if id(node) in seen or (skip and skip(node)):
+            continue
+        seen.add(id(node))
+        pending.append([node, True])
+        for c in node.children:
+            pending.append([c, False])
+    return order
+
+
+def _empty():
+    return Expr("empty")
+
+
+def _overlaps(a, b):
+    return a is not None and b is not None and a.overlaps(b, CSG.Plane_EPSILON)
+
+
+def _unique(nodes):
+    keys = set()
+    result = []
+    for node in nodes:
+        if node.key() not in keys:
+            keys.add(node.key())
+            result.append(node)
+    return result
+
+
+# Planned copy of `expr`. `memo` maps keys to planned nodes, so repeated
+# subexpressions become one node.
+def _plan(expr, memo):
+    planned = {}
+    for source in _postorder(expr):
+        if source.op in ("leaf", "empty"):
+            node = source
+        else:
+            children = [planned[id(c)] for c in source.children]
+            if source.op == "subtract":
+                node = _planSubtract(children)
+            else:
+                node = _planAssociative(source.op, children)
+        planned[id(source)] = memo.setdefault(node.key(), node)
+    return planned[id(expr)]
+
+
+def _planAssociative(op, children):
+    flat = []
+    for c in children:
+        if c.op == op:
+            flat.extend(c.children)
+        else:
+            flat.append(c)
+    flat = _unique(flat)
+
+    if op == "union":
+        flat = [c for c in flat if c.bounds() is not None]
+        if not flat:
+            return _empty()
+    elif any(c.bounds() is None for c in flat):
+        return _empty()
+
+    if len(flat) == 1:
+        return flat[0]
+    node = Expr(op, flat)
+    if op == "intersect" and node.bounds() is None:
+        return _empty()
+    return node
+
+
+def _planSubtract(children):
+    solid = children[0]
+    tools = children[1:]
+    if solid.op == "subtract":
+        tools = solid.children[1:] + tools
+        solid = solid.children[0]
+
+    box = solid.bounds()
+    if box is None:
+        return _empty()
+    tools = _unique([t for t in tools if _overlaps(box, t.bounds())])
+    if any(t.key() == solid.key() for t in tools):
+        return _empty()
+    if not tools:
+        return solid
+    return Expr("subtract", [solid] + tools)
+
+
+# Evaluate the planned expression `plan`, children first. `results` maps
+# keys to the solids already evaluated.
+def _evaluate(plan, results, options):
+    for node in _postorder(plan, lambda n: n.key() in results):
+        if node.op == "leaf":
+            result = node.csg
+        elif node.op == "empty":
+            result = CSG([])
+        else:
+            csgs = [results[c.key()] for c in node.children]
+            if node.op == "union":
+                result = _unionAll(csgs, options)
+            elif node.op == "intersect":
+                result = _intersectAll(csgs, options)
+            else:
+                result = _subtractAll(csgs[0], csgs[1:], options)
+        results[node.key()] = result
+    return results[plan.key()]
+
+
+# Whether the n-way methods of `CSG` can run with `options`.
+def _many(options):
+    return (options["engine"] or CSG.DEFAULT_ENGINE) == "python" and \
+        not (options["cache"] or CSG.CACHE)
+
+
+def _unionAll(csgs, options):
+    if _many(options):
+        return csgs[0].union_many(csgs[1:], options["splitter"], options["parallel"],
+                                  options["robust"], options["profile"])
+    result = csgs[0]
+    for c in csgs[1:]:
+        result = result.union(c, **options)
+    return result
+
+
+def _intersectAll(csgs, options):
+    # Smallest first: every step can only shrink the result.
+    def volume(c):
+        b = c.bounds()
+        if b is None:
+            return 0.0
+        size = b.max.minus(b.min)
+        return size.x * size.y * size.z
+
+    csgs = sorted(csgs, key=volume)
+    result = csgs[0]
+    for c in csgs[1:]:
+        if not result.polygons:
+            break
+        result = result.intersect(c, **options)
+    return result
+
+
+def _subtractAll(solid, tools, options):
+    if _many(options):
+        return solid.subtract_many(tools, options["splitter"], options["parallel"],
+                                   options["robust"], options["profile"])
+    for t in tools:
+        solid = solid.subtract(t, **options)
+    return solid
@@ -0,0 +1,235 @@
+# coding: utf-8
+#
+# CSG ソリッド (と BSP ツリー) のバイナリ形式
+#
+# A file holds a header and flat little-endian arrays, so it is written and
+# read with one bulk copy per array:
+#
+#     header      "CSGB", version, flags and the counts below (uint32)
+#     vertices    float64 x, y, z per vertex
+#     planes      float64 normal x, y, z and w per plane
+#     polygons    int32 vertex indices of all polygons back to back, int32
+#                 offsets into them (polygons + 1), int32 plane and shared
+#                 index per polygon
+#     solid       int32 polygon indices of `csg.polygons`
+#     tree        int32 plane, front, back (-1 when missing) and splits per
+#                 node, the root first and every child after its parent, and
+#                 int32 offsets into int32 polygon indices per node (nodes + 1)
+#     literals    the repr of the distinct `shared` values and of the key of
+#                 the tree (`CSG._treeKeyFor`)
+#
+# Vertices, planes, polygons and `shared` values are written once however
+# many polygons or nodes use them, and read back shared the same way. The
+# tree is written when the solid has one (after `csg.tree()`, or from
+# `csg_from_ply`) and `tree` is True; a solid read with its tree runs booleans without
+# building it again. The tree section is the arrays of `CSG.FlatTree`, and
+# is read back as one. Splitters are not written, but the key of the tree
+# is: a tree read back is only used with the same kind of splitter and under
+# the same tolerance, and built again otherwise.
+#
+# The literals are read back with `ast.literal_eval`, so reading a file
+# never runs code from it, even from a directory others can write to (see
+# csg_cache.py). Only `shared` values made of None, booleans, numbers,
+# strings, and tuples, lists and dicts of them can be written.
+#
+#     csg_file.write(a.union(b), "union.csg")
+#     csg = csg_file.read("union.csg")
+#
+
+import ast
+import math
+import mmap as _mmap
+import struct
+import sys
+from array import array
+from csg import CSG
+
+MAGIC = "CSGB"
+VERSION = 3
+
+# Flags of the header.
+HAS_TREE = 1
+
+# magic, version, flags, vertices, planes, polygons, refs, solid polygons,
+# nodes, node refs, bytes of literals
+HEADER = struct.Struct("<4sIIIIIIIIII")
+
+_SWAP = not sys.byteorder == "little"
+
+
+def _bytes(typecode, values):
+    a = array(typecode, values) if not isinstance(values, array) else values
+    if _SWAP:
+        a = array(typecode, a)
+        a.byteswap()
+    return a.tostring()
+
+
+def _array(typecode, data, offset, count):
+    a = array(typecode)
+    size = a.itemsize * count
+    a.fromstring(data[offset:offset + size])
+    if _SWAP:
+        a.byteswap()
+    return a, offset + size
+
+
+# True when `value` is read back equal from its repr by `ast.literal_eval`.
+def _literal(value):
+    if value is None or isinstance(value, (bool, int, long, str, unicode)):
+        return True
+    if isinstance(value, float):
+        return not (math.isinf(value) or math.isnan(value))
+    if isinstance(value, (tuple, list)):
+        return all(_literal(v) for v in value)
+    if isinstance(value, dict):
+        return all(_literal(k) and _literal(v) for k, v in value.iteritems())
+    return False
+
+
+# Distinct objects of `items` in order of first use: a list of them, and
+# the index of each item in that list.
+class _Table(object):
+
+    def __init__(self):
+        self.items = []
+        self.indices = {}
+
+    def index(self, item):
+        i = self.indices.get(id(item))
+        if i is None:
+            i = self.indices[id(item)] = len(self.items)
+            self.items.append(item)
+        return i
+
+
+def dumps(csg, tree=True):
+    flat = None
+    key = None
+    if tree:
+        flat = csg._flat
+        key = csg._treeKey
+        if flat is None and csg._tree is not None:
+            flat = CSG.FlatTree.fromNode(csg._tree)
+
+    polygons = _Table()
+    solid = array("i", [polygons.index(p) for p in csg.polygons])
+    node_offsets = array("i", [0])
+    node_refs = array("i")
+    if flat is not None:
+        node_refs.extend(polygons.index(p) for p in flat.polygons)
+        node_offsets = flat.offsets
+
+    vertices = _Table()
+    planes = _Table()
+    shareds = _Table()
+    refs = array("i")
+    offsets = array("i", [0])
+    polygon_planes = array("i")
+    polygon_shareds = array("i")
+    for p in polygons.items:
+        refs.extend(vertices.index(v) for v in p.vertices)
+        offsets.append(len(refs))
+        polygon_planes.append(planes.index(p.plane))
+        polygon_shareds.append(shareds.index(p.shared))
+
+    node_planes = array("i")
+    fronts = array("i")
+    backs = array("i")
+    splits = array("i")
+    if flat is not None:
+        node_planes.extend(planes.index(plane) if plane else -1 for plane in flat.planes)
+        fronts = flat.fronts
+        backs = flat.backs
+        splits = flat.splits
+
+    coords = array("d")
+    for v in vertices.items:
+        coords.extend((v.x, v.y, v.z))
+    plane_values = array("d")
+    for plane in planes.items:
+        normal = plane.normal
+        plane_values.extend((normal.x, normal.y, normal.z, plane.w))
+    for shared in shareds.items:
+        if not _literal(shared):
+            assert False, "cannot write shared=%r" % (shared,)
+    literal = repr((shareds.items, key if flat is not None else None))
+
+    header = HEADER.pack(MAGIC, VERSION, HAS_TREE if node_planes else 0, len(vertices.items),
+                         len(planes.items), len(polygons.items), len(refs), len(solid),
+                         len(node_planes), len(node_refs), len(literal))
+    return "".join([header, _bytes("d", coords), _bytes("d", plane_values),
+                    _bytes("i", refs), _bytes("i", offsets), _bytes("i", polygon_planes),
+                    _bytes("i", polygon_shareds), _bytes("i", solid),
+                    _bytes("i", node_planes), _bytes("i", fronts), _bytes("i", backs),
+                    _bytes("i", splits), _bytes("i", node_offsets), _bytes("i", node_refs),
+                    literal])
+
+
+# The solid in `data` (a string, or anything sliced like one such as an
+# mmap), with its tree when one was written.
+def loads(data):
+    (magic, version, flags, vertex_count, plane_count, polygon_count, ref_count, solid_count,
+     node_count, node_ref_count, literal_size) = HEADER.unpack(data[:HEADER.size])
+    if not magic == MAGIC:
+        assert False, "not a CSG file"
+    if not version == VERSION:
+        assert False, "unknown version=%d" % version
+
+    offset = HEADER.size
+    coords, offset = _array("d", data, offset, vertex_count * 3)
+    plane_values, offset = _array("d", data, offset, plane_count * 4)
+    refs, offset = _array("i", data, offset, ref_count)
+    offsets, offset = _array("i", data, offset, polygon_count + 1)
+    polygon_planes, offset = _array("i", data, offset, polygon_count)
+    polygon_shareds, offset = _array("i", data, offset, polygon_count)
+    solid, offset = _array("i", data, offset, solid_count)
+    node_planes, offset = _array("i", data, offset, node_count)
+    fronts, offset = _array("i", data, offset, node_count)
+    backs, offset = _array("i", data, offset, node_count)
+    splits, offset = _array("i", data, offset, node_count)
+    node_offsets, offset = _array("i", data, offset, node_count + 1)
+    node_refs, offset = _array("i", data, offset, node_ref_count)
+    shareds, key = ast.literal_eval(data[offset:offset + literal_size])
+
+    Vector = CSG.Vector
+    vertices = [Vector(coords[k], coords[k + 1], coords[k + 2])
+                for k in xrange(0, len(coords), 3)]
+    planes = [CSG.Plane(Vector(plane_values[k], plane_values[k + 1], plane_values[k + 2]),
+                        plane_values[k + 3])
+              for k in xrange(0, len(plane_values), 4)]
+    polygons = []
+    for i in xrange(polygon_count):
+        polygons.append(CSG.Polygon([vertices[k] for k in refs[offsets[i]:offsets[i + 1]]],
+                                    shareds[polygon_shareds[i]], planes[polygon_planes[i]]))
+
+    csg = CSG([polygons[i] for i in solid])
+    if flags & HAS_TREE and node_count:
+        flat = CSG.FlatTree()
+        flat.planes = [planes[k] if k >= 0 else None for k in node_planes]
+        flat.fronts = fronts
+        flat.backs = backs
+        flat.splits = splits
+        flat.offsets = node_offsets
+        flat.polygons = [polygons[i] for i in node_refs]
+        csg._flat = flat
+        csg._treeKey = key
+    return csg
+
+
+def write(csg, filename, tree=True):
+    with open(filename, "wb") as io:
+        io.write(dumps(csg, tree))
+
+
+# Read the solid written to `filename` in one read, or through a memory map
+# of the file with `mmap`.
+def read(filename, mmap=False):
+    with open(filename, "rb") as io:
+        if not mmap:
+            return loads(io.read())
+        mapping = _mmap.mmap(io.fileno(), 0, access=_mmap.ACCESS_READ)
+        try:
+            return loads(mapping)
+        finally:
+            mapping.close()
@@ -0,0 +1,246 @@
+# coding: utf-8
+#
+# 同一平面上の断片を凸多角形にまとめなおす
+#
+# Booleans leave every input polygon cut into many coplanar fragments. This
+# pass groups the polygons of a solid by plane and `shared` value and, inside
+# each group, joins polygons along the edges they share as long as the result
+# stays convex (Hertel-Mehlhorn in reverse). Vertices lying on an edge of a
+# neighbour (T-junctions left by the BSP splits) are taken into account, so
+# fragments cut by different planes still find each other. Polygons that are
+# not merged are kept as they are.
+#
+
+import bisect
+from csg import CSG
+
+# Vertices closer than this are the same vertex.
+TOLERANCE = 1e-6
+
+# Relative tolerance of the convexity and collinearity tests.
+ANGLE_EPSILON = 1e-9
+
+
+def _vertex_key(v):
+    return (int(round(v.x / TOLERANCE)), int(round(v.y / TOLERANCE)), int(round(v.z / TOLERANCE)))
+
+
+def _plane_key(plane):
+    n = plane.normal
+    return (round(n.x, 6), round(n.y, 6), round(n.z, 6), int(round(plane.w / CSG.Plane_EPSILON)))
+
+
+def _shared_key(shared):
+    if isinstance(shared, list):
+        return tuple(shared)
+    try:
+        hash(shared)
+        return shared
+    except TypeError:
+        return id(shared)
+
+
+# Turn of the corner a -> b -> c around `normal`: > 0 when convex, about 0 when
+# the three are on a line.
+def _turn(a, b, c, normal):
+    ux = b.x - a.x
+    uy = b.y - a.y
+    uz = b.z - a.z
+    vx = c.x - b.x
+    vy = c.y - b.y
+    vz = c.z - b.z
+    cross = ((uy * vz - uz * vy) * normal.x + (uz * vx - ux * vz) * normal.y +
+             (ux * vy - uy * vx) * normal.z)
+    scale = (ux * ux + uy * uy + uz * uz) ** 0.5 * (vx * vx + vy * vy + vz * vz) ** 0.5
+    if abs(cross) <= ANGLE_EPSILON * scale:
+        return 0.0
+    return cross
+
+
+# Insert into every loop the vertices of the group lying inside its edges.
+# Only an edge without a twin (the same edge the other way round in another
+# loop) can have such a vertex, and the vertex then ends an edge without a
+# twin itself. Candidates are looked up along the axis on which the edge is
+# shortest.
+def _split_t_junctions(loops, points):
+    edges = set()
+    for loop in loops.itervalues():
+        for i in xrange(len(loop)):
+            edges.add((loop[i - 1], loop[i]))
+    open_edges = set(e for e in edges if (e[1], e[0]) not in edges)
+    if not open_edges:
+        return
+    candidates = set()
+    for a, b in open_edges:
+        candidates.add(a)
+        candidates.add(b)
+    axes = []
+    for axis in ("x", "y", "z"):
+        keys = sorted(candidates, key=lambda k: getattr(points[k], axis))
+        axes.append((keys, [getattr(points[k], axis) for k in keys]))
+
+    for id, loop in loops.items():
+        result = []
+        for i in xrange(len(loop)):
+            a = loop[i]
+            b = loop[(i + 1) % len(loop)]
+            result.append(a)
+            if (a, b) not in open_edges:
+                continue
+            pa = points[a]
+            pb = points[b]
+            dx = pb.x - pa.x
+            dy = pb.y - pa.y
+            dz = pb.z - pa.z
+            length2 = dx * dx + dy * dy + dz * dz
+            if length2 == 0.0:
+                continue
+            extents = [abs(dx), abs(dy), abs(dz)]
+            axis = extents.index(min(extents))
+            keys, values = axes[axis]
+            lo = min(pa[axis], pb[axis]) - TOLERANCE
+            hi = max(pa[axis], pb[axis]) + TOLERANCE
+            inside = []
+            for k in keys[bisect.bisect_left(values, lo):bisect.bisect_right(values, hi)]:
+                if k == a or k == b:
+                    continue
+                p = points[k]
+                t = ((p.x - pa.x) * dx + (p.y - pa.y) * dy + (p.z - pa.z) * dz) / length2
+                if t <= 0.0 or t >= 1.0:
+                    continue
+                ex = pa.x + dx * t - p.x
+                ey = pa.y + dy * t - p.y
+                ez = pa.z + dz * t - p.z
+                if ex * ex + ey * ey + ez * ez <= TOLERANCE * TOLERANCE:
+                    inside.append((t, k))
+            inside.sort()
+            result.extend(k for t, k in inside)
+        loops[id] = result
+
+
+# Join the loops `p` and `q` along the edge a -> b of `p` (b -> a in `q`), or
+# None when they would touch themselves. The joined loop starts at b and a is
+# at `len(p) - 1`; as both loops are convex, only these two corners can be
+# concave.
+def _join(p, q, a, b):
+    i = p.index(b)
+    p = p[i:] + p[:i]
+    i = q.index(a)
+    q = q[i:] + q[:i]
+    if not (p[-1] == a and q[-1] == b):
+        return None
+    loop = p + q[1:-1]
+    if len(set(loop)) < len(loop):
+        return None
+    return loop
+
+
+def _merge_group(polygons, group, owners):
+    plane = polygons[0].plane
+    normal = plane.normal
+    points = {}
+    loops = {}
+    for id, polygon in enumerate(polygons):
+        loop = []
+        for v in polygon.vertices:
+            key = _vertex_key(v)
+            if key not in points:
+                points[key] = v
+            if not loop or not loop[-1] == key:
+                loop.append(key)
+        if len(loop) > 1 and loop[0] == loop[-1]:
+            loop.pop()
+        loops[id] = loop
+    _split_t_junctions(loops, points)
+
+    edges = {}
+    for id, loop in loops.items():
+        for i in xrange(len(loop)):
+            edges[(loop[i - 1], loop[i])] = id
+
+    merged = set()
+    rejected = set()
+    queue = loops.keys()
+    next_id = len(polygons)
+    while queue:
+        id = queue.pop()
+        loop = loops.get(id)
+        if loop is None:
+            continue
+        for i in xrange(len(loop)):
+            a = loop[i - 1]
+            b = loop[i]
+            other = edges.get((b, a))
+            if other is None or other == id or other not in loops or (id, other) in rejected:
+                continue
+            joined = _join(loop, loops[other], a, b)
+            k = len(loop) - 1
+            if joined is None or \
+                    _turn(points[joined[-1]], points[b], points[joined[1]], normal) < 0 or \
+                    _turn(points[joined[k - 1]], points[a], points[joined[k + 1]], normal) < 0:
+                rejected.add((id, other))
+                rejected.add((other, id))
+                continue
+            for old in (id, other):
+                old_loop = loops.pop(old)
+                for j in xrange(len(old_loop)):
+                    edge = (old_loop[j - 1], old_loop[j])
+                    if edges.get(edge) == old:
+                        del edges[edge]
+                merged.discard(old)
+            for j in xrange(len(joined)):
+                edges[(joined[j - 1], joined[j])] = next_id
+            loops[next_id] = joined
+            merged.add(next_id)
+            queue.append(next_id)
+            next_id += 1
+            break
+
+    result = [polygons[id] for id in sorted(loops) if id not in merged]
+    for id in sorted(merged):
+        loop = loops[id]
+        # Drop the vertices on a straight edge that no other group uses.
+        vertices = []
+        n = len(loop)
+        for i in xrange(n):
+            key = loop[i]
+            if owners.get(key) == group and \
+                    _turn(points[loop[i - 1]], points[key], points[loop[(i + 1) % n]], normal) == 0.0:
+                continue
+            vertices.append(points[key])
+        if len(vertices) >= 3:
+            result.append(CSG.Polygon(vertices, polygons[0].shared, plane))
+    return result
+
+
+# Polygons of `polygons` with adjacent coplanar convex pieces merged.
+def merge_coplanar(polygons):
+    groups = {}
+    order = []
+    for p in polygons:
+        key = (_plane_key(p.plane), _shared_key(p.shared))
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append(p)
+
+    # Group using each vertex, or -1 when several do.
+    owners = {}
+    for group, key in enumerate(order):
+        for p in groups[key]:
+            for v in p.vertices:
+                k = _vertex_key(v)
+                owner = owners.get(k)
+                if owner is None:
+                    owners[k] = group
+                elif not owner == group:
+                    owners[k] = -1
+
+    result = []
+    for group, key in enumerate(order):
+        members = groups[key]
+        if len(members) == 1:
+            result.extend(members)
+        else:
+            result.extend(_merge_group(members, group, owners))
+    return result
@@ -0,0 +1,471 @@
+# coding: utf-8
+#
+# NumPy 版の CSG エンジン
+#
+# CSG.Node と同じアルゴリズム (csg.js) を、ポリゴンを 1 つずつではなく
+# まとめて配列で処理する。CSG.union/subtract/intersect に engine="numpy" を
+# 渡すとこちらが使われる。
+#
+
+import numpy as np
+from csg import CSG
+
+COPLANAR = 0
+FRONT = 1
+BACK = 2
+SPANNING = 3
+
+
+# Return the concatenation of `arange(s, s + c)` for every pair of `starts` and
+# `counts` without a Python loop.
+def _ranges(starts, counts):
+    total = int(counts.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    heads = np.cumsum(counts) - counts
+    return np.repeat(starts - heads, counts) + np.arange(total)
+
+
+def _offsets(counts):
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+def _object_array(values):
+    array = np.empty(len(values), dtype=object)
+    for i, v in enumerate(values):
+        array[i] = v
+    return array
+
+
+# # class Soup
+#
+# A batch of convex polygons stored as contiguous arrays.
+#
+# - `vertices` (V, 3) float64: the vertices of every polygon, back to back
+# - `counts` (P): the number of vertices of every polygon
+# - `offsets` (P + 1): polygon `i` owns `vertices[offsets[i]:offsets[i + 1]]`
+# - `normals` (P, 3) and `w` (P): the plane of every polygon
+# - `shared` (P) object: the `shared` value of every polygon
+#
+class Soup(object):
+
+    def __init__(self, vertices, counts, normals, w, shared, offsets=None):
+        self.vertices = vertices
+        self.counts = counts
+        self.offsets = _offsets(counts) if offsets is None else offsets
+        self.normals = normals
+        self.w = w
+        self.shared = shared
+        self._owner = None
+
+    def __len__(self):
+        return len(self.counts)
+
+    @classmethod
+    def empty(cls):
+        return Soup(np.zeros((0, 3)), np.zeros(0, dtype=np.int64),
+                    np.zeros((0, 3)), np.zeros(0), _object_array([]))
+
+    @classmethod
+    def from_polygons(cls, polygons):
+        if not polygons:
+            return Soup.empty()
+        counts = np.array([len(p.vertices) for p in polygons], dtype=np.int64)
+        vertices = np.array([[v.x, v.y, v.z] for p in polygons for v in p.vertices],
+                            dtype=np.float64)
+        normals = np.array([[p.plane.normal.x, p.plane.normal.y, p.plane.normal.z]
+                            for p in polygons], dtype=np.float64)
+        w = np.array([p.plane.w for p in polygons], dtype=np.float64)
+        shared = _object_array([p.shared for p in polygons])
+        return Soup(vertices, counts, normals, w, shared)
+
+    def to_polygons(self):
+        vertices = [CSG.Vector(v) for v in self.vertices.tolist()]
+        normals = self.normals.tolist()
+        w = self.w.tolist()
+        offsets = self.offsets.tolist()
+        polygons = []
+        for i in xrange(len(self)):
+            plane = CSG.Plane(CSG.Vector(normals[i]), w[i])
+            polygon = CSG.Polygon(vertices[offsets[i]:offsets[i + 1]], self.shared[i], plane)
+            polygons.append(polygon)
+        return polygons
+
+    # The polygon index of every vertex.
+    def owner(self):
+        if self._owner is None:
+            self._owner = np.repeat(np.arange(len(self)), self.counts)
+        return self._owner
+
+    # Return a new soup holding the polygons where `mask` is set.
+    def select(self, mask):
+        if mask.all():
+            return self
+        return Soup(self.vertices[mask[self.owner()]], self.counts[mask],
+                    self.normals[mask], self.w[mask], self.shared[mask])
+
+    # Return a new soup holding the polygons at `index`, in that order.
+    def take(self, index):
+        return Soup(self.vertices[_ranges(self.offsets[index], self.counts[index])],
+                    self.counts[index], self.normals[index], self.w[index], self.shared[index])
+
+    # True for every polygon whose bounding box touches the `CSG.Bounds`
+    # `bounds`.
+    def touches(self, bounds):
+        if len(self) == 0:
+            return np.zeros(0, dtype=bool)
+        low = np.minimum.reduceat(self.vertices, self.offsets[:-1])
+        high = np.maximum.reduceat(self.vertices, self.offsets[:-1])
+        box_low = np.array(bounds.min.as_array())
+        box_high = np.array(bounds.max.as_array())
+        return np.all((low <= box_high) & (high >= box_low), axis=1)
+
+    # Return a new soup with every polygon facing the other way.
+    def flipped(self):
+        ends = self.offsets[:-1] + self.offsets[1:] - 1
+        index = ends[self.owner()] - np.arange(len(self.vertices))
+        return Soup(self.vertices[index], self.counts, -self.normals, -self.w,
+                    self.shared, self.offsets)
+
+    @classmethod
+    def concat(cls, soups):
+        soups = [s for s in soups if len(s) > 0]
+        if not soups:
+            return Soup.empty()
+        if len(soups) == 1:
+            return soups[0]
+        return Soup(np.concatenate([s.vertices for s in soups]),
+                    np.concatenate([s.counts for s in soups]),
+                    np.concatenate([s.normals for s in soups]),
+                    np.concatenate([s.w for s in soups]),
+                    np.concatenate([s.shared for s in soups]))
+
+
+# Vectorized `CSG.Plane.splitPolygon`. Polygon `i` of `soup` is classified
+# against the plane (`normals[i]`, `w[i]`) in one signed distance computation,
+# and every spanning polygon is split at once.
+#
+# Returns `(types, facing, front, front_src, back, back_src)`:
+#
+# - `types`: COPLANAR / FRONT / BACK / SPANNING for every polygon
+# - `facing`: True where a coplanar polygon faces the same way as its plane
+# - `front` / `back`: the fragments of the spanning polygons
+# - `front_src` / `back_src`: the index in `soup` each fragment was cut from
+#
+def split_soup(soup, normals, w):
+    eps = CSG.Plane_EPSILON
+    counts = soup.counts
+    owner = soup.owner()
+    dist = np.einsum("ij,ij->i", soup.vertices, normals[owner]) - w[owner]
+
+    vtypes = np.full(len(dist), COPLANAR, dtype=np.int8)
+    vtypes[dist > eps] = FRONT
+    vtypes[dist < -eps] = BACK
+    types = np.bitwise_or.reduceat(vtypes, soup.offsets[:-1])
+    facing = np.einsum("ij,ij->i", normals, soup.normals) > 0
+
+    spanning = np.nonzero(types == SPANNING)[0]
+    if len(spanning) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return types, facing, Soup.empty(), empty, Soup.empty(), empty
+
+    # Walk the edges (i, j) of every spanning polygon.
+    span_counts = counts[spanning]
+    i = _ranges(soup.offsets[:-1][spanning], span_counts)
+    edge_owner = np.repeat(np.arange(len(spanning)), span_counts)
+    last = soup.offsets[1:][spanning][edge_owner] - 1
+    j = np.where(i == last, soup.offsets[:-1][spanning][edge_owner], i + 1)
+
+    ti = vtypes[i]
+    tj = vtypes[j]
+    cut = (ti | tj) == SPANNING
+    di = dist[i]
+    dj = dist[j]
+    denom = np.where(cut, dj - di, 1.0)
+    t = np.where(cut, -di / denom, 0.0)
+    vi = soup.vertices[i]
+    vj = soup.vertices[j]
+
+    # Every edge emits its start vertex and then, if it crosses the plane, the
+    # intersection point. Lay those out as two slots per edge and keep the ones
+    # each side wants.
+    points = np.empty((2 * len(i), 3))
+    points[0::2] = vi
+    points[1::2] = vi + (vj - vi) * t[:, np.newaxis]
+    slot_owner = np.repeat(edge_owner, 2)
+
+    def side(keep_vertex):
+        mask = np.empty(2 * len(i), dtype=bool)
+        mask[0::2] = keep_vertex
+        mask[1::2] = cut
+        owners = slot_owner[mask]
+        sizes = np.bincount(owners, minlength=len(spanning))
+        valid = sizes >= 3
+        mask[mask] = valid[owners]
+        src = spanning[valid]
+        fragments = Soup(points[mask], sizes[valid], soup.normals[src],
+                         soup.w[src], soup.shared[src])
+        return fragments, src
+
+    front, front_src = side(ti != BACK)
+    back, back_src = side(ti != FRONT)
+    return types, facing, front, front_src, back, back_src
+
+
+# The polygons of `soup` where `mask` is set together with the fragments
+# `pieces` cut from the polygons `src` of `soup`, in the order of `soup` like
+# `CSG.Plane.splitPolygon` appends them. Returns the merged soup and the index
+# in `soup` of every polygon in it.
+def _merge(soup, mask, pieces, src):
+    whole = np.nonzero(mask)[0]
+    if len(pieces) == 0:
+        return soup.select(mask), whole
+    src = np.concatenate([whole, src])
+    order = np.argsort(src, kind="mergesort")
+    return Soup.concat([soup.select(mask), pieces]).take(order), src[order]
+
+
+# # class Tree
+#
+# A BSP tree in the same shape as `CSG.Node`, but stored as arrays. Node `k`
+# has the plane (`normals[k]`, `w[k]`) and the children `front[k]` and
+# `back[k]` (-1 when missing). The polygons of all nodes live in one soup, and
+# `owner[i]` is the node holding polygon `i`.
+#
+class Tree(object):
+
+    def __init__(self, soup=None):
+        self.normals = np.zeros((0, 3))
+        self.w = np.zeros(0)
+        self.front = np.zeros(0, dtype=np.int64)
+        self.back = np.zeros(0, dtype=np.int64)
+        self.soup = Soup.empty()
+        self.owner = np.zeros(0, dtype=np.int64)
+        if soup is not None:
+            self.build(soup)
+
+    def node_count(self):
+        return len(self.w)
+
+    def _add_nodes(self, normals, w):
+        first = self.node_count()
+        missing = np.full(len(w), -1, dtype=np.int64)
+        self.normals = np.concatenate([self.normals, normals])
+        self.w = np.concatenate([self.w, w])
+        self.front = np.concatenate([self.front, missing])
+        self.back = np.concatenate([self.back, missing])
+        return np.arange(first, first + len(w))
+
+    # Return the `side` ("front" or "back") child of every node in `parent`,
+    # creating the missing ones from the plane of the first polygon in
+    # `pieces` that arrives there.
+    def _children(self, side, pieces, parent):
+        missing = np.nonzero(getattr(self, side)[parent] < 0)[0]
+        if len(missing) > 0:
+            parents, first = np.unique(parent[missing], return_index=True)
+            first = missing[first]
+            nodes = self._add_nodes(pieces.normals[first], pieces.w[first])
+            getattr(self, side)[parents] = nodes
+        return getattr(self, side)[parent]
+
+    # Rank of every node in the order `CSG.Node.allPolygons` visits them: from
+    # the root, front subtrees first.
+    def preorder(self):
+        front = self.front.tolist()
+        back = self.back.tolist()
+        rank = [0] * self.node_count()
+        pending = [0] if self.node_count() > 0 else []
+        count = 0
+        while pending:
+            k = pending.pop()
+            rank[k] = count
+            count += 1
+            if back[k] >= 0:
+                pending.append(back[k])
+            if front[k] >= 0:
+                pending.append(front[k])
+        return np.array(rank, dtype=np.int64)
+
+    # Return the polygons of all nodes as a soup, in the order of
+    # `CSG.Node.allPolygons`.
+    def all_polygons(self):
+        if len(self.soup) == 0:
+            return self.soup
+        order = np.argsort(self.preorder()[self.owner], kind="mergesort")
+        return self.soup.take(order)
+
+    # Convert solid space to empty space and empty space to solid space.
+    def invert(self):
+        self.soup = self.soup.flipped()
+        self.normals = -self.normals
+        self.w = -self.w
+        self.front, self.back = self.back, self.front
+
+    # Build a BSP tree out of `soup`. When called on an existing tree, the new
+    # polygons are filtered down to the bottom of the tree and become new nodes
+    # there. Like `CSG.Node.build`, every group of polygons reaching a missing
+    # child is partitioned using its first polygon, and the whole tree is
+    # processed one level at a time.
+    #
+    # Polygons lying on the plane of their node by construction stay there
+    # without being classified, as in `CSG.Node._build`. Planes are not shared
+    # objects here, so those are the polygons whose plane is exactly the one
+    # of the node, such as the polygon it was picked from and its fragments.
+    def build(self, soup):
+        if len(soup) == 0:
+            return
+        if self.node_count() == 0:
+            self._add_nodes(soup.normals[:1], soup.w[:1])
+
+        stored = [self.soup]
+        owners = [self.owner]
+        node = np.zeros(len(soup), dtype=np.int64)
+        while len(soup) > 0:
+            types, facing, front, front_src, back, back_src = split_soup(
+                soup, self.normals[node], self.w[node])
+            own = (soup.w == self.w[node]) & np.all(soup.normals == self.normals[node], axis=1)
+            coplanar = (types == COPLANAR) | own
+            stored.append(soup.select(coplanar))
+            owners.append(node[coplanar])
+
+            if own.any():
+                keep = ~own[front_src]
+                front, front_src = front.select(keep), front_src[keep]
+                keep = ~own[back_src]
+                back, back_src = back.select(keep), back_src[keep]
+            front, front_src = _merge(soup, (types == FRONT) & ~own, front, front_src)
+            back, back_src = _merge(soup, (types == BACK) & ~own, back, back_src)
+            front_node = self._children("front", front, node[front_src])
+            back_node = self._children("back", back, node[back_src])
+
+            soup = Soup.concat([front, back])
+            node = np.concatenate([front_node, back_node])
+
+        self.soup = Soup.concat(stored)
+        self.owner = np.concatenate(owners)
+
+    # Remove all polygons in `soup` that are inside this BSP tree. Returns the
+    # surviving pieces and, for every piece, its index in `soup`.
+    #
+    # The pieces come in the order of `CSG.Node.clipPolygons`: by the node
+    # they leave the tree at, in the order of `preorder`, and then in the order
+    # of `soup`. Two pieces of one polygon never leave at the same node.
+    def clip_soup(self, soup):
+        if self.node_count() == 0 or len(soup) == 0:
+            return soup, np.arange(len(soup))
+
+        kept = [Soup.empty()]
+        kept_src = [np.zeros(0, dtype=np.int64)]
+        kept_node = [np.zeros(0, dtype=np.int64)]
+        node = np.zeros(len(soup), dtype=np.int64)
+        src = np.arange(len(soup))
+        while len(soup) > 0:
+            types, facing, front, front_src, back, back_src = split_soup(
+                soup, self.normals[node], self.w[node])
+            coplanar = types == COPLANAR
+            to_front = (types == FRONT) | (coplanar & facing)
+            to_back = (types == BACK) | (coplanar & ~facing)
+            front = Soup.concat([soup.select(to_front), front])
+            back = Soup.concat([soup.select(to_back), back])
+            front_src = np.concatenate([np.nonzero(to_front)[0], front_src])
+            back_src = np.concatenate([np.nonzero(to_back)[0], back_src])
+            front_node = self.front[node[front_src]]
+            back_node = self.back[node[back_src]]
+
+            leaf = front_node < 0
+            kept.append(front.select(leaf))
+            kept_src.append(src[front_src[leaf]])
+            kept_node.append(node[front_src[leaf]])
+
+            go_front = ~leaf
+            go_back = back_node >= 0
+            soup = Soup.concat([front.select(go_front), back.select(go_back)])
+            src = np.concatenate([src[front_src[go_front]], src[back_src[go_back]]])
+            node = np.concatenate([front_node[go_front], back_node[go_back]])
+
+        kept_src = np.concatenate(kept_src)
+        order = np.lexsort((kept_src, self.preorder()[np.concatenate(kept_node)]))
+        return Soup.concat(kept).take(order), kept_src[order]
+
+    # Remove all polygons in this BSP tree that are inside the other BSP tree
+    # `tree`. With `bounds`, only the polygons touching that box are clipped;
+    # the others are kept as they are, or dropped if `keep_outside` is False.
+    def clip_to(self, tree, bounds=None, keep_outside=True):
+        if bounds is None:
+            self.soup, src = tree.clip_soup(self.soup)
+            self.owner = self.owner[src]
+            return
+
+        inside = self.soup.touches(bounds)
+        clipped, src = tree.clip_soup(self.soup.select(inside))
+        owner = self.owner[inside][src]
+        if keep_outside:
+            outside = ~inside
+            self.soup = Soup.concat([clipped, self.soup.select(outside)])
+            self.owner = np.concatenate([owner, self.owner[outside]])
+        else:
+            self.soup = clipped
+            self.owner = owner
+
+
+# The boolean operations of `CSG`, on soups. See `CSG.union` and friends for
+# the meaning of every step, and `CSG._operate` for `bounds`.
+#
+# The steps and the order of the polygons are the ones of the python engine,
+# so both build the same trees and give the same surface. Only polygons far
+# from the surface of the other solid differ: the python engine keeps them
+# whole (`CSG.Node._keepFar`), while they are clipped like the others here and
+# can come out cut into more pieces.
+def union(a, b, bounds=None):
+    a = Tree(a)
+    b = Tree(b)
+    a.clip_to(b, bounds)
+    b.clip_to(a, bounds)
+    b.invert()
+    b.clip_to(a, bounds)
+    b.invert()
+    a.build(b.all_polygons())
+    return a.all_polygons()
+
+
+def subtract(a, b, bounds=None):
+    a = Tree(a)
+    b = Tree(b)
+    a.invert()
+    a.clip_to(b, bounds)
+    b.clip_to(a, bounds, keep_outside=False)
+    b.invert()
+    b.clip_to(a, bounds, keep_outside=False)
+    a.invert()
+    a.build(b.all_polygons())
+    return a.all_polygons()
+
+
+def intersect(a, b, bounds=None):
+    a = Tree(a)
+    b = Tree(b)
+    a.invert()
+    b.clip_to(a, bounds, keep_outside=False)
+    b.invert()
+    a.clip_to(b, bounds, keep_outside=False)
+    b.clip_to(a, bounds, keep_outside=False)
+    b.invert()
+    a.invert()
+    a.build(b.all_polygons())
+    return a.all_polygons()
+
+
+OPERATIONS = {
+    "union": union,
+    "subtract": subtract,
+    "intersect": intersect,
+}
+
+
+# Run the boolean `op` ("union", "subtract" or "intersect") on two CSG solids.
+def operate(op, csg_a, csg_b, bounds=None):
+    a = Soup.from_polygons(csg_a.polygons)
+    b = Soup.from_polygons(csg_b.polygons)
+    return CSG(OPERATIONS[op](a, b, bounds).to_polygons())
@@ -0,0 +1,184 @@
+# coding: utf-8
+#
+# CSG.Node.clipTo をプロセスプールで並列に実行する
+#
+# The polygons of one BSP tree are clipped against the other tree in chunks,
+# one chunk per task. Nothing is pickled as CSG objects: the clipping tree is
+# sent as flat arrays of planes and child indices, and polygons as flat arrays
+# of coordinates, vertex counts and planes. Every polygon carries its index in
+# the chunk through `shared`, so fragments can be mapped back to the original
+# polygon (and its real `shared` value) when the results come back.
+#
+
+import multiprocessing
+from array import array
+from csg import CSG
+
+# Below this many polygons a clipTo runs in the calling process.
+MIN_POLYGONS = 2000
+
+# Tasks per worker process, to even out chunks that split more than others.
+CHUNKS_PER_PROCESS = 4
+
+
+# # class Pool
+#
+# A process pool for parallel clipping. Pass one (or just a process count) to
+# `CSG.union`, `subtract` and `intersect` as `parallel`. A pool can be reused
+# across many booleans; call `close()` when done.
+class Pool(object):
+
+    def __init__(self, processes=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.pool = multiprocessing.Pool(self.processes)
+
+    def map(self, function, tasks):
+        return self.pool.map(function, tasks)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+# The planes and children of the tree `node` (a `CSG.Node` or a
+# `CSG.FlatTree`) as arrays: node `k` has the plane `planes[4k:4k + 4]`
+# (normal and w) and the children `fronts[k]` and `backs[k]` (-1 when
+# missing). Polygons are not included. An inverted `CSG.FlatTree` is packed
+# flipped.
+def pack_tree(node):
+    tree = node if isinstance(node, CSG.FlatTree) else CSG.FlatTree.fromNode(node)
+    planes = array("d")
+    if not tree.planes[0]:
+        return planes.tostring(), array("i").tostring(), array("i").tostring()
+    for plane in tree.planes:
+        normal = plane.normal
+        planes.extend((normal.x, normal.y, normal.z, plane.w))
+    if tree.inverted:
+        planes = array("d", [-value for value in planes])
+        return planes.tostring(), tree.backs.tostring(), tree.fronts.tostring()
+    return planes.tostring(), tree.fronts.tostring(), tree.backs.tostring()
+
+
+# The `CSG.FlatTree` of `pack_tree`, without polygons.
+def _unpack_tree(packed):
+    planes = array("d")
+    tree = CSG.FlatTree()
+    planes.fromstring(packed[0])
+    tree.fronts.fromstring(packed[1])
+    tree.backs.fromstring(packed[2])
+    for k in xrange(len(tree.fronts)):
+        normal = CSG.Vector(planes[4 * k], planes[4 * k + 1], planes[4 * k + 2])
+        tree.planes.append(CSG.Plane(normal, planes[4 * k + 3]))
+    return tree
+
+
+# Flatten `polygons` into coordinates, vertex counts, planes and, for every
+# polygon, the integer kept in its `shared`.
+def pack_polygons(polygons, shared=None):
+    coords = array("d")
+    counts = array("i")
+    planes = array("d")
+    ids = array("i")
+    for i, p in enumerate(polygons):
+        for v in p.vertices:
+            coords.extend((v.x, v.y, v.z))
+        counts.append(len(p.vertices))
+        normal = p.plane.normal
+        planes.extend((normal.x, normal.y, normal.z, p.plane.w))
+        ids.append(i if shared is None else p.shared)
+    return coords.tostring(), counts.tostring(), planes.tostring(), ids.tostring()
+
+
+# Rebuild the polygons of `pack_polygons`, with the ids as their `shared`.
+def unpack_polygons(packed):
+    coords = array("d")
+    counts = array("i")
+    planes = array("d")
+    ids = array("i")
+    coords.fromstring(packed[0])
+    counts.fromstring(packed[1])
+    planes.fromstring(packed[2])
+    ids.fromstring(packed[3])
+    polygons = []
+    c = 0
+    for i in xrange(len(counts)):
+        vertices = []
+        for v in xrange(counts[i]):
+            vertices.append(CSG.Vector(coords[c], coords[c + 1], coords[c + 2]))
+            c += 3
+        plane = CSG.Plane(CSG.Vector(planes[4 * i], planes[4 * i + 1], planes[4 * i + 2]),
+                          planes[4 * i + 3])
+        polygons.append(CSG.Polygon(vertices, ids[i], plane))
+    return polygons
+
+
+# Worker: clip one chunk of polygons against the packed tree.
+def _clip_chunk(task):
+    packed_tree, packed_polygons, epsilon, robust, flipped = task
+    CSG.Plane_EPSILON = epsilon
+    CSG.Plane_ROBUST = robust
+    tree = _unpack_tree(packed_tree)
+    return pack_polygons(tree.clipPolygons(unpack_polygons(packed_polygons), flipped), shared=True)
+
+
+# Parallel `bsp.clipPolygons(polygons, flipped)`. Returns the surviving
+# polygons with their original `shared` values.
+def clip_polygons(bsp, polygons, pool, flipped=False):
+    if not polygons:
+        return polygons[:]
+    packed_tree = pack_tree(bsp)
+    if not packed_tree[0]:
+        return polygons[:]
+
+    size = max(1, -(-len(polygons) // (pool.processes * CHUNKS_PER_PROCESS)))
+    chunks = [polygons[i:i + size] for i in xrange(0, len(polygons), size)]
+    tasks = [[packed_tree, pack_polygons(chunk), CSG.Plane_EPSILON, CSG.Plane_ROBUST, flipped]
+             for chunk in chunks]
+
+    result = []
+    for chunk, packed in zip(chunks, pool.map(_clip_chunk, tasks)):
+        for p in unpack_polygons(packed):
+            p.shared = chunk[p.shared].shared
+            result.append(p)
+    return result
+
+
+# Parallel `CSG.Node._clipLists`: the polygon lists of all nodes of a tree,
+# `lists`, are clipped against `bsp` in one batch and replaced. With `bvh`,
+# the polygons far from the surface of `bsp` are classified here and only the
+# others are shipped. Returns False, leaving `lists` untouched, when there
+# are too few polygons to be worth shipping to the pool.
+def clip_lists(lists, bsp, pool, bounds=None, keepOutside=True, bvh=None, flipped=False):
+    if sum(len(l) for l in lists) < MIN_POLYGONS:
+        return False
+
+    polygons = []
+    owners = []
+    outside = []
+    far = []
+    for k, l in enumerate(lists):
+        kept = []
+        for p in l:
+            if bounds is not None and not bounds.overlaps(p.bounds()):
+                if keepOutside:
+                    kept.append(p)
+            elif bvh is not None and not bvh.touches(p.bounds(), CSG.Plane_EPSILON):
+                far.append([k, p])
+            else:
+                polygons.append(p)
+                owners.append(k)
+        outside.append(kept)
+        lists[k] = []
+
+    # Tag every polygon with its index so fragments find their owner node.
+    tagged = []
+    for i, p in enumerate(polygons):
+        tagged.append(CSG.Polygon(p.vertices, i, p.plane))
+    for p in clip_polygons(bsp, tagged, pool, flipped):
+        i = p.shared
+        p.shared = polygons[i].shared
+        lists[owners[i]].append(p)
+    for l, kept in zip(lists, outside):
+        l.extend(kept)
+    CSG.Node._keepFar(bsp, far, lists, flipped)
+    return True
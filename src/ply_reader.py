@@ -5,64 +5,610 @@
 #   http://paulbourke.net/dataformats/ply/
 #   http://www.cs.gunma-u.ac.jp/~nagai/wiki/index.php?ply%20%A5%D5%A5%A1%A5%A4%A5%EB%20%A5%D5%A5%A9%A1%BC%A5%DE%A5%C3%A5%C8
 #
+# ascii, binary_little_endian and binary_big_endian are read. Vertex and face
+# blocks are decoded in bulk into a `Solid.VertexArray` and a
+# `Solid.FaceArray` instead of one list per vertex and one `Solid.Face` per
+# face. Faces may repeat their first index at the end (as ply_writer does) or
+# not.
+#
+# Face colors are held as 0..255 whatever their type: float and double colors
+# are taken as 0..1 and scaled.
+#
+# `read_mmap` maps a binary file instead and hands out zero-copy NumPy views of
+# the vertex and face blocks (requires NumPy). `read_chunks` keeps only the
+# vertices and streams the faces out chunk by chunk.
+#
 
-import re
+import itertools
+import mmap
+import struct
+import sys
+from array import array
 from solid import Solid
-from text_reader import TextReader
 
-def read(filename):
-    io = TextReader(filename)
-    if not io.readline() == "ply":
-        assert False, "file does not start ply: filename=%s" % filename
-    if not io.readline() == "format ascii 1.0":
-        assert False, "file is not ascii: filename=%s" % filename
+FORMATS = {"ascii": None, "binary_little_endian": "<", "binary_big_endian": ">"}
+
+# PLY type -> struct / array type code
+TYPES = {
+    "char": "b", "int8": "b", "uchar": "B", "uint8": "B",
+    "short": "h", "int16": "h", "ushort": "H", "uint16": "H",
+    "int": "i", "int32": "i", "uint": "I", "uint32": "I",
+    "float": "f", "float32": "f", "double": "d", "float64": "d",
+}
+
+# Records decoded per struct.unpack call.
+CHUNK = 4096
+
+
+# An element of the header. Every property is (name, type, count_type), with
+# count_type None for a scalar and the type of the count for a list.
+class Element(object):
+
+    def __init__(self, name, count):
+        self.name = name
+        self.count = count
+        self.properties = []
+
+    def names(self):
+        return [p[0] for p in self.properties]
+
+    def is_fixed(self):
+        return all(p[2] is None for p in self.properties)
 
-    vertex_count = 0
-    face_count = 0
-    has_color = False
 
+def read_header(io, filename):
+    if not io.readline().rstrip("\r\n") == "ply":
+        assert False, "file does not start ply: filename=%s" % filename
+
+    format = None
+    elements = []
     while True:
         line = io.readline()
-        if line == "end_header":
+        if not line:
+            assert False, "no end_header: filename=%s" % filename
+        items = line.split()
+        if not items:
+            continue
+        if items[0] == "end_header":
             break
+        if items[0] == "format":
+            format = items[1]
+            if format not in FORMATS:
+                assert False, "unknown format=%s: filename=%s" % (format, filename)
+        elif items[0] == "element":
+            elements.append(Element(items[1], int(items[2])))
+        elif items[0] == "property":
+            if items[1] == "list":
+                elements[-1].properties.append((items[4], TYPES[items[3]], TYPES[items[2]]))
+            else:
+                elements[-1].properties.append((items[2], TYPES[items[1]], None))
 
-        if line == "property uchar red":
-            has_color = True
+    if format is None:
+        assert False, "no format: filename=%s" % filename
+    return format, elements
 
-        match = re.match(r"element vertex (\d+)", line)
-        if match:
-            vertex_count = int(match.group(1))
-            continue
 
-        match = re.match(r"element face (\d+)", line)
-        if match:
-            face_count = int(match.group(1))
-            continue
+def read(filename, mmap=False):
+    if mmap:
+        return read_mmap(filename)
 
-    if vertex_count == 0:
+    io = open(filename, "rb")
+    format, elements = read_header(io, filename)
+    data = io.read()
+    io.close()
+
+    counts = dict((e.name, e.count) for e in elements)
+    if counts.get("vertex", 0) == 0:
         assert False, "no vertex"
 
+    endian = FORMATS[format]
     solid = Solid()
-    for i in xrange(vertex_count):
-        line = io.readline()
-        items = line.split(" ")
-        solid.append_vertex([float(items[0]), float(items[1]), float(items[2])])
+    if endian is None:
+        _read_ascii(data.split(), elements, solid)
+    else:
+        _read_binary(data, endian, elements, solid)
+    return solid
 
-    for i in xrange(face_count):
-        line = io.readline()
-        items = line.split(" ")
-        count = int(items[0]) - 1
-        indices = []
-        color = None
-        for v in xrange(count):
-            indices.append(int(items[v + 1]))
 
-        if has_color:
-            color = []
-            for c in xrange(count, count + 3):
-                color.append(int(items[c + 2]))
+# Interleave the x, y and z columns of `values` (`stride` values per vertex)
+# into one flat array('d').
+def _coords(values, names, stride, count):
+    if names[:3] == ["x", "y", "z"] and stride == 3:
+        return array("d", values)
+    coords = array("d", [0.0]) * (count * 3)
+    for d, name in enumerate(["x", "y", "z"]):
+        if name not in names:
+            assert False, "no vertex property %s" % name
+        coords[d::3] = array("d", values[names.index(name)::stride])
+    return coords
+
+
+# Fill `faces` from per-face columns: `columns` holds the `n` index columns,
+# `colors` the red, green and blue columns (or None).
+def _fill_faces(faces, count, n, columns, colors):
+    if n > 3 and columns[0] == columns[n - 1]:
+        n -= 1
+    elif n > 3 and any(a == b for a, b in zip(columns[0], columns[n - 1])):
+        for i in xrange(count):
+            _append_face(faces, [c[i] for c in columns], [c[i] for c in colors] if colors else None)
+        return
+
+    flat = [0] * (count * n)
+    for k in xrange(n):
+        flat[k::n] = columns[k]
+    faces.indices.extend(array("i", flat))
+    faces.offsets.extend(xrange(n, count * n + 1, n))
+    if colors:
+        flat = [0] * (count * 3)
+        for k in xrange(3):
+            flat[k::3] = colors[k]
+        faces.colors = array("h", flat)
+
+
+# Same as `faces.append(Solid.Face(loop, color))` without the Face.
+def _append_face(faces, loop, color):
+    if len(loop) > 3 and loop[0] == loop[-1]:
+        loop = loop[:-1]
+    faces.indices.extend(loop)
+    faces.offsets.append(len(faces.indices))
+    if color is not None:
+        if faces.colors is None:
+            faces.colors = array("h", [-1]) * (len(faces) * 3 - 3)
+        faces.colors.extend(color)
+    elif faces.colors is not None:
+        faces.colors.extend((-1, -1, -1))
+
+
+# A float color (0..1) as a 0..255 one; `value` may be a token.
+def _scale_color(value):
+    return max(0, min(255, int(round(float(value) * 255.0))))
+
+
+# Index of the vertex index list and of the colors of a face element, and the
+# function turning a value (or token) of each color into 0..255.
+def _face_layout(element):
+    names = element.names()
+    index = None
+    for name in ("vertex_indices", "vertex_index"):
+        if name in names:
+            index = names.index(name)
+    if index is None or element.properties[index][2] is None:
+        assert False, "no vertex_indices list in face element"
+    colors = None
+    converts = None
+    if all(c in names for c in ("red", "green", "blue")):
+        colors = [names.index(c) for c in ("red", "green", "blue")]
+        converts = [_scale_color if element.properties[c][1] in "fd" else int for c in colors]
+    return index, colors, converts
+
+
+# The 0..255 color of a face from its `values`.
+def _color(values, colors, converts):
+    return [convert(values[c]) for c, convert in zip(colors, converts)]
+
+
+def _read_ascii(tokens, elements, solid):
+    pos = 0
+    for element in elements:
+        if element.name == "vertex":
+            assert element.is_fixed(), "list property in vertex element"
+            stride = len(element.properties)
+            values = map(float, tokens[pos:pos + element.count * stride])
+            solid.vertices = Solid.VertexArray(
+                _coords(values, element.names(), stride, element.count))
+            pos += element.count * stride
+        elif element.name == "face":
+            pos = _read_ascii_faces(tokens, pos, element, solid)
+        elif element.is_fixed():
+            pos += element.count * len(element.properties)
+        else:
+            for i in xrange(element.count):
+                for p in element.properties:
+                    pos += 1 + (int(tokens[pos]) if p[2] else 0)
+
+
+def _read_ascii_faces(tokens, pos, element, solid):
+    faces = Solid.FaceArray()
+    solid.faces = faces
+    count = element.count
+    if count == 0:
+        return pos
+    index, colors, converts = _face_layout(element)
+    lists = [p[2] is not None for p in element.properties]
+
+    # Every face has the same number of indices when the count of each face
+    # sits one record further than the one before: the whole block can then
+    # be cut into columns by slicing.
+    if sum(lists) == 1:
+        head = index
+        first = tokens[pos + head]
+        n = int(first)
+        stride = len(element.properties) + n
+        end = pos + count * stride
+        if end <= len(tokens) and all(c == first for c in tokens[pos + head:end:stride]):
+            columns = []
+            for k in xrange(n):
+                columns.append(map(int, tokens[pos + head + 1 + k:end:stride]))
+
+            def column(p, convert):
+                offset = p if p < index else p + n
+                return map(convert, tokens[pos + offset:end:stride])
+            _fill_faces(faces, count, n, columns,
+                        map(column, colors, converts) if colors else None)
+            return end
+
+    for i in xrange(count):
+        values = []
+        for is_list in lists:
+            if is_list:
+                n = int(tokens[pos])
+                values.append(tokens[pos + 1:pos + 1 + n])
+                pos += 1 + n
+            else:
+                values.append(tokens[pos])
+                pos += 1
+        _append_face(faces, map(int, values[index]),
+                     _color(values, colors, converts) if colors else None)
+    return pos
+
+
+# Decode `count` records of struct format `record` (without byte order) from
+# `data` at `pos` into one flat sequence.
+def _unpack(data, pos, endian, record, count):
+    if len(set(record)) == 1:
+        values = array(record[0])
+        values.fromstring(data[pos:pos + count * struct.calcsize("=" + record)])
+        if not endian == ("<" if sys.byteorder == "little" else ">"):
+            values.byteswap()
+        return values
+
+    values = []
+    size = struct.calcsize(endian + record)
+    chunk = struct.Struct(endian + record * CHUNK)
+    for start in xrange(0, count, CHUNK):
+        n = min(CHUNK, count - start)
+        if n < CHUNK:
+            chunk = struct.Struct(endian + record * n)
+        values.extend(chunk.unpack_from(data, pos + start * size))
+    return values
+
 
-        solid.append_plane(indices, color)
+def _read_binary(data, endian, elements, solid):
+    pos = 0
+    for element in elements:
+        if element.name == "vertex":
+            assert element.is_fixed(), "list property in vertex element"
+            record = "".join(p[1] for p in element.properties)
+            values = _unpack(data, pos, endian, record, element.count)
+            solid.vertices = Solid.VertexArray(
+                _coords(values, element.names(), len(record), element.count))
+            pos += element.count * struct.calcsize(endian + record)
+        elif element.name == "face":
+            pos = _read_binary_faces(data, pos, endian, element, solid)
+        else:
+            pos = _skip_binary(data, pos, endian, element)
 
+
+def _skip_binary(data, pos, endian, element):
+    if element.is_fixed():
+        return pos + element.count * struct.calcsize(endian + "".join(p[1] for p in element.properties))
+    for i in xrange(element.count):
+        for name, type, count_type in element.properties:
+            if count_type:
+                n = struct.unpack_from(endian + count_type, data, pos)[0]
+                pos += struct.calcsize(endian + count_type) + n * struct.calcsize(endian + type)
+            else:
+                pos += struct.calcsize(endian + type)
+    return pos
+
+
+def _read_binary_faces(data, pos, endian, element, solid):
+    faces = Solid.FaceArray()
+    solid.faces = faces
+    count = element.count
+    if count == 0:
+        return pos
+    index, colors, converts = _face_layout(element)
+
+    # Same idea as the ascii reader: if every face has as many indices as
+    # the first one, the block is made of fixed records and can be unpacked in
+    # bulk. The counts decoded from every record prove that it is.
+    if sum(1 for p in element.properties if p[2]) == 1:
+        head = "".join(p[1] for p in element.properties[:index])
+        name, type, count_type = element.properties[index]
+        n = struct.unpack_from(endian + count_type, data, pos + struct.calcsize(endian + head))[0]
+        tail = "".join(p[1] for p in element.properties[index + 1:])
+        record = head + count_type + type * n + tail
+        size = struct.calcsize(endian + record)
+        if pos + count * size <= len(data):
+            values = _unpack(data, pos, endian, record, count)
+            stride = len(record)
+            if all(c == n for c in values[len(head)::stride]):
+                first = len(head) + 1
+                columns = [values[first + k::stride] for k in xrange(n)]
+
+                def column(p, convert):
+                    offset = p if p < index else p + n
+                    return values[offset::stride] if convert is int else map(convert, values[offset::stride])
+                _fill_faces(faces, count, n, columns,
+                            map(column, colors, converts) if colors else None)
+                return pos + count * size
+
+    for i in xrange(count):
+        values, pos = _unpack_face(data, pos, endian, element)
+        _append_face(faces, values[index], _color(values, colors, converts) if colors else None)
+    return pos
+
+
+# Values of the face record at `pos` (a tuple for a list) and the position
+# after it.
+def _unpack_face(data, pos, endian, element):
+    values = []
+    for name, type, count_type in element.properties:
+        if count_type:
+            n = struct.unpack_from(endian + count_type, data, pos)[0]
+            pos += struct.calcsize(endian + count_type)
+            values.append(struct.unpack_from(endian + type * n, data, pos))
+            pos += struct.calcsize(endian + type * n)
+        else:
+            values.append(struct.unpack_from(endian + type, data, pos)[0])
+            pos += struct.calcsize(endian + type)
+    return values, pos
+
+
+# Read a binary PLY file through mmap. Vertices become a `Solid.VertexView` and
+# faces a `Solid.FaceView` over the mapped file, so no Python object is made
+# per vertex or face; blocks that cannot be viewed (x, y and z not next to each
+# other, faces of different sizes) are decoded as `read` does. The solid is
+# read-only. ascii files are read with `read`.
+def read_mmap(filename):
+    import numpy
+
+    io = open(filename, "rb")
+    format, elements = read_header(io, filename)
+    pos = io.tell()
+    endian = FORMATS[format]
+    if endian is None:
+        io.close()
+        return read(filename)
+    data = mmap.mmap(io.fileno(), 0, access=mmap.ACCESS_READ)
     io.close()
+
+    if dict((e.name, e.count) for e in elements).get("vertex", 0) == 0:
+        assert False, "no vertex"
+
+    solid = Solid()
+    for element in elements:
+        if element.name == "vertex":
+            pos = _view_vertices(numpy, data, pos, endian, element, solid)
+        elif element.name == "face":
+            pos = _view_faces(numpy, data, pos, endian, element, solid)
+        else:
+            pos = _skip_binary(data, pos, endian, element)
     return solid
+
+
+# An (count, 3) view of `data` from the fields `names` of records of `size`
+# bytes, or None when the fields are not adjacent and of one type.
+def _view_columns(numpy, data, pos, endian, element, names, count, size, offsets):
+    properties = element.names()
+    if not all(name in properties for name in names):
+        return None
+    first = properties.index(names[0])
+    types = [element.properties[first + k][1] for k in xrange(len(names))]
+    if not properties[first:first + len(names)] == names or len(set(types)) > 1:
+        return None
+    dtype = numpy.dtype(endian + types[0])
+    return numpy.ndarray((count, len(names)), dtype, data, pos + offsets[first],
+                         (size, dtype.itemsize))
+
+
+def _offsets(endian, record):
+    return [struct.calcsize(endian + record[:k]) for k in xrange(len(record) + 1)]
+
+
+def _view_vertices(numpy, data, pos, endian, element, solid):
+    assert element.is_fixed(), "list property in vertex element"
+    record = "".join(p[1] for p in element.properties)
+    offsets = _offsets(endian, record)
+    size = offsets[-1]
+    view = _view_columns(numpy, data, pos, endian, element, ["x", "y", "z"],
+                         element.count, size, offsets)
+    if view is None:
+        values = _unpack(data, pos, endian, record, element.count)
+        solid.vertices = Solid.VertexArray(
+            _coords(values, element.names(), len(record), element.count))
+    else:
+        solid.vertices = Solid.VertexView(view)
+    return pos + element.count * size
+
+
+def _view_faces(numpy, data, pos, endian, element, solid):
+    count = element.count
+    if count == 0 or not sum(1 for p in element.properties if p[2]) == 1:
+        return _read_binary_faces(data, pos, endian, element, solid)
+    index, colors, converts = _face_layout(element)
+
+    # Lay the face records out as fixed records, with the list as `n` fields,
+    # and check every count before trusting the view.
+    head = "".join(p[1] for p in element.properties[:index])
+    name, type, count_type = element.properties[index]
+    n = struct.unpack_from(endian + count_type, data, pos + struct.calcsize(endian + head))[0]
+    tail = "".join(p[1] for p in element.properties[index + 1:])
+    record = head + count_type + type * n + tail
+    offsets = _offsets(endian, record)
+    size = offsets[-1]
+    if pos + count * size > len(data):
+        return _read_binary_faces(data, pos, endian, element, solid)
+    counts = numpy.ndarray((count,), numpy.dtype(endian + count_type), data,
+                           pos + offsets[len(head)], (size,))
+    if not (counts == n).all():
+        return _read_binary_faces(data, pos, endian, element, solid)
+
+    dtype = numpy.dtype(endian + type)
+    loops = numpy.ndarray((count, n), dtype, data, pos + offsets[len(head) + 1],
+                          (size, dtype.itemsize))
+    if n > 3:
+        closed = loops[:, 0] == loops[:, n - 1]
+        if closed.all():
+            loops = loops[:, :n - 1]
+        elif closed.any():
+            return _read_binary_faces(data, pos, endian, element, solid)
+
+    view = None
+    if colors:
+        # The list takes n + 1 fields of the record instead of one.
+        fields = [p if p < index else p + n for p in xrange(len(element.properties))]
+        view = _view_columns(numpy, data, pos, endian, element, ["red", "green", "blue"],
+                             count, size, [offsets[f] for f in fields])
+        if view is None:
+            view = numpy.column_stack([
+                numpy.ndarray((count,), numpy.dtype(endian + element.properties[c][1]), data,
+                              pos + offsets[fields[c]], (size,)) for c in colors])
+        if not all(convert is int for convert in converts):
+            view = numpy.column_stack([
+                numpy.clip(numpy.rint(view[:, k] * 255.0), 0, 255) if convert is not int
+                else view[:, k] for k, convert in enumerate(converts)]).astype("h")
+    solid.faces = Solid.FaceView(loops, view)
+    return pos + count * size
+
+
+# PLY ファイルの面を少しずつ読む
+#
+# Returns (vertices, chunks): the vertices as a `Solid.VertexArray`, and a
+# generator of lists of up to `size` faces, each face an (indices, color)
+# pair with the indices without the closing index. Only one chunk of faces is
+# resident at a time. Binary files are read through mmap; ascii files are
+# read line by line and must have one element per line.
+def read_chunks(filename, size=CHUNK):
+    io = open(filename, "rb")
+    format, elements = read_header(io, filename)
+    endian = FORMATS[format]
+    names = [e.name for e in elements]
+    if "vertex" not in names or elements[names.index("vertex")].count == 0:
+        assert False, "no vertex"
+    if "face" in names and names.index("face") < names.index("vertex"):
+        assert False, "faces before vertices: filename=%s" % filename
+
+    if endian is None:
+        vertices = None
+        for element in elements:
+            if element.name == "vertex":
+                vertices = _read_ascii_vertex_lines(io, element, size)
+            elif element.name == "face":
+                return vertices, _ascii_face_chunks(io, element, size)
+            else:
+                for line in itertools.islice(io, element.count):
+                    pass
+        io.close()
+        return vertices, iter([])
+
+    pos = io.tell()
+    data = mmap.mmap(io.fileno(), 0, access=mmap.ACCESS_READ)
+    io.close()
+    vertices = None
+    for element in elements:
+        if element.name == "vertex":
+            assert element.is_fixed(), "list property in vertex element"
+            record = "".join(p[1] for p in element.properties)
+            values = _unpack(data, pos, endian, record, element.count)
+            vertices = Solid.VertexArray(_coords(values, element.names(), len(record), element.count))
+            pos += element.count * struct.calcsize(endian + record)
+        elif element.name == "face":
+            return vertices, _binary_face_chunks(data, pos, endian, element, size)
+        else:
+            pos = _skip_binary(data, pos, endian, element)
+    return vertices, iter([])
+
+
+def _read_ascii_vertex_lines(io, element, size):
+    assert element.is_fixed(), "list property in vertex element"
+    names = element.names()
+    stride = len(names)
+    coords = array("d")
+    remaining = element.count
+    while remaining > 0:
+        lines = list(itertools.islice(io, min(size, remaining)))
+        if not lines:
+            assert False, "file ends in vertex element"
+        remaining -= len(lines)
+        values = map(float, "".join(lines).split())
+        coords.extend(_coords(values, names, stride, len(lines)))
+    return Solid.VertexArray(coords)
+
+
+def _open_loop(loop):
+    if len(loop) > 3 and loop[0] == loop[-1]:
+        return loop[:-1]
+    return loop
+
+
+def _ascii_face_chunks(io, element, size):
+    index, colors, converts = _face_layout(element)
+    lists = [p[2] is not None for p in element.properties]
+    remaining = element.count
+    try:
+        while remaining > 0:
+            lines = list(itertools.islice(io, min(size, remaining)))
+            if not lines:
+                assert False, "file ends in face element"
+            remaining -= len(lines)
+            chunk = []
+            for line in lines:
+                tokens = line.split()
+                pos = 0
+                values = []
+                for is_list in lists:
+                    if is_list:
+                        n = int(tokens[pos])
+                        values.append(tokens[pos + 1:pos + 1 + n])
+                        pos += 1 + n
+                    else:
+                        values.append(tokens[pos])
+                        pos += 1
+                color = _color(values, colors, converts) if colors else None
+                chunk.append((_open_loop(map(int, values[index])), color))
+            yield chunk
+    finally:
+        io.close()
+
+
+def _binary_face_chunks(data, pos, endian, element, size):
+    index, colors, converts = _face_layout(element)
+    single = sum(1 for p in element.properties if p[2]) == 1
+    head = "".join(p[1] for p in element.properties[:index])
+    name, type, count_type = element.properties[index]
+    tail = "".join(p[1] for p in element.properties[index + 1:])
+    done = 0
+    while done < element.count:
+        k = min(size, element.count - done)
+        chunk = None
+
+        # Try the chunk as k fixed records sized after its first face.
+        if single:
+            n = struct.unpack_from(endian + count_type, data, pos + struct.calcsize(endian + head))[0]
+            record = head + count_type + type * n + tail
+            record_size = struct.calcsize(endian + record)
+            if pos + k * record_size <= len(data):
+                values = _unpack(data, pos, endian, record, k)
+                stride = len(record)
+                if all(c == n for c in values[len(head)::stride]):
+                    first = len(head) + 1
+                    loops = zip(*[values[first + j::stride] for j in xrange(n)])
+                    if colors:
+                        fields = [c if c < index else c + n for c in colors]
+                        chunk = zip([_open_loop(list(loop)) for loop in loops],
+                                    [_color(c, range(3), converts)
+                                     for c in zip(*[values[f::stride] for f in fields])])
+                    else:
+                        chunk = [(_open_loop(list(loop)), None) for loop in loops]
+                    pos += k * record_size
+
+        if chunk is None:
+            chunk = []
+            for i in xrange(k):
+                values, pos = _unpack_face(data, pos, endian, element)
+                color = _color(values, colors, converts) if colors else None
+                chunk.append((_open_loop(list(values[index])), color))
+        done += k
+        yield chunk
@@ -5,16 +5,48 @@
 #   http://paulbourke.net/dataformats/ply/
 #   http://www.cs.gunma-u.ac.jp/~nagai/wiki/index.php?ply%20%A5%D5%A5%A1%A5%A4%A5%EB%20%A5%D5%A5%A9%A1%BC%A5%DE%A5%C3%A5%C8
 #
+# Vertex and face blocks are formatted `CHUNK` records at a time: one string
+# format (ascii) or one struct.pack (binary) per chunk instead of one per line.
+# ascii faces repeat their first index at the end as before; binary faces are
+# written as plain loops.
+#
+
+import itertools
+import struct
+import sys
+from array import array
+from solid import Solid
+
+FORMATS = {"ascii": None, "binary_little_endian": "<", "binary_big_endian": ">"}
+
+# Records formatted at a time.
+CHUNK = 4096
+
+# Color of faces without one, when other faces have one.
+DEFAULT_COLOR = [255, 255, 255]
+
 
 class PLYWriter:
 
-    def __init__(self, filename):
-        self.io = open(filename, "w")
+    def __init__(self, filename, format="ascii"):
+        if format not in FORMATS:
+            assert False, "unknown format=%s" % format
+        self.io = open(filename, "wb")
+        self.format = format
+        self.endian = FORMATS[format]
         self.vertex_color = None
         self.face_color = None
 
     def close(self):
-        self.io.close
+        if self.io:
+            self.io.close()
+            self.io = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
 
     def _write_header_color(self):
         self.io.write("""property uchar red
@@ -22,21 +54,15 @@ property uchar green
 property uchar blue
 """)
 
-    def _append_color(self, line, color):
-        if not color == None:
-            return line + " %d %d %d" % (color[0], color[1], color[2])
-        else:
-            return line
-
-    def write_header(self, vertex_count, face_count = 0):
+    def write_header(self, vertex_count, face_count = 0, face_color = None):
         self.io.write("""ply
-format ascii 1.0
+format %s 1.0
 comment made by washi
 element vertex %d
 property double x
 property double y
 property double z
-""" % (vertex_count))
+""" % (self.format, vertex_count))
 
         if self.vertex_color:
             self._write_header_color()
@@ -45,26 +71,204 @@ property double z
             self.io.write("""element face %d
 property list uchar int vertex_index
 """ % (face_count))
-        
-            if self.face_color:
+
+            if self.face_color if face_color is None else face_color:
                 self._write_header_color()
 
         self.io.write("end_header\n")
 
     def write_solid(self, solid):
-        vertex_count = len(solid.vertices)
-        face_count = len(solid.faces)
-        self.write_header(vertex_count, face_count)
-       
-        for v in solid.vertices:
-            line = "%f %f %f" % (v[0], v[1], v[2])
-            line = self._append_color(line, self.vertex_color)
-            self.io.write(line + "\n")
-       
-        for face in solid.faces:
-            line = "%d" % len(face.indices)
-            for v in face.indices:
-                line += " %d" % v
-            line = self._append_color(line, self.face_color if face.color == None else face.color)
-            self.io.write(line + "\n")
+        faces = solid.faces
+        blocks = None
+        closed = False
+        if isinstance(faces, (Solid.FaceArray, Solid.FaceView)):
+            blocks = _face_blocks(faces)
+            loops = faces.loops()
+            colored = faces.colors is not None
+        else:
+            loops = ((f.indices, f.color) for f in faces)
+            closed = True
+            colored = any(f.color is not None for f in faces)
+
+        colored = colored or bool(self.face_color)
+        self.write_header(len(solid.vertices), len(faces), colored)
+        self._write_vertices(_vertex_chunks(solid.vertices))
+        if blocks:
+            self._write_face_blocks(blocks, colored)
+        else:
+            self._write_faces(loops, colored, closed)
+
+    # Write the polygons of the CSG solid `csg` without building a Solid.
+    # Every polygon gets its own vertices, and its `shared` is taken as its
+    # color (r, g, b in 0..1, as made by csg_builder.csg_from_solid) when it
+    # is one. With `as_tri`, polygons are written as triangle fans.
+    def write_csg(self, csg, as_tri=False):
+        polygons = csg.polygons
+        vertex_count = 0
+        face_count = 0
+        colored = bool(self.face_color)
+        for p in polygons:
+            n = len(p.vertices)
+            vertex_count += n
+            face_count += n - 2 if as_tri else 1
+            colored = colored or _color(p.shared) is not None
+
+        self.write_header(vertex_count, face_count, colored)
+        self._write_vertices(_polygon_vertex_chunks(polygons))
+        self._write_faces(_polygon_loops(polygons, as_tri), colored)
 
+    def _write_vertices(self, chunks):
+        color = self.vertex_color
+        for coords in chunks:
+            count = len(coords) // 3
+            if self.endian is None:
+                line = "%f %f %f"
+                if color:
+                    line += " %d %d %d" % (color[0], color[1], color[2])
+                self.io.write((line + "\n") * count % tuple(coords))
+            elif color:
+                values = []
+                tail = (color[0], color[1], color[2])
+                for k in xrange(0, len(coords), 3):
+                    values.extend(coords[k:k + 3])
+                    values.extend(tail)
+                self.io.write(struct.pack(self.endian + "dddBBB" * count, *values))
+            else:
+                coords = array("d", coords)
+                if not self.endian == ("<" if sys.byteorder == "little" else ">"):
+                    coords.byteswap()
+                self.io.write(coords.tostring())
+
+    # `loops` yields (indices, color) per face, color None for the default
+    # color. The indices repeat the first one at the end when `closed` (as in
+    # Solid.Face), and do not otherwise.
+    def _write_faces(self, loops, colored, closed=False):
+        default = self.face_color or DEFAULT_COLOR
+        default = (default[0], default[1], default[2])
+        ascii = self.endian is None
+        formats = {}
+        while True:
+            chunk = list(itertools.islice(loops, CHUNK))
+            if not chunk:
+                break
+            # Number of indices written per face.
+            layout = []
+            values = []
+            for indices, color in chunk:
+                if ascii and not closed:
+                    indices = list(indices)
+                    indices.append(indices[0])
+                elif not ascii and closed and len(indices) > 3 and indices[0] == indices[-1]:
+                    indices = indices[:-1]
+                m = len(indices)
+                layout.append(m)
+                values.append(m)
+                values.extend(indices)
+                if colored:
+                    values.extend(default if color is None else color[:3])
+
+            for m in set(layout):
+                if m not in formats:
+                    if ascii:
+                        formats[m] = " ".join(["%d"] * (m + 1)) + (" %d %d %d" if colored else "") + "\n"
+                    else:
+                        formats[m] = "B" + "i" * m + ("BBB" if colored else "")
+            if ascii:
+                self.io.write("".join(formats[m] for m in layout) % tuple(values))
+            else:
+                self.io.write(struct.pack(self.endian + "".join(formats[m] for m in layout), *values))
+
+    # Faces that all have `n` indices, from `blocks` of (n, indices, colors)
+    # with flat indices and flat colors (or None for the default color). The
+    # values of a chunk are laid out by strided slice assignment.
+    def _write_face_blocks(self, blocks, colored):
+        default = self.face_color or DEFAULT_COLOR
+        ascii = self.endian is None
+        for n, indices, colors in blocks:
+            count = len(indices) // n
+            head = n + 2 if ascii else n + 1
+            width = head + (3 if colored else 0)
+            values = [n + 1 if ascii else n] * (count * width)
+            for k in xrange(n):
+                values[1 + k::width] = indices[k::n]
+            if ascii:
+                values[n + 1::width] = indices[0::n]
+            if colored:
+                for k in xrange(3):
+                    values[head + k::width] = colors[k::3] if colors else [default[k]] * count
+
+            if ascii:
+                line = " ".join(["%d"] * width) + "\n"
+                self.io.write(line * count % tuple(values))
+            else:
+                record = "B" + "i" * n + ("BBB" if colored else "")
+                self.io.write(struct.pack(self.endian + record * count, *values))
+
+
+# Chunks of (n, indices, colors) of a Solid.FaceArray or Solid.FaceView whose
+# faces all have n indices, or None when they do not.
+def _face_blocks(faces):
+    count = len(faces)
+    if count == 0:
+        return None
+    if isinstance(faces, Solid.FaceView):
+        n = faces.indices.shape[1]
+        return ((n, faces.indices[k:k + CHUNK].ravel().tolist(),
+                 None if faces.colors is None else faces.colors[k:k + CHUNK].ravel().tolist())
+                for k in xrange(0, count, CHUNK))
+
+    n = faces.offsets[1]
+    if not faces.offsets == array(faces.offsets.typecode, xrange(0, n * count + 1, n)):
+        return None
+    if faces.colors is not None and min(faces.colors) < 0:
+        return None
+    return ((n, faces.indices[k * n:(k + CHUNK) * n].tolist(),
+             None if faces.colors is None else faces.colors[k * 3:(k + CHUNK) * 3].tolist())
+            for k in xrange(0, count, CHUNK))
+
+
+def _color(shared):
+    if isinstance(shared, (list, tuple)) and len(shared) == 3:
+        return [int(round(c * 255)) for c in shared]
+    return None
+
+
+def _vertex_chunks(vertices):
+    if isinstance(vertices, Solid.VertexArray):
+        coords = vertices.coords
+        for k in xrange(0, len(coords), CHUNK * 3):
+            yield coords[k:k + CHUNK * 3]
+        return
+    vertices = iter(vertices)
+    while True:
+        chunk = list(itertools.islice(vertices, CHUNK))
+        if not chunk:
+            break
+        yield [c for v in chunk for c in v[:3]]
+
+
+def _polygon_vertex_chunks(polygons):
+    coords = []
+    for p in polygons:
+        for v in p.vertices:
+            coords.append(v.x)
+            coords.append(v.y)
+            coords.append(v.z)
+        if len(coords) >= CHUNK * 3:
+            yield coords
+            coords = []
+    if coords:
+        yield coords
+
+
+def _polygon_loops(polygons, as_tri):
+    i = 0
+    for p in polygons:
+        n = len(p.vertices)
+        color = _color(p.shared)
+        if as_tri:
+            for k in xrange(2, n):
+                yield [i, i + k - 1, i + k], color
+        else:
+            yield range(i, i + n), color
+        i += n
@@ -1,8 +1,14 @@
 # coding:utf-8
 # 頂点と面をまとめたもの
 
+import math
+from array import array
+
 class Solid:
 
+    # `weld` で同じ頂点とみなす距離 (各軸)
+    WELD_TOLERANCE = 1e-6
+
     # 面
     class Face:
         # indices は反時計回りが表 (CSG.js とは逆)
@@ -20,6 +26,185 @@ class Solid:
         def clone(self):
             return Solid.Face(self.indices[:], self.color[:] if self.color else None)
 
+    # 頂点を配列にまとめて持つもの
+    #
+    # Drop-in replacement for the list of [x, y, z] lists in `vertices`: the
+    # coordinates are kept flat in `coords` (an array('d'), or any other flat
+    # sequence such as a NumPy view), and `vertices[i]` returns a new
+    # [x, y, z] list.
+    class VertexArray(object):
+
+        def __init__(self, coords=None):
+            self.coords = array("d") if coords is None else coords
+
+        def __len__(self):
+            return len(self.coords) // 3
+
+        def __getitem__(self, i):
+            if i < 0:
+                i += len(self)
+            c = self.coords
+            k = i * 3
+            return [c[k], c[k + 1], c[k + 2]]
+
+        def __iter__(self):
+            c = self.coords
+            for k in xrange(0, len(c) - 2, 3):
+                yield [c[k], c[k + 1], c[k + 2]]
+
+        def append(self, vertex):
+            self.coords.extend((vertex[0], vertex[1], vertex[2]))
+
+        def extend(self, vertices):
+            for v in vertices:
+                self.append(v)
+
+        def __iadd__(self, vertices):
+            self.extend(vertices)
+            return self
+
+    # 面を配列にまとめて持つもの
+    #
+    # Drop-in replacement for the list of `Solid.Face` in `faces`. The loops
+    # are kept flat in `indices` (without the closing index), face `i` being
+    # `indices[offsets[i]:offsets[i + 1]]`; `colors` holds r, g, b per face
+    # (-1 for a face without color), or is None when no face has a color.
+    # `faces[i]` returns a new `Solid.Face`, so changing it does not change
+    # the array.
+    class FaceArray(object):
+
+        def __init__(self, indices=None, offsets=None, colors=None):
+            self.indices = array("i") if indices is None else indices
+            self.offsets = array("l", [0]) if offsets is None else offsets
+            self.colors = colors
+
+        def __len__(self):
+            return len(self.offsets) - 1
+
+        def loop(self, i):
+            return self.indices[self.offsets[i]:self.offsets[i + 1]]
+
+        def color(self, i):
+            if self.colors is None or self.colors[i * 3] < 0:
+                return None
+            return list(self.colors[i * 3:i * 3 + 3])
+
+        def __getitem__(self, i):
+            if i < 0:
+                i += len(self)
+            if not 0 <= i < len(self):
+                raise IndexError("face index out of range")
+            return Solid.Face(list(self.loop(i)), self.color(i))
+
+        def __iter__(self):
+            for i in xrange(len(self)):
+                yield Solid.Face(list(self.loop(i)), self.color(i))
+
+        # (indices, color) of every face, without building a Face.
+        def loops(self):
+            indices = self.indices
+            offsets = self.offsets
+            for i in xrange(len(self)):
+                yield indices[offsets[i]:offsets[i + 1]].tolist(), self.color(i)
+
+        def append(self, face):
+            indices = face.indices
+            if len(indices) > 3 and indices[0] == indices[-1]:
+                indices = indices[:-1]
+            if face.color is not None and self.colors is None:
+                self.colors = array("h", [-1]) * (len(self) * 3)
+            self.indices.extend(indices)
+            self.offsets.append(len(self.indices))
+            if self.colors is not None:
+                self.colors.extend(face.color[:3] if face.color is not None else (-1, -1, -1))
+
+        def extend(self, faces):
+            for f in faces:
+                self.append(f)
+
+        def __iadd__(self, faces):
+            self.extend(faces)
+            return self
+
+    # mmap したファイルの頂点をそのまま見るもの
+    #
+    # Read-only `vertices` over an (n, 3) NumPy view, e.g. into a memory
+    # mapped binary PLY file (see ply_reader.read_mmap). Nothing is copied
+    # until a vertex is asked for. `solid.clone()` gives an editable copy.
+    class VertexView(object):
+
+        # Rows converted to Python lists at a time while iterating.
+        CHUNK = 65536
+
+        def __init__(self, view):
+            self.view = view
+
+        def __len__(self):
+            return len(self.view)
+
+        def __getitem__(self, i):
+            return self.view[i].tolist()
+
+        def __iter__(self):
+            for start in xrange(0, len(self.view), self.CHUNK):
+                for v in self.view[start:start + self.CHUNK].tolist():
+                    yield v
+
+        def append(self, vertex):
+            assert False, "vertices are a read-only view"
+
+        def extend(self, vertices):
+            assert False, "vertices are a read-only view"
+
+        def __iadd__(self, vertices):
+            assert False, "vertices are a read-only view"
+
+    # Read-only `faces` over an (n, k) NumPy view of face indices (without the
+    # closing index) and an optional (n, 3) view of colors, all faces having
+    # k vertices.
+    class FaceView(object):
+
+        CHUNK = 65536
+
+        def __init__(self, indices, colors=None):
+            self.indices = indices
+            self.colors = colors
+
+        def __len__(self):
+            return len(self.indices)
+
+        def loop(self, i):
+            return self.indices[i].tolist()
+
+        def color(self, i):
+            return None if self.colors is None else self.colors[i].tolist()
+
+        def __getitem__(self, i):
+            return Solid.Face(self.loop(i), self.color(i))
+
+        def __iter__(self):
+            for loop, color in self.loops():
+                yield Solid.Face(loop, color)
+
+        def loops(self):
+            for start in xrange(0, len(self.indices), self.CHUNK):
+                loops = self.indices[start:start + self.CHUNK].tolist()
+                if self.colors is None:
+                    for loop in loops:
+                        yield loop, None
+                else:
+                    for item in zip(loops, self.colors[start:start + self.CHUNK].tolist()):
+                        yield item
+
+        def append(self, face):
+            assert False, "faces are a read-only view"
+
+        def extend(self, faces):
+            assert False, "faces are a read-only view"
+
+        def __iadd__(self, faces):
+            assert False, "faces are a read-only view"
+
     def __init__(self):
         # これの引数に vertices=[] を入れていたら、前に作った vertices がなぜかコピーされる
         self.vertices = []
@@ -103,6 +288,78 @@ class Solid:
         else:
             return vertex
 
+    # 近い頂点をひとつにまとめる
+    #
+    # Merge vertices that are within `tolerance` of each other on every axis
+    # (0 merges only identical ones), and drop the faces that collapse to
+    # fewer than 3 vertices. Vertices are hashed into a grid of `tolerance`
+    # sized cells; a cell keeps one vertex, so a vertex is compared with at
+    # most the 27 vertices around it and the whole pass is O(n) instead of a
+    # `find_vertex` per vertex. Returns the new index of every old vertex.
+    def weld(self, tolerance=None):
+        if tolerance is None:
+            tolerance = Solid.WELD_TOLERANCE
+
+        cells = {}
+        coords = array("d")
+        remap = []
+        floor = math.floor
+        for v in self.vertices:
+            x = v[0]
+            y = v[1]
+            z = v[2]
+            if tolerance > 0:
+                key = (int(floor(x / tolerance)), int(floor(y / tolerance)), int(floor(z / tolerance)))
+            else:
+                key = (x, y, z)
+            index = cells.get(key)
+            if index is None and tolerance > 0:
+                index = self._weld_neighbor(cells, coords, key, x, y, z, tolerance)
+            if index is None:
+                index = len(coords) // 3
+                coords.extend((x, y, z))
+                cells[key] = index
+            remap.append(index)
+
+        if isinstance(self.faces, (Solid.FaceArray, Solid.FaceView)):
+            loops = self.faces.loops()
+            faces = Solid.FaceArray()
+        else:
+            loops = ((f.indices[:-1], f.color) for f in self.faces)
+            faces = []
+        for indices, color in loops:
+            loop = []
+            for i in indices:
+                i = remap[i]
+                if not loop or not loop[-1] == i:
+                    loop.append(i)
+            while len(loop) > 1 and loop[0] == loop[-1]:
+                loop.pop()
+            if len(loop) >= 3:
+                faces.append(Solid.Face(loop, color))
+
+        if isinstance(self.vertices, list):
+            self.vertices = [[coords[k], coords[k + 1], coords[k + 2]] for k in xrange(0, len(coords), 3)]
+        else:
+            self.vertices = Solid.VertexArray(coords)
+        self.faces = faces
+        return remap
+
+    @staticmethod
+    def _weld_neighbor(cells, coords, key, x, y, z, tolerance):
+        kx, ky, kz = key
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    index = cells.get((kx + dx, ky + dy, kz + dz))
+                    if index is None:
+                        continue
+                    k = index * 3
+                    if abs(coords[k] - x) <= tolerance and abs(coords[k + 1] - y) <= tolerance \
+                            and abs(coords[k + 2] - z) <= tolerance:
+                        return index
+        return None
+
     def find_vertex(self, vertex, decimals=None):
         index = 0
         vertex = self.round_value(vertex, decimals)
@@ -0,0 +1,99 @@
+# coding: utf-8
+#
+# テストで使うソリッド
+#
+
+import math
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from csg import CSG
+from solid import Solid
+import csg_builder
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "example", "data")
+
+
+# Box polygons around `center` with half size `radius`.
+def box(center, radius):
+    faces = [[0, 4, 6, 2], [1, 3, 7, 5], [0, 1, 5, 4], [2, 6, 7, 3], [0, 2, 3, 1], [4, 5, 7, 6]]
+    polygons = []
+    for face in faces:
+        vertices = [CSG.Vector(center[0] + radius * (2 * bool(i & 1) - 1),
+                               center[1] + radius * (2 * bool(i & 2) - 1),
+                               center[2] + radius * (2 * bool(i & 4) - 1)) for i in face]
+        polygons.append(CSG.Polygon(vertices, None))
+    return polygons
+
+
+# Box polygons like `box`, with every face cut into `n` x `n` quads.
+def grid_box(n, center, radius):
+    polygons = []
+    for axis in xrange(3):
+        u = (axis + 1) % 3
+        v = (axis + 2) % 3
+        for sign in (-1, 1):
+            for i in xrange(n):
+                for j in xrange(n):
+                    corners = [(i, j), (i + 1, j), (i + 1, j + 1), (i, j + 1)]
+                    if sign < 0:
+                        corners.reverse()
+                    vertices = []
+                    for a, b in corners:
+                        p = [0.0, 0.0, 0.0]
+                        p[axis] = center[axis] + sign * radius
+                        p[u] = center[u] + radius * (2.0 * a / n - 1)
+                        p[v] = center[v] + radius * (2.0 * b / n - 1)
+                        vertices.append(CSG.Vector(p[0], p[1], p[2]))
+                    polygons.append(CSG.Polygon(vertices, None))
+    return polygons
+
+
+# UV sphere `Solid` with `4 * n` slices and `2 * n` stacks, faces pointing
+# outwards.
+def sphere_solid(n, center=(0.0, 0.0, 0.0), radius=1.0):
+    solid = Solid()
+    cx, cy, cz = center
+    top = solid.append_vertex([cx, cy, cz + radius])
+    rings = []
+    for j in xrange(1, 2 * n):
+        phi = math.pi * j / (2 * n)
+        ring = []
+        for i in xrange(4 * n):
+            theta = 2 * math.pi * i / (4 * n)
+            ring.append(solid.append_vertex([cx + radius * math.sin(phi) * math.cos(theta),
+                                             cy + radius * math.sin(phi) * math.sin(theta),
+                                             cz + radius * math.cos(phi)]))
+        rings.append(ring)
+    bottom = solid.append_vertex([cx, cy, cz - radius])
+    for i in xrange(4 * n):
+        k = (i + 1) % (4 * n)
+        solid.append_polygon([top, rings[0][i], rings[0][k]], as_tri=False)
+        for j in xrange(len(rings) - 1):
+            solid.append_polygon([rings[j][i], rings[j + 1][i], rings[j + 1][k], rings[j][k]],
+                                 as_tri=False)
+        solid.append_polygon([bottom, rings[-1][k], rings[-1][i]], as_tri=False)
+    return solid
+
+
+def sphere(n, center=(0.0, 0.0, 0.0), radius=1.0):
+    return csg_builder.csg_from_solid(sphere_solid(n, center, radius))
+
+
+def volume(csg):
+    total = 0.0
+    for p in csg.polygons:
+        a = p.vertices[0]
+        for b, c in zip(p.vertices[1:-1], p.vertices[2:]):
+            total += a.dot(b.cross(c)) / 6.0
+    return total
+
+
+def area(csg):
+    total = 0.0
+    for p in csg.polygons:
+        a = p.vertices[0]
+        for b, c in zip(p.vertices[1:-1], p.vertices[2:]):
+            total += b.minus(a).cross(c.minus(a)).length() / 2.0
+    return total
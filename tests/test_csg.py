@@ -0,0 +1,159 @@
+# coding: utf-8
+#
+# csg のテスト
+#
+#     python -m unittest discover -s tests
+#
+
+import os
+import unittest
+
+from solids import DATA, box, grid_box, sphere, volume
+from csg import CSG
+import csg_builder
+import ply_reader
+
+
+class TestRobust(unittest.TestCase):
+
+    # A box with a sphere cut out of a corner, both scaled by `scale`.
+    def solids(self, scale):
+        a = CSG.fromPolygons(box([0, 0, 0], scale))
+        b = sphere(6, (scale, scale, scale), 1.2 * scale)
+        return a, b
+
+    # Robust mode gives the same solid at every scale, where the fixed
+    # tolerance is too coarse for small solids.
+    def test_scale(self):
+        a, b = self.solids(1.0)
+        expected = volume(a.subtract(b))
+        for scale in [1e-4, 1e-2, 1e3]:
+            a, b = self.solids(scale)
+            result = volume(a.subtract(b, robust=True)) / scale ** 3
+            self.assertAlmostEqual(result, expected, delta=1e-9 * expected)
+
+    # Trees cached by a boolean in one mode must not be reused in the other.
+    def test_mixed_modes(self):
+        a, b = self.solids(1e-4)
+        robust = volume(a.subtract(b, robust=True))
+        a, b = self.solids(1e-4)
+        plain = volume(a.subtract(b))
+
+        a, b = self.solids(1e-4)
+        self.assertEqual(volume(a.subtract(b)), plain)
+        self.assertEqual(volume(a.subtract(b, robust=True)), robust)
+        a, b = self.solids(1e-4)
+        self.assertEqual(volume(a.subtract(b, robust=True)), robust)
+        self.assertEqual(volume(a.subtract(b)), plain)
+
+    # subtract_many takes the tolerance from all the solids at once, and cuts
+    # what a chain of robust subtracts cuts.
+    def test_subtract_many(self):
+        for scale in [1e-4, 1e3]:
+            a, b = self.solids(scale)
+            c = sphere(4, (-scale, 0, 0), 0.5 * scale)
+            expected = volume(a.subtract(b, robust=True).subtract(c, robust=True))
+            a, b = self.solids(scale)
+            result = volume(a.subtract_many([b, c], robust=True))
+            self.assertAlmostEqual(result, expected, delta=1e-9 * expected)
+
+
+class TestTree(unittest.TestCase):
+
+    def setUp(self):
+        self.a = csg_builder.csg_from_solid(ply_reader.read(os.path.join(DATA, "a.ply")))
+        self.b = csg_builder.csg_from_solid(ply_reader.read(os.path.join(DATA, "b.ply")))
+
+    # A tree cached by an earlier boolean is not reused with another splitter.
+    def test_splitter(self):
+        self.a.intersect(self.b)
+        expected = CSG.Node(self.a.polygons, splitter=CSG.Splitter("cost", seed=1)).stats()
+        self.assertEqual(self.a.tree(CSG.Splitter("cost", seed=1)).stats(), expected)
+        expected = CSG.Node(self.a.polygons).stats()
+        self.assertEqual(self.a.tree().stats(), expected)
+
+
+class TestMany(unittest.TestCase):
+
+    # A row of overlapping spheres and one far from the others.
+    def setUp(self):
+        self.spheres = [sphere(3, (0.6 * i, 0.2 * i, 0)) for i in xrange(4)]
+        self.spheres.append(sphere(3, (10, 0, 0)))
+
+    def test_union_many(self):
+        expected = self.spheres[0]
+        for b in self.spheres[1:]:
+            expected = expected.union(b)
+        result = self.spheres[0].union_many(self.spheres[1:])
+        self.assertAlmostEqual(volume(result), volume(expected), delta=1e-9)
+
+    # Tools overlapping each other, and one missing the stock.
+    def test_subtract_many(self):
+        stock = CSG.fromPolygons(box([0.9, 0.3, 0], 1))
+        expected = stock
+        for b in self.spheres:
+            expected = expected.subtract(b)
+        result = stock.subtract_many(self.spheres)
+        self.assertAlmostEqual(volume(result), volume(expected), delta=1e-9)
+
+
+# Booleans that clip every polygon of the overlap box through the trees.
+class NoBVH(CSG):
+
+    def _bvh(self, bounds, profile, label):
+        return None
+
+
+class TestFar(unittest.TestCase):
+
+    # Polygons far from the other surface are kept or dropped whole, so the
+    # results have fewer fragments than with every polygon clipped, and the
+    # same volume.
+    def test_corner(self):
+        counts = [0, 0]
+        for center, radius in [((1, 1, 1), 0.8), ((1, 0, 0), 0.5)]:
+            for op in ["union", "subtract", "intersect"]:
+                a = grid_box(12, (0, 0, 0), 1)
+                b = sphere(6, center, radius)
+                result = getattr(CSG.fromPolygons(a), op)(b)
+                expected = getattr(NoBVH(a), op)(NoBVH(b.polygons))
+                self.assertTrue(len(result.polygons) <= len(expected.polygons), op)
+                self.assertAlmostEqual(volume(result), volume(expected), delta=1e-9, msg=op)
+                counts[0] += len(result.polygons)
+                counts[1] += len(expected.polygons)
+        self.assertTrue(counts[0] < counts[1])
+
+    # A solid inside the other is classified as one group of polygons.
+    def test_inside(self):
+        a = grid_box(6, (0, 0, 0), 0.3)
+        b = sphere(6)
+        result = CSG.fromPolygons(a).intersect(b)
+        self.assertEqual(len(result.polygons), len(a))
+        self.assertAlmostEqual(volume(result), 0.216, delta=1e-9)
+        result = CSG.fromPolygons(a).subtract(b)
+        self.assertEqual(len(result.polygons), 0)
+
+
+class TestProfile(unittest.TestCase):
+
+    # Every "allPolygons" phase counts the polygons of its own tree.
+    def test_union_many(self):
+        solids = [CSG.fromPolygons(box([0.6 * i, 0.3 * i, 0], 1)) for i in xrange(3)]
+        profile = CSG.Profile()
+        result = solids[0].union_many(solids[1:], profile=profile)
+        counts = [r["polygons_out"] for r in profile.records if r["phase"] == "allPolygons"]
+        self.assertEqual(len(counts), 3)
+        self.assertEqual(sum(counts), len(result.polygons))
+
+    def test_subtract_many(self):
+        stock = CSG.fromPolygons(box([0, 0, 0], 1))
+        tools = [CSG.fromPolygons(box([0.8 * i - 0.8, 0.9, 0.9], 0.5)) for i in xrange(3)]
+        profile = CSG.Profile()
+        result = stock.subtract_many(tools, profile=profile)
+        counts = [r["polygons_out"] for r in profile.records if r["phase"] == "allPolygons"]
+        self.assertEqual(len(counts), 4)
+        self.assertEqual(sum(counts), len(result.polygons))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+# coding: utf-8
+#
+# csg_cache のテスト
+#
+#     python -m unittest discover -s tests
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from solids import box
+from csg import CSG
+import csg_cache
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.a = CSG.fromPolygons(box([0, 0, 0], 1))
+        self.b = CSG.fromPolygons(box([1, 1, 1], 1))
+
+    def test_clear_memory_only(self):
+        cache = csg_cache.Cache()
+        key = cache.key("union", self.a, self.b, "python")
+        cache.put(key, self.a.union(self.b))
+        cache.clear()
+        self.assertIsNone(cache.get(key))
+
+    def test_clear_directory(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = csg_cache.Cache(directory)
+            key = cache.key("union", self.a, self.b, "python")
+            cache.put(key, self.a.union(self.b))
+            self.assertEqual(len(os.listdir(directory)), 1)
+            cache.clear()
+            self.assertEqual(os.listdir(directory), [])
+            self.assertIsNone(cache.get(key))
+        finally:
+            shutil.rmtree(directory)
+
+    # csg_file cannot write an object as `shared`: the result stays in memory.
+    def test_shared_object(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = csg_cache.Cache(directory)
+            result = self.a.union(self.b)
+            result.polygons[0].shared = object()
+            key = cache.key("union", self.a, self.b, "python")
+            cache.put(key, result)
+            self.assertEqual(os.listdir(directory), [])
+            self.assertEqual(len(cache.get(key).polygons), len(result.polygons))
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    unittest.main()
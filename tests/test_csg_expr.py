@@ -0,0 +1,60 @@
+# coding: utf-8
+#
+# csg_expr のテスト
+#
+#     python -m unittest discover -s tests
+#
+
+import unittest
+
+from solids import box, sphere, volume
+from csg import CSG
+
+
+class TestExpr(unittest.TestCase):
+
+    def setUp(self):
+        self.a = CSG.fromPolygons(box([0, 0, 0], 1))
+        self.b = sphere(3, (1, 0, 0), 0.6)
+        self.c = sphere(3, (0, 1, 0), 0.6)
+        self.d = sphere(3, (0, 0, 1), 0.6)
+        self.e = sphere(3, (1, 1, 1), 0.6)
+        self.far = CSG.fromPolygons(box([10, 0, 0], 1))
+
+    # A chain becomes one n-way union inside one n-way subtract, and gives
+    # the solid of the chain of booleans.
+    def test_chain(self):
+        expr = self.a.lazy().union(self.b).union(self.c).subtract(self.d).subtract(self.e)
+        plan = expr.plan()
+        self.assertEqual(plan.op, "subtract")
+        self.assertEqual(len(plan.children), 3)
+        self.assertEqual(plan.children[0].op, "union")
+        self.assertEqual(len(plan.children[0].children), 3)
+
+        expected = self.a.union(self.b).union(self.c).subtract(self.d).subtract(self.e)
+        self.assertAlmostEqual(volume(expr.evaluate()), volume(expected), delta=1e-9)
+        result = expr.evaluate(engine="numpy")
+        self.assertAlmostEqual(volume(result), volume(expected), delta=1e-9)
+
+    # The same union written twice is evaluated once.
+    def test_fold(self):
+        expr = self.a.lazy().union(self.b).intersect(self.b.lazy().union(self.a))
+        plan = expr.plan()
+        self.assertEqual(plan.op, "union")
+        self.assertAlmostEqual(volume(expr.evaluate()), volume(self.a.union(self.b)), delta=1e-9)
+
+    # Operands that cannot touch the result are dropped before any boolean.
+    def test_prune(self):
+        expr = self.a.lazy().subtract(self.far).subtract(self.b)
+        plan = expr.plan()
+        self.assertEqual(len(plan.children), 2)
+        self.assertAlmostEqual(volume(expr.evaluate()), volume(self.a.subtract(self.b)),
+                               delta=1e-9)
+
+        expr = self.a.lazy().union(self.b).intersect(self.far)
+        self.assertEqual(expr.plan().op, "empty")
+        self.assertEqual(len(expr.evaluate().polygons), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+# coding: utf-8
+#
+# csg_file のテスト
+#
+#     python -m unittest discover -s tests
+#
+
+import os
+import unittest
+
+from solids import box
+from csg import CSG
+import csg_file
+
+
+class TestFile(unittest.TestCase):
+
+    def test_shared(self):
+        polygons = box([0, 0, 0], 1)
+        colors = [[255, 255, 0], (0.5, u"steel"), {"id": 3}, None]
+        for i, p in enumerate(polygons):
+            p.shared = colors[i % len(colors)]
+        csg = csg_file.loads(csg_file.dumps(CSG.fromPolygons(polygons)))
+        self.assertEqual([p.shared for p in csg.polygons], [p.shared for p in polygons])
+
+    def test_shared_object(self):
+        polygons = box([0, 0, 0], 1)
+        polygons[0].shared = object()
+        self.assertRaises(AssertionError, csg_file.dumps, CSG.fromPolygons(polygons))
+
+    # The shareds section is parsed as a literal, never run.
+    def test_shared_code(self):
+        data = csg_file.dumps(CSG.fromPolygons(box([0, 0, 0], 1)))
+        code = "[__import__('os').system('exit 1')]"
+        header = list(csg_file.HEADER.unpack(data[:csg_file.HEADER.size]))
+        size = header[-1]
+        header[-1] = len(code)
+        data = csg_file.HEADER.pack(*header) + data[csg_file.HEADER.size:-size] + code
+        self.assertRaises(ValueError, csg_file.loads, data)
+
+    # A tree is read back with the tolerance it was built under, and is not
+    # used under another one.
+    def test_tree_tolerance(self):
+        csg = CSG.fromPolygons(box([0, 0, 0], 1))
+        csg.tree()
+        data = csg_file.dumps(csg)
+        csg = csg_file.loads(data)
+        csg.tree()
+        self.assertIsNotNone(csg._flat)
+        saved = CSG.Plane_EPSILON
+        CSG.Plane_EPSILON = 1e-9
+        try:
+            csg = csg_file.loads(data)
+            csg.tree()
+            self.assertIsNone(csg._flat)
+        finally:
+            CSG.Plane_EPSILON = saved
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+# coding: utf-8
+#
+# csg_merge のテスト
+#
+#     python -m unittest discover -s tests
+#
+
+import unittest
+
+from solids import area, box, sphere, volume
+from csg import CSG
+
+
+def convex(polygon):
+    normal = polygon.plane.normal
+    vertices = polygon.vertices
+    for i in xrange(len(vertices)):
+        a, b, c = vertices[i - 2], vertices[i - 1], vertices[i]
+        if b.minus(a).cross(c.minus(b)).dot(normal) < -1e-9:
+            return False
+    return True
+
+
+class TestMerge(unittest.TestCase):
+
+    # The fragments left on the faces of a box by a chain of booleans merge
+    # back into fewer convex polygons, and the chain goes on with the same
+    # solid.
+    def test_chain(self):
+        a = CSG.fromPolygons(box([0, 0, 0], 1))
+        b = sphere(4, (1, 1, 1), 0.8)
+        c = CSG.fromPolygons(box([-1, 0, 0], 0.5))
+        result = a.subtract(b).union(CSG.fromPolygons(box([0, 0, 1], 0.5)))
+        merged = result.mergeCoplanar()
+        self.assertTrue(len(merged.polygons) < len(result.polygons))
+        self.assertTrue(all(convex(p) for p in merged.polygons))
+        self.assertAlmostEqual(volume(merged), volume(result), delta=1e-9)
+        self.assertAlmostEqual(area(merged), area(result), delta=1e-9)
+
+        expected = result.subtract(c)
+        merged = merged.subtract(c)
+        self.assertAlmostEqual(volume(merged), volume(expected), delta=1e-9)
+        self.assertTrue(len(merged.polygons) < len(expected.polygons))
+
+    # Two boxes side by side have four faces each on the same planes; only
+    # faces with the same `shared` become one polygon. The faces where the
+    # boxes touch face opposite ways and stay.
+    def test_shared(self):
+        a = box([0, 0, 0], 1)
+        b = box([2, 0, 0], 1)
+        for p in b:
+            p.shared = "b"
+        result = CSG.fromPolygons(a + b).mergeCoplanar()
+        self.assertEqual(len(result.polygons), 12)
+
+        for p in b:
+            p.shared = None
+        result = CSG.fromPolygons(a + b).mergeCoplanar()
+        self.assertAlmostEqual(volume(result), 16.0, delta=1e-9)
+        self.assertEqual(len(result.polygons), 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
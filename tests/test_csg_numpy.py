@@ -0,0 +1,89 @@
+# coding: utf-8
+#
+# csg_numpy のテスト
+#
+#     python -m unittest discover -s tests
+#
+
+import os
+import unittest
+
+from solids import DATA, area, box, sphere, volume
+from csg import CSG
+import csg_builder
+import ply_reader
+
+
+# The vertices of `polygon` starting from the smallest one, as the engines
+# may start a flipped polygon at a different vertex.
+def loop(polygon):
+    vertices = [(v.x, v.y, v.z) for v in polygon.vertices]
+    i = vertices.index(min(vertices))
+    return vertices[i:] + vertices[:i]
+
+
+# `csg` moved by 10 along x.
+def moved(csg):
+    return CSG([CSG.Polygon([CSG.Vector(v.x + 10.0, v.y, v.z) for v in p.vertices], None)
+                for p in csg.polygons])
+
+
+class TestEngines(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.a = csg_builder.csg_from_solid(ply_reader.read(os.path.join(DATA, "a.ply")))
+        cls.b = csg_builder.csg_from_solid(ply_reader.read(os.path.join(DATA, "b.ply")))
+
+    # The example solids are not closed, so the result depends on the shape
+    # of the trees: both engines have to pick the same splitting planes.
+    def test_example_data(self):
+        for op in ["union", "subtract", "intersect"]:
+            expected = getattr(self.a, op)(self.b, engine="python")
+            result = getattr(self.a, op)(self.b, engine="numpy")
+            self.assertEqual(len(result.polygons), len(expected.polygons), op)
+            self.assertAlmostEqual(area(result), area(expected), delta=1e-6 * area(expected))
+
+    def test_same_polygons(self):
+        expected = self.a.intersect(self.b, engine="python")
+        result = self.a.intersect(self.b, engine="numpy")
+        self.assertEqual(len(result.polygons), len(expected.polygons))
+        for p, q in zip(result.polygons, expected.polygons):
+            self.assertEqual(p.shared, q.shared)
+            for u, v in zip(loop(p), loop(q)):
+                for x, y in zip(u, v):
+                    self.assertAlmostEqual(x, y, delta=1e-6)
+
+    # On closed solids both engines give the same solid, even where the
+    # python engine keeps far polygons whole. The volume about another origin
+    # changes with every gap in the surface, so it has to match too.
+    def test_closed(self):
+        a = sphere(4)
+        b = sphere(4, (0.5, 0.3, 0.2))
+        for op in ["union", "subtract", "intersect"]:
+            expected = getattr(a, op)(b, engine="python")
+            result = getattr(a, op)(b, engine="numpy")
+            self.assertAlmostEqual(volume(result), volume(expected), delta=1e-9, msg=op)
+            self.assertAlmostEqual(volume(moved(result)), volume(moved(expected)), delta=1e-9,
+                                   msg=op)
+
+
+class TestBuild(unittest.TestCase):
+
+    # A quad with a vertex slightly off its own plane has to stay in the node
+    # its plane was picked from instead of being split against it forever.
+    def test_non_planar_polygon(self):
+        polygons = box([0, 0, 0], 5000)
+        p = polygons[0]
+        p.vertices[3] = p.vertices[3].plus(p.plane.normal.times(4e-3))
+        a = CSG.fromPolygons(polygons)
+        b = CSG.fromPolygons(box([3000, 2000, 1000], 5000))
+
+        expected = a.union(b, engine="python")
+        result = a.union(b, engine="numpy")
+        self.assertEqual(len(result.polygons), len(expected.polygons))
+        self.assertAlmostEqual(volume(result), volume(expected), delta=1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
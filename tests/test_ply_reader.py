@@ -0,0 +1,142 @@
+# coding: utf-8
+#
+# ply_reader のテスト
+#
+#     python -m unittest discover -s tests
+#
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from solids import sphere, sphere_solid, volume
+from solid import Solid
+import csg_builder
+import ply_reader
+from ply_writer import PLYWriter
+
+VERTICES = [(0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 1, 0)]
+FACES = [([0, 1, 2], (1.0, 0.5, 0.0)), ([0, 2, 3], (0.2, 0.0, 1.0))]
+COLORS = [[255, 128, 0], [51, 0, 255]]
+
+
+def header(format, color_type):
+    return ("ply\nformat %s 1.0\n"
+            "element vertex %d\nproperty float x\nproperty float y\nproperty float z\n"
+            "element face %d\nproperty list uchar int vertex_indices\n"
+            "property %s red\nproperty %s green\nproperty %s blue\nend_header\n"
+            % (format, len(VERTICES), len(FACES), color_type, color_type, color_type))
+
+
+class TestFloatColor(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data):
+        filename = os.path.join(self.directory, name)
+        with open(filename, "wb") as io:
+            io.write(data)
+        return filename
+
+    def ascii(self):
+        data = header("ascii", "float")
+        data += "".join("%g %g %g\n" % v for v in VERTICES)
+        data += "".join("3 %d %d %d %g %g %g\n" % tuple(f + list(c)) for f, c in FACES)
+        return self.write("ascii.ply", data)
+
+    def binary(self, color_type):
+        code = ply_reader.TYPES[color_type]
+        data = header("binary_little_endian", color_type)
+        data += "".join(struct.pack("<fff", *v) for v in VERTICES)
+        data += "".join(struct.pack("<B3i3" + code, 3, *(f + list(c))) for f, c in FACES)
+        return self.write("%s.ply" % color_type, data)
+
+    def colors(self, solid):
+        return [face.color for face in solid.faces]
+
+    # float and double colors are 0..1 and come out as 0..255.
+    def test_read(self):
+        for filename in [self.ascii(), self.binary("float"), self.binary("double")]:
+            self.assertEqual(self.colors(ply_reader.read(filename)), COLORS, filename)
+
+    def test_read_mmap(self):
+        self.assertEqual(self.colors(ply_reader.read_mmap(self.binary("float"))), COLORS)
+
+    def test_read_chunks(self):
+        for filename in [self.ascii(), self.binary("double")]:
+            vertices, chunks = ply_reader.read_chunks(filename)
+            self.assertEqual([color for chunk in chunks for loop, color in chunk], COLORS)
+
+
+class TestStream(unittest.TestCase):
+
+    # A sphere of triangles and quads, some faces with a color, written in
+    # every format, and the sphere cut into triangles as binary.
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.solid = sphere_solid(4)
+        for i, face in enumerate(cls.solid.faces):
+            if i % 3 == 0:
+                face.color = [i % 256, 0, 255]
+        cls.filenames = []
+        for format in ["ascii", "binary_little_endian", "binary_big_endian"]:
+            filename = os.path.join(cls.directory, format + ".ply")
+            with PLYWriter(filename, format) as writer:
+                writer.write_solid(cls.solid)
+            cls.filenames.append(filename)
+        cls.triangles = os.path.join(cls.directory, "triangles.ply")
+        with PLYWriter(cls.triangles, "binary_little_endian") as writer:
+            writer.write_solid(csg_builder.csg_to_solid(csg_builder.csg_from_solid(cls.solid),
+                                                        as_tri=True))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def faces(self, solid):
+        return [(list(loop), color) for loop, color in solid.faces.loops()]
+
+    # Chunks smaller than the file, ending inside runs of triangles and of
+    # quads, give the faces of `read`.
+    def test_read_chunks(self):
+        for filename in self.filenames:
+            expected = ply_reader.read(filename)
+            vertices, chunks = ply_reader.read_chunks(filename, 7)
+            self.assertEqual(list(vertices.coords), list(expected.vertices.coords), filename)
+            self.assertEqual([face for chunk in chunks for face in chunk], self.faces(expected),
+                             filename)
+
+    # Faces of one size are viewed in the mapped file, the others decoded.
+    def test_read_mmap(self):
+        for filename in self.filenames + [self.triangles]:
+            expected = ply_reader.read(filename)
+            solid = ply_reader.read_mmap(filename)
+            if filename == self.triangles:
+                self.assertTrue(isinstance(solid.vertices, Solid.VertexView))
+                self.assertTrue(isinstance(solid.faces, Solid.FaceView))
+            self.assertEqual([list(v) for v in solid.vertices], [list(v) for v in expected.vertices])
+            self.assertEqual(self.faces(solid), self.faces(expected), filename)
+
+    # A solid streamed into its tree has the polygons of the solid read whole,
+    # and the same booleans. The tree is built chunk by chunk, so the result
+    # may be cut into other fragments.
+    def test_csg_from_ply(self):
+        b = sphere(4, (0.5, 0.3, 0.2))
+        for filename in self.filenames + [self.triangles]:
+            a = csg_builder.csg_from_solid(ply_reader.read(filename))
+            expected = a.subtract(b)
+            csg = csg_builder.csg_from_ply(filename, chunk=7)
+            self.assertEqual(len(csg.polygons), len(a.polygons), filename)
+            self.assertAlmostEqual(volume(csg), volume(a), delta=1e-9)
+            self.assertAlmostEqual(volume(csg.subtract(b)), volume(expected), delta=1e-9)
+
+
+if __name__ == "__main__":
+    unittest.main()
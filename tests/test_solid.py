@@ -0,0 +1,53 @@
+# coding: utf-8
+#
+# solid のテスト
+#
+#     python -m unittest discover -s tests
+#
+
+import unittest
+
+from solids import sphere, sphere_solid, volume
+from solid import Solid
+import csg_builder
+
+
+class TestWeld(unittest.TestCase):
+
+    # A solid with its own vertices for every polygon welds back to the shared
+    # vertices of the sphere, and gives the same boolean as the sphere.
+    def test_sphere(self):
+        original = sphere_solid(4)
+        solid = csg_builder.csg_to_solid(csg_builder.csg_from_solid(original), weld=False)
+        self.assertTrue(len(solid.vertices) > len(original.vertices))
+
+        solid.weld()
+        self.assertEqual(len(solid.vertices), len(original.vertices))
+        self.assertEqual(len(solid.faces), len(original.faces))
+        b = sphere(4, (0.5, 0.3, 0.2))
+        expected = csg_builder.csg_from_solid(original).subtract(b)
+        result = csg_builder.csg_from_solid(solid).subtract(b)
+        self.assertEqual(len(result.polygons), len(expected.polygons))
+        self.assertAlmostEqual(volume(result), volume(expected), delta=1e-9)
+
+    # Vertices within the tolerance on every axis are merged, across cells of
+    # the grid too, and faces left with fewer than 3 vertices are dropped.
+    def test_tolerance(self):
+        solid = Solid()
+        for v in [[0, 0, 0], [1, 0, 0], [0, 1, 0], [1e-7, -1e-7, 0], [1, 1e-7, 1e-7], [2, 2, 2]]:
+            solid.append_vertex(v)
+        solid.append_plane([0, 1, 2])
+        solid.append_plane([3, 4, 2])
+        solid.append_plane([0, 4, 5])
+        remap = solid.weld(1e-6)
+        self.assertEqual(remap, [0, 1, 2, 0, 1, 3])
+        self.assertEqual(len(solid.vertices), 4)
+        self.assertEqual([f.indices[:-1] for f in solid.faces], [[0, 1, 2], [0, 1, 2], [0, 1, 3]])
+
+        solid.weld(1.5)
+        self.assertEqual(len(solid.vertices), 2)
+        self.assertEqual(len(solid.faces), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()